@@ -0,0 +1,261 @@
+from datetime import datetime
+import os
+import sys
+import json
+import gzip
+import time
+import hashlib
+import logging
+import argparse
+import subprocess
+
+from vcf_index import find_index, read_index
+
+# timed tsim.py scenarios on synthetic cohorts (see synthetic.py)
+# each scenario runs in its own process: wall time, variants/sec, peak RSS (of the process and the ones it waited for)
+# and a checksum of its outputs, so that runs before and after a change can be compared
+# this process stays small (no numpy): a child's peak RSS starts from the size of its parent
+TSIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tsim.py')
+SYNTHETIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic.py')
+SCENARIOS = ['rsq', 'rsq-jobs', 'rsq-threads', 'rsq-info', 'rsq-hwe', 'qc', 'qc-stream', 'overlap', 'merge', 'merge-stream', 'merge-targets']
+
+
+def scenario_command(name, data, prep, out, n_cohorts):
+    # (tsim.py arguments, outputs) of a scenario; cohort 0 for rsq and qc, all cohorts for overlap and merge
+    c0 = '%s/c0' % data
+    qc_args = ['-c', '22', '-rf', '0.8', '-mf', '0.01', '-ef', '0.5', '--hwe', c0 + '.hwe']
+    commands = {
+        'rsq': (['rsq', '-v', c0 + '.vcf.gz', '-s', c0 + '.samples.txt', '-o', out + '.tsv'], [out + '.tsv']),
+        'rsq-jobs': (['rsq', '-v', c0 + '.vcf.gz', '-s', c0 + '.samples.txt', '-o', out + '.tsv', '-j', '4',
+                      '-t', os.path.dirname(out)], [out + '.tsv']),
+        'rsq-threads': (['rsq', '-v', c0 + '.vcf.gz', '-s', c0 + '.samples.txt', '-o', out + '.tsv',
+                         '--decompress-threads', '4'], [out + '.tsv']),
+        'rsq-info': (['rsq', '-v', c0 + '.vcf.gz', '--info-only', '-o', out + '.tsv'], [out + '.tsv']),
+        'rsq-hwe': (['rsq', '-v', c0 + '.vcf.gz', '-s', c0 + '.samples.txt', '-o', out + '.tsv', '--calc-hwe'],
+                    [out + '.tsv']),
+        'qc': (['qc', '-r', prep + '/c0.rsq.tsv', '-m', prep + '/c0.rsq.tsv', '-o', out + '.txt'] + qc_args, [out + '.txt']),
+        'qc-stream': (['qc', '-r', prep + '/c0.rsq.tsv', '-m', prep + '/c0.rsq.tsv', '-o', out + '.txt', '--stream'] +
+                      qc_args, [out + '.txt']),
+        'overlap': (['overlap', '-l', prep + '/qc_lists.txt', '-c', '22', '-o', out + '.txt'], [out + '.txt']),
+        'merge': (['merge', '-l', prep + '/mergelist.txt', '-c', '22', '-o', out + '.vcf.gz', '-t', os.path.dirname(out),
+                   '-s'], [out + '.vcf.gz']),
+        'merge-stream': (['merge', '-l', prep + '/mergelist.txt', '-c', '22', '-o', out + '.vcf.gz',
+                          '-t', os.path.dirname(out), '-s', '--stream'], [out + '.vcf.gz']),
+        'merge-targets': (['merge', '-l', prep + '/mergelist.txt', '-c', '22', '-o', out + '.vcf.gz',
+                           '-t', os.path.dirname(out), '-s', '--targets', '-j', str(n_cohorts)], [out + '.vcf.gz']),
+    }
+    return commands[name]
+
+
+def scenario_variants(name, data, prep, n_cohorts):
+    # number of input variants of a scenario, for variants/sec
+    if name.startswith('rsq') or name.startswith('qc'):
+        return vcf_records('%s/c0.vcf.gz' % data)
+    if name == 'overlap':
+        return sum(count_lines('%s/c%s.qc.txt' % (prep, k)) for k in range(n_cohorts))
+    return sum(vcf_records('%s/c%s.vcf.gz' % (data, k)) for k in range(n_cohorts))
+
+
+def vcf_records(vcf_fn):
+    # from the tabix index
+    return sum(contig[3] for contig in read_index(find_index(vcf_fn)))
+
+
+def count_lines(fn):
+    with open(fn) as f1:
+        return sum(1 for line in f1)
+
+
+def checksum(fn):
+    # md5 of the output; for VCFs without the ## header lines, which hold dates and command lines
+    digest = hashlib.md5()
+    if fn.endswith('.vcf.gz'):
+        with gzip.open(fn, 'rb') as f1:
+            for line in f1:
+                if not line.startswith(b'##'):
+                    digest.update(line)
+    else:
+        with open(fn, 'rb') as f1:
+            for chunk in iter(lambda: f1.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def run_tsim(args, log_fn):
+    # (seconds, peak RSS in MB, exit code) of one tsim.py call
+    with open(log_fn, 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, TSIM] + args, stdout=log, stderr=subprocess.STDOUT)
+        (pid, status, usage) = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kB on Linux
+    return (seconds, usage.ru_maxrss/1024.0, proc.returncode)
+
+
+def prepare(data, prep, n_cohorts, needed):
+    # untimed inputs of the qc, overlap and merge scenarios: Rsq tables, QC lists, overlap and merge list
+    os.makedirs(prep, exist_ok=True)
+    for k in range(n_cohorts):
+        c = '%s/c%s' % (data, k)
+        steps = [(['rsq', '-v', c + '.vcf.gz', '-s', c + '.samples.txt', '-o', '%s/c%s.rsq.tsv' % (prep, k)],
+                  '%s/c%s.rsq.tsv' % (prep, k)),
+                 (['qc', '-r', '%s/c%s.rsq.tsv' % (prep, k), '-m', '%s/c%s.rsq.tsv' % (prep, k), '-c', '22',
+                   '-rf', '0.8', '-mf', '0.01', '-ef', '0.5', '--hwe', c + '.hwe', '-o', '%s/c%s.qc.txt' % (prep, k)],
+                  '%s/c%s.qc.txt' % (prep, k))]
+        for (args, output) in steps:
+            if os.path.exists(output) or not needed:
+                continue
+            logging.info('Preparing %s' % output)
+            if run_tsim(args, output + '.log')[2] != 0:
+                logging.error('Preparing %s failed, see %s.log' % (output, output))
+                sys.exit(1)
+    with open(prep + '/qc_lists.txt', 'w') as fo:
+        fo.write(''.join(['%s/c%s.qc.txt\n' % (prep, k) for k in range(n_cohorts)]))
+    overlap_fn = prep + '/overlap.txt'
+    if needed and not os.path.exists(overlap_fn):
+        logging.info('Preparing %s' % overlap_fn)
+        if run_tsim(['overlap', '-l', prep + '/qc_lists.txt', '-c', '22', '-o', overlap_fn], overlap_fn + '.log')[2] != 0:
+            logging.error('Preparing %s failed, see %s.log' % (overlap_fn, overlap_fn))
+            sys.exit(1)
+    with open(prep + '/mergelist.txt', 'w') as fo:
+        fo.write(''.join(['%s/c%s.vcf.gz,%s,%s/c%s.samples.txt\n' % (data, k, overlap_fn, data, k) for k in range(n_cohorts)]))
+
+
+def simulate(data, n_cohorts, n_variants, n_samples, seed):
+    # synthetic cohorts, reused while the parameters are the same
+    params = {'cohorts': n_cohorts, 'variants': n_variants, 'samples': n_samples, 'seed': seed}
+    params_fn = data + '/params.json'
+    if os.path.exists(params_fn):
+        with open(params_fn) as f1:
+            if json.load(f1) == params:
+                logging.info('Reusing synthetic cohorts in %s' % data)
+                return False
+    cmd = [sys.executable, SYNTHETIC, '-o', data, '-k', str(n_cohorts), '-v', str(n_variants), '-n', str(n_samples),
+           '--seed', str(seed)]
+    if subprocess.run(cmd).returncode != 0:
+        logging.error('Simulating cohorts failed.')
+        sys.exit(1)
+    with open(params_fn, 'w') as fo:
+        json.dump(params, fo)
+    return True
+
+
+def load_results(fn):
+    results = {}
+    with open(fn) as f1:
+        header = f1.readline().rstrip('\n').split('\t')
+        for line in f1:
+            row = dict(zip(header, line.rstrip('\n').split('\t')))
+            results[row['scenario']] = row
+    return results
+
+
+def run(outdir, scenarios, n_cohorts=2, n_variants=100000, n_samples=500, seed=1, repeat=1, output=None, compare=None):
+    start = datetime.now()
+    logging.info('###########################')
+    logging.info('######## Benchmark ########')
+    logging.info('###########################')
+    logging.info('### Arguments')
+    logging.info('Output directory\t%s' % outdir)
+    logging.info('Scenarios\t%s' % ', '.join(scenarios))
+    logging.info('Cohorts\t%s' % n_cohorts)
+    logging.info('Variants\t%s' % n_variants)
+    logging.info('Samples\t%s' % n_samples)
+    logging.info('Seed\t%s' % seed)
+    logging.info('Repeats\t%s' % repeat)
+
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if len(unknown) > 0:
+        logging.error('Unknown scenarios: %s (choose from %s)' % (', '.join(unknown), ', '.join(SCENARIOS)))
+        sys.exit(1)
+    if output == None:
+        output = outdir + '/benchmark.tsv'
+
+    data = outdir + '/data'
+    prep = outdir + '/prep'
+    out = outdir + '/out'
+    os.makedirs(out, exist_ok=True)
+    if simulate(data, n_cohorts, n_variants, n_samples, seed) and os.path.exists(prep):
+        # inputs made from older synthetic data
+        for fn in os.listdir(prep):
+            os.remove(os.path.join(prep, fn))
+    prepare(data, prep, n_cohorts, any(not name.startswith('rsq') for name in scenarios))
+
+    logging.info('####################')
+    rows = []
+    for name in scenarios:
+        (args, outputs) = scenario_command(name, data, prep, '%s/%s' % (out, name), n_cohorts)
+        n = scenario_variants(name, data, prep, n_cohorts)
+        times = []
+        peak = 0
+        failed = False
+        for r in range(repeat):
+            (seconds, rss, code) = run_tsim(args, '%s/%s.log' % (out, name))
+            if code != 0:
+                logging.error('%s failed (exit code %s), see %s/%s.log' % (name, code, out, name))
+                failed = True
+                break
+            times.append(seconds)
+            peak = max(peak, rss)
+        if failed:
+            rows.append([name, n, 'NA', 'NA', 'NA', 'failed'])
+            continue
+        # median of the repeats
+        seconds = sorted(times)[len(times)//2]
+        digest = hashlib.md5(''.join(checksum(fn) for fn in outputs).encode()).hexdigest()
+        rows.append([name, n, '%.3f' % seconds, '%.0f' % (n/seconds), '%.1f' % peak, digest])
+        logging.info('%-14s %10s variants %9.3f s %10.0f variants/s %9.1f MB  %s' % (name, n, seconds, n/seconds, peak, digest))
+
+    with open(output, 'w') as fo:
+        fo.write('scenario\tvariants\tseconds\tvariants_per_sec\tpeak_rss_mb\tchecksum\n')
+        for row in rows:
+            fo.write('\t'.join([str(x) for x in row]) + '\n')
+
+    if compare != None:
+        logging.info('####################')
+        logging.info('Compared with %s' % compare)
+        old = load_results(compare)
+        for row in rows:
+            before = old.get(row[0])
+            if before == None or 'NA' in (row[2], before['seconds']):
+                continue
+            same = 'same output' if before['checksum'] == row[5] else 'OUTPUT DIFFERS'
+            logging.info('%-14s %6.2fx speed %6.2fx peak RSS  %s' % (
+                row[0], float(before['seconds'])/float(row[2]), float(row[4])/float(before['peak_rss_mb']), same))
+
+    logging.info('####################')
+    logging.info('Benchmark done.')
+    logging.info('Results saved to:\n\t%s' % output)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark.py',
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     description='Time tsim.py subcommands on deterministic synthetic cohorts.\nReports variants/sec, peak RSS and output checksums per scenario.')
+    parser.add_argument('-o', '--outdir', required=True,
+                        help='directory for the synthetic cohorts, outputs and results')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma-separated scenarios [default: all]\n%s' % ', '.join(SCENARIOS))
+    parser.add_argument('-k', '--cohorts', default=2, type=int,
+                        help='number of synthetic cohorts [default: 2]')
+    parser.add_argument('-v', '--variants', default=100000, type=int,
+                        help='number of sites per cohort before sampling (each cohort keeps ~90%%) [default: 100000]')
+    parser.add_argument('-n', '--samples', default=500, type=int,
+                        help='number of samples per cohort [default: 500]')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='random seed of the synthetic data [default: 1]')
+    parser.add_argument('-r', '--repeat', default=1, type=int,
+                        help='runs per scenario; the median time is reported [default: 1]')
+    parser.add_argument('--output', default=None,
+                        help='results TSV [default: <outdir>/benchmark.tsv]')
+    parser.add_argument('--compare', default=None,
+                        help='results TSV of an earlier run to compare with (speed, peak RSS, same output)')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        format='%(levelname)s %(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    run(args.outdir, args.scenarios.split(','), args.cohorts, args.variants, args.samples, args.seed,
+        args.repeat, args.output, args.compare)
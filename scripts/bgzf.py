@@ -0,0 +1,121 @@
+import os
+import zlib
+import queue
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# BGZF (blocked gzip, as written by bgzip): gzip members of at most 64 kB, readable by gzip and tabix
+# text written to BgzfWriter is compressed by a thread pool and written in order by a writer thread,
+# so the caller only waits when compression falls behind
+BLOCK_SIZE = 0xff00 # uncompressed bytes per block, as bgzip
+CHUNK_SIZE = 16*BLOCK_SIZE # text handed to one compression job
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def compress_block(data, level=6):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    body = c.compress(data) + c.flush()
+    # gzip header with the BC extra field holding the block size - 1
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(body) + 25)
+    return header + body + struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def compress_chunk(text, transform, level):
+    if transform != None:
+        text = transform(text)
+    data = text.encode()
+    return b''.join([compress_block(data[i:i+BLOCK_SIZE], level) for i in range(0, len(data), BLOCK_SIZE)])
+
+
+class BgzfWriter:
+    # file-like (text); transform: applied to chunks of whole lines before compression, in the pool
+    def __init__(self, fn, threads=None, level=6, transform=None):
+        self.name = fn
+        self.level = level
+        self.transform = transform
+        self.fh = open(fn, 'wb')
+        self.pending = []
+        self.size = 0
+        self.error = None
+        threads = threads or min(4, os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(threads)
+        # bounded: write() blocks once this many chunks wait for compression
+        self.jobs = queue.Queue(2*threads)
+        # daemon: an error exiting without close() or abort() does not leave the interpreter waiting for it
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def write(self, text):
+        self.pending.append(text)
+        self.size = self.size + len(text)
+        if self.size >= CHUNK_SIZE:
+            self.submit(False)
+
+    def submit(self, last):
+        text = ''.join(self.pending)
+        # with a transform, chunks end at a line break
+        cut = len(text) if last or self.transform == None else text.rfind('\n') + 1
+        self.pending = [text[cut:]] if cut < len(text) else []
+        self.size = len(text) - cut
+        if cut > 0:
+            self.jobs.put(self.pool.submit(compress_chunk, text[:cut], self.transform, self.level))
+
+    def write_chunks(self):
+        while True:
+            job = self.jobs.get()
+            if job == None:
+                return
+            try:
+                if self.error == None:
+                    self.fh.write(job.result())
+            except Exception as e:
+                # kept for close(); the remaining jobs are drained so that write() does not block
+                self.error = e
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.submit(True)
+        self.jobs.put(None)
+        self.writer.join()
+        self.pool.shutdown()
+        if self.error == None:
+            self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        if self.error != None:
+            raise self.error
+
+    def abort(self):
+        # after an error: pending chunks are dropped and the file is left incomplete (without the EOF block)
+        if self.fh.closed:
+            return
+        self.error = self.error or RuntimeError('%s aborted' % self.name)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.jobs.put(None)
+        self.writer.join()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type == None:
+            self.close()
+        else:
+            self.abort()
+
+
+def abort(fh):
+    # closes an output after an error, so that no compression threads are left running
+    if hasattr(fh, 'abort'):
+        fh.abort()
+    else:
+        fh.close()
+
+
+def open_text(fn, threads=None):
+    # plain text, or BGZF for names ending with .gz
+    if fn.endswith('.gz'):
+        return BgzfWriter(fn, threads)
+    return open(fn, 'w')
@@ -0,0 +1,98 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+
+# files up to this size are identified by their content, larger ones (VCFs) by size and modification time
+DIGEST_SIZE = 64*1024*1024
+
+
+def file_fingerprint(fn):
+    if fn == None or fn == '':
+        return None
+    stat = os.stat(fn)
+    if stat.st_size <= DIGEST_SIZE:
+        digest = hashlib.sha1()
+        with open(fn, 'rb') as f1:
+            for chunk in iter(lambda: f1.read(1 << 20), b''):
+                digest.update(chunk)
+        return ['sha1', digest.hexdigest()]
+    return [os.path.abspath(fn), stat.st_size, stat.st_mtime_ns]
+
+
+class ResultCache:
+    # content-addressed cache of output files: one directory per key (a hash of the step, its input files and
+    # parameters) holding copies of the outputs and a small JSON of results
+    # least recently used entries are removed once the cache is larger than max_size bytes
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, step, files, params):
+        text = json.dumps([step, [file_fingerprint(fn) for fn in files], params], sort_keys=True)
+        return '%s-%s' % (step, hashlib.sha1(text.encode()).hexdigest())
+
+    def fetch(self, key, outputs, prefix=''):
+        # copies the cached outputs to outputs and returns the cached results, None on a miss
+        entry = os.path.join(self.cache_dir, key)
+        with self.lock:
+            if not os.path.exists(os.path.join(entry, 'results.json')):
+                return None
+            # the entry is now the most recently used
+            os.utime(entry)
+        with open(os.path.join(entry, 'results.json')) as f1:
+            results = json.load(f1)
+        if len(results['outputs']) != len(outputs):
+            return None
+        try:
+            for (k, fn) in enumerate(outputs):
+                shutil.copyfile(os.path.join(entry, str(k)), fn)
+        except FileNotFoundError:
+            # evicted meanwhile
+            return None
+        logging.info('%sCache hit (%s):\n\t%s' % (prefix, key, '\n\t'.join(outputs)))
+        return results['results']
+
+    def store(self, key, outputs, results=None, prefix=''):
+        # copies are stored, so that rewriting an output later does not change the cache
+        entry = os.path.join(self.cache_dir, key)
+        temp = '%s.tmp%s.%s' % (entry, os.getpid(), threading.get_ident())
+        os.makedirs(temp, exist_ok=True)
+        for (k, fn) in enumerate(outputs):
+            shutil.copyfile(fn, os.path.join(temp, str(k)))
+        with open(os.path.join(temp, 'results.json'), 'w') as fo:
+            json.dump({'outputs': outputs, 'results': {} if results == None else results}, fo)
+        with self.lock:
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(temp, entry)
+            logging.info('%sSaved to cache (%s)' % (prefix, key))
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if '.tmp' in name or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total = total + size
+        for (mtime, size, entry) in sorted(entries):
+            if total <= self.max_size:
+                break
+            logging.info('Cache larger than %s bytes: removing %s' % (self.max_size, os.path.basename(entry)))
+            shutil.rmtree(entry)
+            total = total - size
+
+
+def open_cache(cache_dir, cache_size):
+    # cache_size in GB; None without a cache directory
+    if cache_dir == None:
+        return None
+    return ResultCache(cache_dir, int(cache_size*1024**3))
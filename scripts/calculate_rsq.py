@@ -1,23 +1,481 @@
 from datetime import datetime
+import os
 import sys
+import queue
+import shutil
 import logging
+import threading
 
-def calculate_rsq(d, p_hat, rsq_topmed, term1):    
-    term2 = ((d-p_hat)**2).sum()
-    term3 = p_hat*(1-p_hat)
+import metrics
+from vcf_index import split_regions, vcf_metadata, n_records
+from rsq_table import open_output, index_table
+from bgzf import abort
+from dosage_matrix import is_dosage_matrix, DosageMatrix
+
+def calculate_rsq(hds, t1):
+    # hds: (variants, 2*samples) haploid dosages of one block
+    # dtypes follow NumPy scalar promotion so values (and str()) match the per-variant calculation
+    import numpy as np
+
+    af_dtype = (np.float32(1)/2).dtype
+    num_dtype = (t1*np.float32(1)).dtype
+
+    af = hds.sum(axis=1).astype(af_dtype)/hds.shape[1]
+    poly = (af > 0) & (af < 1) # monomorphic sites not included
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        term2 = ((hds-af.astype(np.float32)[:, None])**2).sum(axis=1)
+        term3 = af*(1-af)
+        rsq = (t1*term2.astype(num_dtype))/term3
+
+    return (af, rsq, poly)
+
+
+def read_blocks(vcf, n_samples, block_size, genotypes=False):
+    # yields (ids, hds, afs, rsqs, er2s, gts) for each block of variants
+    # without samples only the site-level INFO fields are read (AF instead of HDS)
+    # gts (cyvcf2 gt_types) only if genotypes are requested
+    import numpy as np
+
+    hds = np.empty((block_size, 2*n_samples), dtype=np.float32) if n_samples > 0 else None
+    gts = np.empty((block_size, n_samples), dtype=np.int8) if genotypes else None
+    ids = []
+    afs = []
+    rsqs = []
+    er2s = []
+    for variant in vcf:
+        if hds is not None:
+            # estimated haploid alternate allele dosage
+            d = variant.format('HDS')
+            assert d.shape == (n_samples, 2)
+            hds[len(ids)] = d.reshape(-1)
+        else:
+            af = variant.INFO.get('AF')
+            if af == None:
+                logging.error('%s has no INFO/AF. Run without --info-only.' % variant.ID)
+                sys.exit(1)
+            afs.append(af)
+        if gts is not None:
+            gts[len(ids)] = variant.gt_types
+
+        ids.append(variant.ID)
+        rsqs.append(variant.INFO.get('R2'))
+        er2 = variant.INFO.get('ER2')
+        er2s.append('-' if er2 == None else er2)
+
+        if len(ids) == block_size:
+            yield (ids, hds, None if hds is not None else afs, rsqs, er2s, gts)
+            # new arrays: blocks may still be in use (see read_ahead)
+            hds = np.empty((block_size, 2*n_samples), dtype=np.float32) if n_samples > 0 else None
+            gts = np.empty((block_size, n_samples), dtype=np.int8) if genotypes else None
+            ids = []
+            afs = []
+            rsqs = []
+            er2s = []
+    if len(ids) > 0:
+        n = len(ids)
+        yield (ids, hds[:n] if hds is not None else None, None if hds is not None else afs, rsqs, er2s,
+               gts[:n] if gts is not None else None)
+
+
+def read_ahead(blocks, depth=4):
+    # reads blocks in a background thread, up to depth blocks ahead of the caller
+    # (htslib decompression and numpy release the GIL, so reading overlaps with the rsq calculation)
+    done = object()
+    q = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        # gives up once the caller has stopped reading
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for block in blocks:
+                if not put(block):
+                    return
+            put(done)
+        except BaseException as e:
+            # e.g. sys.exit() after a logged error, raised again in the caller
+            put(e)
+
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            block = q.get()
+            if block is done:
+                break
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        reader.join()
+
+
+def is_info_file(fn):
+    return fn.endswith('.info') or fn.endswith('.info.gz')
+
+
+def read_info_blocks(info_fn, block_size):
+    # Minimac4 info file: SNP, REF(0), ALT(1), ALT_Frq, MAF, AvgCall, Rsq, Genotyped, LooRsq, EmpR, EmpRsq, ...
+    import gzip
+
+    with gzip.open(info_fn, 'rt') if info_fn.endswith('.gz') else open(info_fn) as f1:
+        header = f1.readline().strip().split('\t')
+        try:
+            (var_col, af_col, rsq_col, er2_col) = [header.index(x) for x in ('SNP', 'ALT_Frq', 'Rsq', 'EmpRsq')]
+        except ValueError:
+            logging.error('%s does not look like a Minimac4 info file (SNP, ALT_Frq, Rsq and EmpRsq columns needed).' % info_fn)
+            sys.exit(1)
+        
+        ids = []
+        afs = []
+        rsqs = []
+        er2s = []
+        for line in f1:
+            ln = line.rstrip('\n').split('\t')
+            ids.append(ln[var_col])
+            afs.append(float(ln[af_col]))
+            rsqs.append(float(ln[rsq_col]))
+            er2s.append('-' if ln[er2_col] in ('-', '.') else float(ln[er2_col]))
+            if len(ids) == block_size:
+                yield (ids, None, afs, rsqs, er2s, None)
+                ids = []
+                afs = []
+                rsqs = []
+                er2s = []
+        if len(ids) > 0:
+            yield (ids, None, afs, rsqs, er2s, None)
+
+
+def site_stats(afs, rsq_topmed):
+    # no dosages: the imputation server's AF and R2 are used as AAF and RSQ
+    import numpy as np
+
+    af = np.array(afs, dtype=np.float64)
+    rsq = np.array([np.nan if r == None else r for r in rsq_topmed], dtype=np.float64)
+    poly = (af > 0) & (af < 1) # monomorphic sites not included
+    return (af, rsq, poly)
+
+
+def format_block(ids, af, rsq, poly, rsq_topmed, er2, extra=()):
+    # extra: further columns (e.g. HWE p-values) appended to every row
+    if len(extra) > 0:
+        rows = format_block(ids, af, rsq, poly, rsq_topmed, er2).split('\n')[:-1]
+        cols = [[str(x) for x in col] for col in extra]
+        return ''.join([row + ''.join(['\t%s' % col[i] for col in cols]) + '\n' for (i, row) in enumerate(rows)])
+    lines = []
+    for (var_id, p, r, keep, r_topmed, e) in zip(ids, af, rsq, poly, rsq_topmed, er2):
+        if keep:
+            lines.append('%s\t%s\t%s\t%s\t%s\n' % (var_id, p, r, r_topmed, e))
+        else:
+            # (p_hat, rsq, rsq_topmed, er2)
+            lines.append('%s\t0\t-\t%s\t%s\n' % (var_id, r_topmed, e))
+    return ''.join(lines)
+
+
+def format_wide_block(ids, stats, rsq_topmed, er2):
+    lines = []
+    for (i, var_id) in enumerate(ids):
+        line = '%s\t%s\t%s' % (var_id, rsq_topmed[i], er2[i])
+        for (af, rsq, poly) in stats:
+            if poly[i]:
+                line = line + '\t%s\t%s' % (af[i], rsq[i])
+            else:
+                line = line + '\t0\t-'
+        lines.append(line + '\n')
+    return ''.join(lines)
+
+
+def subset_columns(hds, cols):
+    if cols is None:
+        return hds
+    n = hds.shape[0]
+    return hds.reshape(n, -1, 2)[:, cols, :].reshape(n, -1)
+
+
+def write_rsq(blocks, fos, subsets, n_samples, wide=False, qc=None, hwe=None, step=500000, total=None):
+    # blocks: from read_blocks or read_info_blocks
+    # subsets: sample columns for each subset (None = all samples)
+    # fos: one output per subset, or a single output holding the wide table
+    # qc: (rfilter, efilter, mfilter, hdic, hfilter) to also write variants passing QC to the last output
+    # hwe: (control columns or None, midp) to add HWE p-values for all samples (and controls)
+    if hwe != None:
+        from hwe import hwe_exact, genotype_counts
+    if qc != None:
+        from variant_qc import qc_block
+        qfo = fos[-1]
+        fos = fos[:-1]
+        qc_counts = [0, 0, 0, 0, 0] # (r2_drop, er2_drop, maf_drop, hq_keep, hwe_drop)
+    else:
+        qc_counts = None
+
+    t1 = [1/(2*(n_samples if cols is None else len(cols))) if n_samples > 0 else None for cols in subsets]
+    counts = [[0, 0] for cols in subsets] # (non-monomorphic, monomorphic)
+    n_variants = 0
+    count = 0
+    
+    # with --metrics: time spent reading/decoding the VCF vs. the rsq math vs. formatting and writing
+    for (ids, hds, afs, rsq_topmed, er2, gts) in metrics.timed(blocks, 'rsq.decode'):
+        n_variants = n_variants + len(ids)
+
+        extra = []
+        if hwe != None:
+            (controls, midp) = hwe
+            with metrics.timer('rsq.hwe'):
+                extra.append(hwe_exact(*genotype_counts(gts), midp=midp))
+                if controls != None:
+                    extra.append(hwe_exact(*genotype_counts(gts[:, controls]), midp=midp))
+
+        # calculate alternative allele frequency and rsq
+        stats = []
+        with metrics.timer('rsq.math'):
+            for (k, cols) in enumerate(subsets):
+                if hds is None:
+                    (af, rsq, poly) = site_stats(afs, rsq_topmed)
+                else:
+                    (af, rsq, poly) = calculate_rsq(subset_columns(hds, cols), t1[k])
+                n_poly = int(poly.sum())
+                counts[k][0] = counts[k][0] + n_poly
+                counts[k][1] = counts[k][1] + len(ids) - n_poly
+                stats.append((af, rsq, poly))
+
+        with metrics.timer('rsq.format'):
+            if wide:
+                fos[0].write(format_wide_block(ids, stats, rsq_topmed, er2))
+            else:
+                for (fo, (af, rsq, poly)) in zip(fos, stats):
+                    fo.write(format_block(ids, af, rsq, poly, rsq_topmed, er2, extra))
+
+        if qc != None:
+            (af, rsq, poly) = stats[0]
+            # HWE of the controls if given, otherwise of all samples (as with --nocases)
+            with metrics.timer('rsq.qc'):
+                (keep, drops) = qc_block(ids, af, rsq, poly, er2, *qc, hwe_p=extra[-1] if hwe != None else None)
+                qfo.write(''.join(['%s\n' % var for var in keep]))
+            for k in range(3):
+                qc_counts[k] = qc_counts[k] + drops[k]
+            qc_counts[3] = qc_counts[3] + len(keep)
+            qc_counts[4] = qc_counts[4] + drops[3]
+
+        while n_variants >= step*(count+1):
+            count = count + 1
+            
+            if total == None:
+                logging.debug('%s variants processed...' % (step*count))
+            else:
+                logging.debug('%s/%s variants processed...' % (step*count, total))
+
+    return (counts, n_variants, qc_counts)
+
+
+def region_variants(vcf, chrom, start, end):
+    if end == None:
+        region = '%s:%s-' % (chrom, start)
+    else:
+        region = '%s:%s-%s' % (chrom, start, end)
+    for variant in vcf(region):
+        # records reaching into the region belong to the region they start in
+        if variant.POS >= start:
+            yield variant
+
+
+def rsq_region(job):
+    (vcf_fn, samples, region, part_fns, subsets, wide, qc, hwe, block_size, python_lib, decompress_threads) = job
+    if python_lib != '' and python_lib not in sys.path:
+        sys.path.append(python_lib)
+
+    import cyvcf2
+
+    if is_dosage_matrix(vcf_fn):
+        vcf = DosageMatrix(vcf_fn, samples)
+        blocks = vcf.blocks(block_size, hwe != None, *region[1:])
+    else:
+        vcf = cyvcf2.VCF(fname=vcf_fn, samples=samples)
+        blocks = vcf_blocks(vcf, region_variants(vcf, *region), block_size, hwe != None, decompress_threads)
+    fos = [open(part_fn, 'w') for part_fn in part_fns]
+    counts = write_rsq(blocks, fos, subsets, len(vcf.samples), wide, qc, hwe)
+    for fo in fos:
+        fo.close()
+    vcf.close()
+    return counts
+
+
+def open_vcf(vcf_fn, sam_fn, info_only=False):
+    import cyvcf2
+
+    if is_info_file(vcf_fn):
+        logging.info('Reading AF, R2 and ER2 from Minimac4 info file.')
+        return (None, [])
+    if is_dosage_matrix(vcf_fn):
+        return open_matrix(vcf_fn, sam_fn, info_only)
+    if info_only:
+        logging.info('Reading AF, R2 and ER2 from INFO only (no samples loaded).')
+        vcf = cyvcf2.VCF(fname=vcf_fn, samples=[])
+        return (vcf, [])
+    if sam_fn != None:
+        fo = open(sam_fn, 'r')
+        samples = fo.read().split('\n')[:-1]
+        fo.close()        
+        in_vcf = set(vcf_metadata(vcf_fn)['samples'])
+        found = [y for y in samples if y in in_vcf]
+        vcf = cyvcf2.VCF(fname=vcf_fn, samples=found)
+        if len(found) != len(samples):
+            logging.warning('%s samples in %s are not in the VCF.' % (len(samples)-len(found), sam_fn))
+            samples = vcf.samples
+    else:
+        logging.info('Using all samples in VCF.')
+        vcf = cyvcf2.VCF(fname=vcf_fn)
+        samples = vcf.samples
+    return (vcf, samples)
+
+
+def open_matrix(vcf_fn, sam_fn, info_only=False):
+    if info_only:
+        logging.error('A dosage matrix has no INFO/AF: run without --info-only.')
+        sys.exit(1)
+    if sam_fn != None:
+        fo = open(sam_fn, 'r')
+        samples = fo.read().split('\n')[:-1]
+        fo.close()
+        matrix = DosageMatrix(vcf_fn, samples)
+        if len(matrix.samples) != len(samples):
+            logging.warning('%s samples in %s are not in the dosage matrix.' % (len(samples)-len(matrix.samples), sam_fn))
+    else:
+        logging.info('Using all samples in the dosage matrix.')
+        matrix = DosageMatrix(vcf_fn)
+    matrix.check_source()
+    return (matrix, matrix.samples)
+
+
+def vcf_blocks(vcf, variants, block_size, genotypes=False, decompress_threads=0):
+    # decompress_threads: htslib threads decompressing the VCF, and a read-ahead thread decoding the blocks
+    if decompress_threads <= 0:
+        return read_blocks(variants, len(vcf.samples), block_size, genotypes)
+    vcf.set_threads(decompress_threads)
+    return read_ahead(read_blocks(variants, len(vcf.samples), block_size, genotypes))
+
+
+def compute_rsq(vcf, vcf_fn, samples, fos, subsets, block_size, jobs, tempdir, python_lib, wide=False, qc=None, hwe=None,
+                decompress_threads=0):
+    # samples: samples to load in each region (None = all samples, [] = site-level fields only)
+    # vcf: None when reading a Minimac4 info file, a DosageMatrix when reading a dosage matrix
+    import multiprocessing
+
+    if vcf == None:
+        if jobs > 1:
+            logging.warning('Info files have no index, ignoring --jobs.')
+        return write_rsq(read_info_blocks(vcf_fn, block_size), fos, subsets, 0, wide, qc)
+    matrix = isinstance(vcf, DosageMatrix)
+    # number of records from the tabix index, for progress messages
+    total = vcf.n_variants if matrix else n_records(vcf_metadata(vcf_fn))
+    if jobs <= 1:
+        if matrix:
+            blocks = vcf.blocks(block_size, hwe != None)
+        else:
+            blocks = vcf_blocks(vcf, vcf, block_size, hwe != None, decompress_threads)
+        counts = write_rsq(blocks, fos, subsets, len(vcf.samples), wide, qc, hwe, total=total)
+        vcf.close()
+        return counts
+    
+    # more regions than jobs so that dense regions do not hold up the pool
+    if matrix:
+        regions = vcf.split(4*jobs)
+    else:
+        regions = split_regions(vcf_fn, 4*jobs, vcf_metadata(vcf_fn)['contigs'])
+    vcf.close()
+    if tempdir == None:
+        tempdir = os.getcwd()
+    logging.info('Splitting VCF into %s regions over %s jobs' % (len(regions), jobs))
     
-    rsq = (term1*term2)/term3
+    work = []
+    for (idx, region) in enumerate(regions):
+        part_fns = ['%s/%s.%s.part' % (tempdir, os.path.basename(fo.name), idx) for fo in fos]
+        work.append((vcf_fn, samples, region, part_fns, subsets, wide, qc, hwe, block_size, python_lib, decompress_threads))
     
-    return (p_hat, rsq, rsq_topmed)
+    counts = [[0, 0] for cols in subsets]
+    qc_counts = [0, 0, 0, 0, 0] if qc != None else None
+    n_variants = 0
+    # terminated if a job fails, so that no worker processes are left behind
+    with multiprocessing.Pool(jobs) as pool:
+        # parts come back in region order, so they can be appended as soon as they are done
+        for (job, (part_counts, part_variants, part_qc)) in zip(work, pool.imap(rsq_region, work)):
+            for k in range(len(subsets)):
+                counts[k][0] = counts[k][0] + part_counts[k][0]
+                counts[k][1] = counts[k][1] + part_counts[k][1]
+            if qc != None:
+                for k in range(len(qc_counts)):
+                    qc_counts[k] = qc_counts[k] + part_qc[k]
+            n_variants = n_variants + part_variants
+            logging.debug('%s:%s-%s done (%s variants, %s/%s)' % (job[2][0], job[2][1], job[2][2] or '', part_variants,
+                                                                 n_variants, total or '?'))
+            for (fo, part_fn) in zip(fos, job[3]):
+                with open(part_fn) as part:
+                    shutil.copyfileobj(part, fo)
+                os.remove(part_fn)
+        pool.close()
+        pool.join()
+    return (counts, n_variants, qc_counts)
+
+
+def hwe_controls(samples, controls_fn):
+    # columns of the control samples, for HWE in controls only (PLINK UNAFF)
+    # samples: in the order of the genotypes (vcf.samples, not the -s file)
+    fo = open(controls_fn, 'r')
+    controls = set(fo.read().split('\n')[:-1])
+    fo.close()
+    cols = [i for (i, y) in enumerate(samples) if y in controls]
+    if len(cols) < len(controls):
+        logging.warning('%s controls in %s are not among the samples used.' % (len(controls)-len(cols), controls_fn))
+    logging.info('Number of controls for HWE: %s' % len(cols))
+    return cols
+
+
+def load_subsets(subsets_fn):
+    # one subset per line: name,sample file
+    subsets = []
+    f1 = open(subsets_fn, 'r')
+    for line in f1.readlines():
+        if line.strip() == '':
+            continue
+        (name, sam_fn) = line.strip().split(',')[:2]
+        fo = open(sam_fn, 'r')
+        samples = fo.read().split('\n')[:-1]
+        fo.close()
+        subsets.append((name, samples))
+    f1.close()
+    return subsets
+
+
+def hwe_header(hwe):
+    if hwe == None:
+        return ''
+    return '\tHWE_ALL' if hwe[0] == None else '\tHWE_ALL\tHWE_UNAFF'
 
 
-def run(vcf_fn, out_fn, sam_fn, python_lib):
-    if (python_lib != ''):
+def subset_output(out_fn, name):
+    (root, ext) = os.path.splitext(out_fn)
+    return '%s.%s%s' % (root, name, ext)
+
+
+def run(vcf_fn, out_fn, sam_fn, python_lib, block_size=1000, jobs=1, tempdir=None,
+        subsets_fn=None, wide=False, binary=False, info_only=False,
+        calc_hwe=False, controls_fn=None, midp=False, cache=None, decompress_threads=0):
+    if python_lib != '' and python_lib not in sys.path:
         sys.path.append(python_lib)
    
     import cyvcf2
     
     start = datetime.now()
+    calc_hwe = calc_hwe or controls_fn != None
 
     logging.info('###########################')
     logging.info('##### Calculating Rsq #####')
@@ -26,80 +484,127 @@ def run(vcf_fn, out_fn, sam_fn, python_lib):
     logging.info('VCF\t%s' % vcf_fn)
     logging.info('Output\t%s' % out_fn)
     logging.info('Samples\t%s' % sam_fn)
+    logging.info('Sample subsets\t%s' % subsets_fn)
+    logging.info('Block size\t%s' % block_size)
+    logging.info('Jobs\t%s' % jobs)
+    logging.info('Decompression threads\t%s' % decompress_threads)
+    logging.info('Binary output\t%s' % binary)
+    logging.info('INFO only\t%s' % info_only)
+    logging.info('HWE\t%s' % calc_hwe)
+    logging.info('Cache\t%s' % (None if cache == None else cache.cache_dir))
+    if calc_hwe:
+        logging.info('HWE controls\t%s' % controls_fn)
+        logging.info('HWE mid-p\t%s' % midp)
+    
+    if sam_fn != None and subsets_fn != None:
+        logging.error('Use either a sample file (-s) or a list of sample subsets (--subsets), not both.')
+        sys.exit(1)
+    if (info_only or is_info_file(vcf_fn)) and (sam_fn != None or subsets_fn != None):
+        logging.error('Site-level values (--info-only or an info file) cannot be used with a sample subset.')
+        sys.exit(1)
+    if calc_hwe and (info_only or is_info_file(vcf_fn) or subsets_fn != None):
+        logging.error('HWE needs genotypes of one set of samples (not available with --info-only, an info file or --subsets).')
+        sys.exit(1)
     
     logging.info('####################')
     logging.info('Getting list of samples for calculation...')
-    if sam_fn != None:
-        fo = open(sam_fn, 'r')
-        samples = fo.read().split('\n')[:-1]
-        fo.close()        
-        vcf = cyvcf2.VCF(fname=vcf_fn, samples=samples)
-    else:
-        logging.info('Using all samples in VCF.')
-        vcf = cyvcf2.VCF(fname=vcf_fn)
+    if subsets_fn != None:
+        named = load_subsets(subsets_fn)
+        union = set()
+        for (name, samples) in named:
+            union.update(samples)
+        if is_dosage_matrix(vcf_fn):
+            vcf = DosageMatrix(vcf_fn, union)
+            vcf.check_source()
+        else:
+            vcf = cyvcf2.VCF(fname=vcf_fn, samples=sorted(union))
         samples = vcf.samples
+        col = dict((y, i) for (i, y) in enumerate(samples))
+        
+        names = []
+        subsets = []
+        for (name, subset) in named:
+            missing = set(subset) - set(col)
+            if len(missing) > 0:
+                logging.error(missing)
+                logging.error('These samples of subset %s are not in the VCF.' % name)
+                sys.exit(1)
+            # keep VCF order, as when the subset is given with -s
+            subset = set(subset)
+            subsets.append([col[y] for y in samples if y in subset])
+            names.append(name)
+            logging.info('Subset %s: %s samples' % (name, len(subsets[-1])))
         
-    n_samples = len(samples)
-    logging.info('Number of samples: %s' % n_samples)
-    logging.debug("Samples' head: %s" % samples[:5])
+        if wide:
+            out_fns = [out_fn]
+        else:
+            out_fns = [subset_output(out_fn, name) for name in names]
+    else:
+        (vcf, samples) = open_vcf(vcf_fn, sam_fn, info_only)
+        names = [None]
+        subsets = [None]
+        wide = False
+        out_fns = [out_fn]
+        
+    if vcf != None and len(vcf.samples) > 0:
+        n_samples = len(samples)
+        logging.info('Number of samples: %s' % n_samples)
+        logging.debug("Samples' head: %s" % samples[:5])
     
     
-    logging.info('####################')
-    logging.info('Calculating rsq...')
-    t1 = 1/(2*n_samples) 
-    fo = open(out_fn, 'w')
-    fo.write('ID\tAAF\tRSQ\tRSQ_TOPMED\tER2\n')
+    hwe = None
+    if calc_hwe:
+        hwe = (hwe_controls(vcf.samples, controls_fn) if controls_fn != None else None, midp)
     
-    passed = 0
-    failed = 0
-    n_variants = 0
-    count = 0
-    step = 500000
-    
-    for variant in vcf:
-        n_variants = n_variants + 1
-        var_id = variant.ID  
-        
-        # estimated haploid alternate allele dosage
-        d = variant.format('HDS')
-        assert d.shape == (n_samples, 2)
-
-        # calculate alternative allele frequency
-        af = d.sum()/(2*n_samples) 
-        maf = af > 0 and af < 1 # monomorphic sites not included
-
-        rsq = variant.INFO.get('R2')
-        er2 = variant.INFO.get('ER2')
-        if er2 == None:
-            er2 = '-'
-
-        # calculate rsq
-        if maf:
-            passed = passed + 1
-            rsq_calc = calculate_rsq(d, af, rsq, t1)
-            fo.write('%s\t' % var_id)
-            fo.write('\t'.join(list(map(str, rsq_calc))) + '\t%s\n' % er2)
-        else:
-            # (p_hat, rsq, rsq_topmed, er2)
-            rsq_calc = (0, '-', rsq)
-            failed = failed+1
-            fo.write('%s\t' % var_id)
-            fo.write('\t'.join(list(map(str, rsq_calc))) + '\t%s\n' % er2)
-
-        if n_variants % step == 0:
-            count = count + 1
-            
-            logging.debug('%s variants processed...' % (step*count))
+    cached = None
+    if cache != None:
+        # the samples (not the sample files) and all options changing the output are part of the key
+        key = cache.key('rsq', [vcf_fn, controls_fn],
+                        [samples, names, subsets, wide, binary, info_only, calc_hwe, midp])
+        cached = cache.fetch(key, out_fns)
     
-    vcf.close()
-    fo.close()
+    if cached != None:
+        (counts, n_variants) = cached
+        for fn in out_fns:
+            if fn.endswith('.gz') and not binary:
+                index_table(fn)
+    else:
+        logging.info('####################')
+        logging.info('Calculating rsq...')
+        fos = []
+        region_samples = None if sam_fn == None and subsets_fn == None and not info_only else samples
+        try:
+            for fn in out_fns:
+                fos.append(open_output(fn, binary))
+            if wide:
+                fos[0].write('ID\tRSQ_TOPMED\tER2' + ''.join(['\tAAF_%s\tRSQ_%s' % (name, name) for name in names]) + '\n')
+            else:
+                for fo in fos:
+                    fo.write('ID\tAAF\tRSQ\tRSQ_TOPMED\tER2%s\n' % hwe_header(hwe))
+            with metrics.stage('rsq') as m:
+                (counts, n_variants, qc_counts) = compute_rsq(vcf, vcf_fn, region_samples, fos, subsets,
+                                                              block_size, jobs, tempdir, python_lib, wide, hwe=hwe,
+                                                              decompress_threads=decompress_threads)
+                m['records'] = n_variants
+        except BaseException:
+            # also on sys.exit(): bgzipped outputs are stopped so their threads do not keep the process alive
+            for fo in fos:
+                abort(fo)
+            raise
+        for fo in fos:
+            fo.close()
+        if cache != None:
+            cache.store(key, out_fns, [counts, n_variants])
     logging.info('%s variants processed...' % n_variants)
 
-    logging.info('Number of variants non-monomorphic: %s' % passed)
-    logging.info('Number of variants monomorphic (rsq could not be calculated): %s' % failed)
+    for (name, (passed, failed)) in zip(names, counts):
+        if name != None:
+            logging.info('### Subset %s' % name)
+        logging.info('Number of variants non-monomorphic: %s' % passed)
+        logging.info('Number of variants monomorphic (rsq could not be calculated): %s' % failed)
     
     logging.info('####################')
     logging.info('Rsq calculations done.')
-    logging.info('Rsq calculations saved to:\n\t%s' % out_fn)
+    logging.info('Rsq calculations saved to:\n\t%s' % '\n\t'.join(out_fns))
     logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
-                         
\ No newline at end of file
+    return (out_fns, counts, n_variants)
@@ -4,10 +4,10 @@ import logging
 
 
 def check_samples(filelists, python_lib):
-    if (python_lib != ''):
+    if python_lib != '' and python_lib not in sys.path:
         sys.path.append(python_lib)
         
-    import cyvcf2
+    from vcf_index import vcf_metadata
     
     logging.info('####################')
     logging.info('Checking if all samples are in VCFs...')
@@ -19,9 +19,7 @@ def check_samples(filelists, python_lib):
         vcf_fn = filelists[idx][0]
         sample_fn = filelists[idx][2]
         
-        vcf = cyvcf2.VCF(fname=vcf_fn).samples
-        for y in vcf:
-            samples_vcf.add(y)
+        samples_vcf.update(vcf_metadata(vcf_fn)['samples'])
             
         f1 = open(sample_fn, 'r')
         txt = [line.strip() for line in f1.readlines()]
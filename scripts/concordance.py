@@ -0,0 +1,226 @@
+from datetime import datetime
+import os
+import sys
+import logging
+
+import metrics
+from merge import normal_chrom
+from vcf_index import vcf_metadata
+
+# stage 1 vs. stage 2 dosages of the same samples: both VCFs are read once, side by side,
+# and variants are joined by chromosome, position, REF and ALT
+
+
+def site_groups(vcf, vcf_fn, ranks, perm=None):
+    # (site, chrom, [(ref, alt, ID, dosages)]) for each position, site = (chromosome rank, position)
+    # ranks: chromosome order, shared by both VCFs; perm: sample order of the other VCF
+    last = None
+    chrom = None
+    group = []
+    for variant in vcf:
+        site = (ranks.setdefault(normal_chrom(variant.CHROM), len(ranks)), variant.POS)
+        if site != last:
+            if last != None and site < last:
+                logging.error('%s is not sorted by position (%s:%s after %s:%s).' % (vcf_fn, variant.CHROM, variant.POS,
+                                                                                     chrom, last[1]))
+                sys.exit(1)
+            if len(group) > 0:
+                yield (last, chrom, group)
+            (last, chrom, group) = (site, variant.CHROM, [])
+        # dosage = sum of the haploid dosages
+        ds = variant.format('HDS').sum(axis=1)
+        group.append((variant.REF, ','.join(variant.ALT), variant.ID, ds if perm is None else ds[perm]))
+    if len(group) > 0:
+        yield (last, chrom, group)
+
+
+def concordance_block(d1, d2):
+    # d1, d2: (variants, samples) dosages; returns (aaf1, aaf2, r2, mad), r2 is NaN for monomorphic variants
+    import numpy as np
+
+    d1 = d1.astype(np.float64)
+    d2 = d2.astype(np.float64)
+    m1 = d1.mean(axis=1)
+    m2 = d2.mean(axis=1)
+    c1 = d1 - m1[:, None]
+    c2 = d2 - m2[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = (c1*c2).sum(axis=1)**2/((c1**2).sum(axis=1)*(c2**2).sum(axis=1))
+    mad = np.abs(d1 - d2).mean(axis=1)
+    return (m1/2, m2/2, r2, mad)
+
+
+def write_block(fo, rows, d1, d2, summary, rank):
+    # rows: (ID, chrom, pos) of a block of matched variants on one chromosome, with their dosages in d1 and d2
+    n = len(rows)
+    (aaf1, aaf2, r2, mad) = concordance_block(d1[:n], d2[:n])
+    values = zip(aaf1.tolist(), aaf2.tolist(), r2.tolist(), mad.tolist())
+    fo.write(''.join(['%s\t%s\t%s\t%s\n' % (var, chrom, pos, '\t'.join([format_value(x) for x in v]))
+                      for ((var, chrom, pos), v) in zip(rows, values)]))
+    summary.add_stats(rank, r2, mad)
+
+
+def format_value(x):
+    return '-' if x != x else '%.6g' % x
+
+
+class Summary:
+    # per chromosome: variant counts, r2 of the matched variants and the sum of their mean absolute differences
+    def __init__(self):
+        self.names = {}
+        self.counts = {}
+        self.r2 = {}
+        self.mad = {}
+
+    def add(self, rank, chrom, k, n=1):
+        # k: 0 = stage 1, 1 = stage 2, 2 = matched
+        self.names.setdefault(rank, chrom)
+        counts = self.counts.setdefault(rank, [0, 0, 0])
+        counts[k] = counts[k] + n
+
+    def add_stats(self, rank, r2, mad):
+        self.r2.setdefault(rank, []).append(r2)
+        self.mad[rank] = self.mad.get(rank, 0.0) + float(mad.sum())
+
+    def write(self, fo, threshold=0.8):
+        import numpy as np
+
+        fo.write('CHROM\tN_FIRST\tN_SECOND\tN_MATCHED\tN_R2\tMEAN_R2\tMEDIAN_R2\tFRAC_R2_%s\tMEAN_ABS_DIFF\n' % threshold)
+        for rank in sorted(self.counts):
+            (first, second, matched) = self.counts[rank]
+            r2 = np.concatenate(self.r2[rank]) if rank in self.r2 else np.zeros(0)
+            r2 = r2[~np.isnan(r2)]
+            stats = [np.nan, np.nan, np.nan] if len(r2) == 0 else [r2.mean(), np.median(r2), (r2 >= threshold).mean()]
+            mad = self.mad[rank]/matched if matched > 0 else np.nan
+            fo.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (self.names[rank], first, second, matched, len(r2),
+                                                   '\t'.join([format_value(x) for x in stats + [mad]])))
+
+
+def common_samples(fn1, fn2, sam_fn):
+    samples2 = set(vcf_metadata(fn2)['samples'])
+    common = [y for y in vcf_metadata(fn1)['samples'] if y in samples2]
+    if sam_fn != None:
+        fo = open(sam_fn, 'r')
+        wanted = set(fo.read().split('\n')[:-1])
+        fo.close()
+        missing = len(wanted - set(common))
+        if missing > 0:
+            logging.warning('%s samples in %s are not in both VCFs.' % (missing, sam_fn))
+        common = [y for y in common if y in wanted]
+    return common
+
+
+def summary_output(out_fn):
+    (root, ext) = os.path.splitext(out_fn)
+    return '%s.summary%s' % (root, ext)
+
+
+def run(first_fn, second_fn, out_fn, sam_fn=None, summary_fn=None, block_size=1000, python_lib=''):
+    if python_lib != '' and python_lib not in sys.path:
+        sys.path.append(python_lib)
+
+    import numpy as np
+    import cyvcf2
+
+    start = datetime.now()
+    if summary_fn == None:
+        summary_fn = summary_output(out_fn)
+
+    logging.info('###########################')
+    logging.info('#### Dosage concordance ###')
+    logging.info('###########################')
+    logging.info('### Arguments')
+    logging.info('Stage 1 VCF\t%s' % first_fn)
+    logging.info('Stage 2 VCF\t%s' % second_fn)
+    logging.info('Samples\t%s' % sam_fn)
+    logging.info('Output\t%s' % out_fn)
+    logging.info('Summary\t%s' % summary_fn)
+    logging.info('Block size\t%s' % block_size)
+
+    logging.info('####################')
+    logging.info('Getting list of samples in both VCFs...')
+    samples = common_samples(first_fn, second_fn, sam_fn)
+    if len(samples) == 0:
+        logging.error('No samples in common between the two VCFs.')
+        sys.exit(1)
+    logging.info('Number of samples: %s' % len(samples))
+    vcf1 = cyvcf2.VCF(fname=first_fn, samples=samples)
+    vcf2 = cyvcf2.VCF(fname=second_fn, samples=samples)
+    # columns of the stage 2 dosages in the sample order of stage 1, worked out once
+    col2 = dict((y, i) for (i, y) in enumerate(vcf2.samples))
+    perm = np.array([col2[y] for y in vcf1.samples])
+    if (perm == np.arange(len(perm))).all():
+        perm = None
+
+    # contigs in header order, then as they are found
+    ranks = {}
+    for fn in [first_fn, second_fn]:
+        for name in vcf_metadata(fn)['contigs']:
+            ranks.setdefault(normal_chrom(name), len(ranks))
+
+    logging.info('####################')
+    logging.info('Comparing dosages...')
+    summary = Summary()
+    fo = open(out_fn, 'w')
+    fo.write('ID\tCHROM\tPOS\tAAF_FIRST\tAAF_SECOND\tDOSAGE_R2\tMEAN_ABS_DIFF\n')
+    d1 = np.empty((block_size, len(samples)), dtype=np.float32)
+    d2 = np.empty((block_size, len(samples)), dtype=np.float32)
+    rows = []
+
+    with metrics.stage('concordance') as m:
+        groups1 = site_groups(vcf1, first_fn, ranks)
+        groups2 = site_groups(vcf2, second_fn, ranks, perm)
+        g1 = next(groups1, None)
+        g2 = next(groups2, None)
+        block_rank = None
+        count = 0
+        while g1 != None or g2 != None:
+            if g2 == None or (g1 != None and g1[0] < g2[0]):
+                summary.add(g1[0][0], g1[1], 0, len(g1[2]))
+                g1 = next(groups1, None)
+                continue
+            if g1 == None or g2[0] < g1[0]:
+                summary.add(g2[0][0], g2[1], 1, len(g2[2]))
+                g2 = next(groups2, None)
+                continue
+
+            (site, chrom, group) = g1
+            summary.add(site[0], chrom, 0, len(group))
+            summary.add(site[0], chrom, 1, len(g2[2]))
+            second = dict(((ref, alt), ds) for (ref, alt, var, ds) in g2[2])
+            for (ref, alt, var, ds) in group:
+                if (ref, alt) not in second:
+                    continue
+                if len(rows) > 0 and (len(rows) == block_size or block_rank != site[0]):
+                    write_block(fo, rows, d1, d2, summary, block_rank)
+                    rows = []
+                block_rank = site[0]
+                d1[len(rows)] = ds
+                d2[len(rows)] = second[(ref, alt)]
+                rows.append((var, chrom, site[1]))
+                summary.add(site[0], chrom, 2)
+                count = count + 1
+                if count % 500000 == 0:
+                    logging.debug('%s variants compared...' % count)
+            g1 = next(groups1, None)
+            g2 = next(groups2, None)
+        if len(rows) > 0:
+            write_block(fo, rows, d1, d2, summary, block_rank)
+        m['records'] = count
+    fo.close()
+    vcf1.close()
+    vcf2.close()
+
+    fs = open(summary_fn, 'w')
+    summary.write(fs)
+    fs.close()
+
+    logging.info('####################')
+    for rank in sorted(summary.counts):
+        (first, second, matched) = summary.counts[rank]
+        logging.info('%s: %s variants in stage 1, %s in stage 2, %s in both' % (summary.names[rank], first, second, matched))
+    logging.info('Dosage concordance done.')
+    logging.info('Per-variant r2 and mean absolute difference saved to:\n\t%s' % out_fn)
+    logging.info('Per-chromosome summary saved to:\n\t%s' % summary_fn)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+    return summary
@@ -0,0 +1,215 @@
+from datetime import datetime
+import os
+import sys
+import json
+import struct
+import shutil
+import logging
+
+from rsq_table import ALIGN, data_start
+from vcf_index import vcf_fingerprint
+
+# dosage matrix: the haploid dosages (HDS) of an imputed VCF, decoded once for repeated `rsq` runs
+#   magic, header length (uint64), JSON header, then 64-byte aligned arrays
+#   - HDS: variants x samples x 2, quantized to multiples of 1/scale (uint16: 1/1000, uint8: 1/200)
+#   - GT: variants x samples, cyvcf2 gt_types (for HWE)
+#   - variant index: IDs packed in one byte array with n+1 int64 offsets, R2 and ER2 (NaN if missing)
+# the header keeps the path, size and modification time of the source VCF: a matrix older than its VCF is not used
+MAGIC = b'TSIMHDS1'
+SCALES = {'uint16': 1000, 'uint8': 200}
+
+
+def is_dosage_matrix(fn):
+    if not os.path.isfile(fn):
+        return False
+    with open(fn, 'rb') as f1:
+        return f1.read(len(MAGIC)) == MAGIC
+
+
+class MatrixWriter:
+    def __init__(self, fn, samples, dtype, source_fn=None):
+        self.name = fn
+        self.samples = samples
+        self.dtype = dtype
+        self.scale = SCALES[dtype]
+        self.source = vcf_fingerprint(source_fn) if source_fn != None else None
+        self.source_path = os.path.abspath(source_fn) if source_fn != None else None
+        self.n = 0
+        self.id_size = 0
+        self.inexact = 0
+        self.max_error = 0.0
+        # HDS, GT, ID bytes, ID offsets, R2, ER2
+        self.temps = [open('%s.%s.tmp' % (fn, k), 'wb') for k in range(6)]
+
+    def write(self, ids, hds, rsqs, er2s, gts):
+        import numpy as np
+
+        scale = np.float32(self.scale)
+        level = np.rint(np.clip(hds, 0, 1)*scale)
+        # dosages not on the grid (e.g. more than 3 decimals) are rounded
+        error = np.abs(level.astype(np.float32)/scale - hds)
+        self.inexact = self.inexact + int((error != 0).sum())
+        if error.size > 0:
+            self.max_error = max(self.max_error, float(np.nanmax(error)))
+        level.astype(self.dtype).tofile(self.temps[0])
+        gts.astype(np.int8).tofile(self.temps[1])
+
+        encoded = [var.encode() for var in ids]
+        ends = self.id_size + np.cumsum([len(x) for x in encoded], dtype='<i8')
+        self.temps[2].write(b''.join(encoded))
+        if self.n == 0:
+            np.array([0], dtype='<i8').tofile(self.temps[3])
+        ends.tofile(self.temps[3])
+        if len(ids) > 0:
+            self.id_size = int(ends[-1])
+        np.array([np.nan if r == None else r for r in rsqs], dtype='<f8').tofile(self.temps[4])
+        np.array([np.nan if e == '-' else e for e in er2s], dtype='<f8').tofile(self.temps[5])
+        self.n = self.n + len(ids)
+
+    def close(self):
+        import numpy as np
+
+        if self.n == 0:
+            np.array([0], dtype='<i8').tofile(self.temps[3])
+        for fh in self.temps:
+            fh.close()
+
+        sizes = [os.path.getsize(fh.name) for fh in self.temps]
+        offsets = []
+        pos = 0
+        for size in sizes:
+            offsets.append(pos)
+            pos = pos + size + (-size) % ALIGN
+        blob = json.dumps({'n': self.n, 'samples': self.samples, 'dtype': self.dtype, 'scale': self.scale,
+                           'source': self.source, 'source_path': self.source_path,
+                           'offsets': offsets, 'sizes': sizes}).encode()
+
+        with open(self.name, 'wb') as fo:
+            fo.write(MAGIC)
+            fo.write(struct.pack('<Q', len(blob)))
+            fo.write(blob)
+            base = data_start(len(blob))
+            for (fh, off) in zip(self.temps, offsets):
+                fo.write(b'\0' * (base + off - fo.tell()))
+                with open(fh.name, 'rb') as f1:
+                    shutil.copyfileobj(f1, fo)
+                os.remove(fh.name)
+
+
+class DosageMatrix:
+    # memory-mapped dosage matrix, read in blocks like calculate_rsq.read_blocks
+    # samples: samples to read (kept in matrix order; None = all samples)
+    def __init__(self, fn, samples=None):
+        import numpy as np
+
+        with open(fn, 'rb') as f1:
+            if f1.read(len(MAGIC)) != MAGIC:
+                logging.error('%s is not a dosage matrix.' % fn)
+                sys.exit(1)
+            (size,) = struct.unpack('<Q', f1.read(8))
+            header = json.loads(f1.read(size))
+
+        self.name = fn
+        self.n_variants = n = header['n']
+        self.scale = header['scale']
+        self.source = header['source']
+        self.source_path = header.get('source_path')
+        if samples == None:
+            self.cols = None
+            self.samples = header['samples']
+        else:
+            wanted = set(samples)
+            self.cols = [i for (i, y) in enumerate(header['samples']) if y in wanted]
+            self.samples = [header['samples'][i] for i in self.cols]
+
+        n_samples = len(header['samples'])
+        offsets = [data_start(size) + off for off in header['offsets']]
+        if n > 0:
+            self.hds = np.memmap(fn, dtype=header['dtype'], mode='r', offset=offsets[0], shape=(n, n_samples, 2))
+            self.gts = np.memmap(fn, dtype=np.int8, mode='r', offset=offsets[1], shape=(n, n_samples))
+            self.r2 = np.memmap(fn, dtype='<f8', mode='r', offset=offsets[4], shape=(n,))
+            self.er2 = np.memmap(fn, dtype='<f8', mode='r', offset=offsets[5], shape=(n,))
+        self.id_data = np.memmap(fn, dtype=np.uint8, mode='r', offset=offsets[2], shape=(header['sizes'][2],)) \
+            if header['sizes'][2] > 0 else np.zeros(0, dtype=np.uint8)
+        self.id_offsets = np.memmap(fn, dtype='<i8', mode='r', offset=offsets[3], shape=(n+1,))
+
+    def check_source(self):
+        # exits if the source VCF changed after the matrix was written (size or modification time, as vcf_metadata)
+        if self.source_path == None or self.source == None:
+            return
+        if not os.path.exists(self.source_path):
+            logging.warning('%s was written from %s, which no longer exists: not checked against it.' % (self.name, self.source_path))
+            return
+        if vcf_fingerprint(self.source_path)[:3] != self.source[:3]:
+            logging.error('%s is out of date: %s changed after it was written. Rebuild it with `dosage-matrix`.' % (self.name, self.source_path))
+            sys.exit(1)
+
+    def split(self, n_parts):
+        # ('variants', first row, end row) ranges for rsq jobs
+        step = max(1, -(-self.n_variants // n_parts))
+        return [('variants', start, min(start+step, self.n_variants)) for start in range(0, self.n_variants, step)]
+
+    def blocks(self, block_size, genotypes=False, start=0, end=None):
+        # yields (ids, hds, afs, rsqs, er2s, gts) as read_blocks does for a VCF opened with the same samples
+        import numpy as np
+
+        scale = np.float32(self.scale)
+        end = self.n_variants if end == None else end
+        for i in range(start, end, block_size):
+            j = min(i+block_size, end)
+            level = self.hds[i:j] if self.cols is None else self.hds[i:j, self.cols]
+            hds = (level.astype(np.float32)/scale).reshape(j-i, -1)
+            gts = None
+            if genotypes:
+                gts = np.array(self.gts[i:j] if self.cols is None else self.gts[i:j, self.cols])
+            ids = [self.id_data[self.id_offsets[k]:self.id_offsets[k+1]].tobytes().decode() for k in range(i, j)]
+            rsqs = [None if x != x else x for x in self.r2[i:j].tolist()]
+            er2s = ['-' if x != x else x for x in self.er2[i:j].tolist()]
+            yield (ids, hds, None, rsqs, er2s, gts)
+
+    def close(self):
+        pass
+
+
+def run(vcf_fn, out_fn, sam_fn=None, dtype='uint16', block_size=1000, python_lib=''):
+    if python_lib != '' and python_lib not in sys.path:
+        sys.path.append(python_lib)
+
+    from calculate_rsq import open_vcf, read_blocks
+
+    start = datetime.now()
+
+    logging.info('#######################')
+    logging.info('#### Dosage matrix ####')
+    logging.info('#######################')
+    logging.info('### Arguments')
+    logging.info('VCF\t%s' % vcf_fn)
+    logging.info('Output\t%s' % out_fn)
+    logging.info('Samples\t%s' % sam_fn)
+    logging.info('Type\t%s (dosages in steps of 1/%s)' % (dtype, SCALES[dtype]))
+    logging.info('Block size\t%s' % block_size)
+
+    logging.info('####################')
+    logging.info('Getting list of samples...')
+    (vcf, samples) = open_vcf(vcf_fn, sam_fn)
+    samples = vcf.samples
+    if len(samples) == 0:
+        logging.error('No samples to store.')
+        sys.exit(1)
+    logging.info('Number of samples: %s' % len(samples))
+
+    logging.info('####################')
+    logging.info('Writing dosage matrix...')
+    fo = MatrixWriter(out_fn, samples, dtype, vcf_fn)
+    for (ids, hds, afs, rsqs, er2s, gts) in read_blocks(vcf, len(samples), block_size, True):
+        fo.write(ids, hds.reshape(len(ids), -1, 2), rsqs, er2s, gts)
+    fo.close()
+    vcf.close()
+
+    if fo.inexact > 0:
+        logging.warning('%s dosages are not multiples of 1/%s and were rounded (largest difference %.4g).' % (
+            fo.inexact, fo.scale, fo.max_error))
+    logging.info('%s variants x %s samples stored' % (fo.n, len(samples)))
+    logging.info('Dosage matrix saved to:\n\t%s' % out_fn)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+    return (fo.n, len(samples))
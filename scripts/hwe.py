@@ -0,0 +1,75 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def hwe_table(n, n_rare, midp=False):
+    # exact HWE p-value (Wigginton et al. 2005) for every possible heterozygote count,
+    # given n genotyped samples carrying n_rare copies of the rare allele
+    # indexed by het count; entries with the wrong parity are never used
+    import numpy as np
+
+    probs = np.zeros(n_rare+1)
+    n_common = 2*n - n_rare
+
+    # start from the most likely het count and fill both sides with the products of the recurrence ratios
+    mid = n_rare*n_common//(2*n) if n > 0 else 0
+    if (n_rare % 2) != (mid % 2):
+        mid = mid+1
+    mid = min(mid, n_rare)
+    probs[mid] = 1.0
+    hom_r = (n_rare-mid)//2
+    hom_c = n - mid - hom_r
+
+    # het counts mid-2, mid-4, ... down to 0 or 1
+    steps = np.arange(mid//2)
+    het = mid - 2*steps
+    probs[het-2] = np.cumprod(het*(het-1.0)/(4.0*(hom_r+1+steps)*(hom_c+1+steps)))
+
+    # het counts mid+2, mid+4, ... up to n_rare
+    steps = np.arange((n_rare-mid)//2)
+    het = mid + 2*steps
+    probs[het+2] = np.cumprod(4.0*(hom_r-steps)*(hom_c-steps)/((het+2.0)*(het+1)))
+
+    valid = np.arange(n_rare % 2, n_rare+1, 2)
+    probs[valid] = probs[valid]/probs[valid].sum()
+
+    # p-value: total probability of the tables no more likely than the observed one
+    # (looked up in sorted order, which is much faster than searching with unsorted values)
+    rank = np.argsort(probs[valid], kind='stable')
+    order = probs[valid][rank]
+    cum = np.cumsum(order)
+    at_most = np.empty(len(valid))
+    at_most[rank] = cum[np.searchsorted(order, order*(1+1e-7), side='right')-1]/cum[-1]
+    # wrong parity: 1; valid het counts that underflow to 0 (extreme HWE violations) keep their p-value
+    pvals = np.ones(n_rare+1)
+    pvals[valid] = np.minimum(1.0, at_most - (0.5*probs[valid] if midp else 0))
+    return pvals
+
+
+def hwe_exact(het, hom1, hom2, midp=False):
+    # vectorized over variants: p-values for arrays of genotype counts
+    import numpy as np
+
+    het = np.asarray(het, dtype=np.int64)
+    hom1 = np.asarray(hom1, dtype=np.int64)
+    hom2 = np.asarray(hom2, dtype=np.int64)
+    n = het + hom1 + hom2
+    n_rare = het + 2*np.minimum(hom1, hom2)
+
+    pvals = np.ones(len(het))
+    keys = np.stack([n, n_rare], axis=1)
+    (uniq, inverse) = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(uniq)+1))
+    for (k, (n_k, rare_k)) in enumerate(uniq):
+        if n_k == 0:
+            continue
+        rows = order[bounds[k]:bounds[k+1]]
+        pvals[rows] = hwe_table(int(n_k), int(rare_k), midp)[het[rows]]
+    return pvals
+
+
+def genotype_counts(gts):
+    # gts: (variants, samples) cyvcf2 gt_types (0 = HOM_REF, 1 = HET, 2 = UNKNOWN, 3 = HOM_ALT)
+    return ((gts == 1).sum(axis=1), (gts == 0).sum(axis=1), (gts == 3).sum(axis=1))
@@ -1,41 +1,321 @@
 from datetime import datetime
 import os
 import sys
+import time
+import signal
 import subprocess
+import gzip
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import metrics
 from check_samples import check_samples
+from variant_key import parse_id
+from vcf_index import find_index, split_regions, vcf_metadata, n_records
 
-def format_files(vcf, samfn, varlist, outvcf):
-    logging.info('####################')
-    logging.info('VCF file:\t%s' % vcf)
-    logging.info('Sample file:\t%s' % samfn)
-    logging.info('Variant file:\t%s' % varlist)
-    logging.info('TEMP file:\t%s' % outvcf)
+class CommandRunner:
+    # runs shell commands (from several threads), logging their stderr line by line with a prefix
+    # stop() kills the running commands and refuses new ones, to fail fast
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = []
+        self.stopped = False
+
+    def start(self, cmd, prefix='', **kwargs):
+        # starts cmd without waiting for it (None if stopped); its stderr is logged from a thread
+        with self.lock:
+            if self.stopped:
+                return None
+            # own process group, so stop() also reaches the programs started by the shell
+            proc = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, text=True, start_new_session=True, **kwargs)
+            self.procs.append(proc)
+        proc.start_time = time.perf_counter()
+        proc.log_thread = threading.Thread(target=self.log_stderr, args=(proc, prefix))
+        proc.log_thread.start()
+        return proc
+
+    def log_stderr(self, proc, prefix):
+        for line in proc.stderr:
+            logging.info('%s%s' % (prefix, line.rstrip()))
+
+    def wait(self, proc, cmd, prefix=''):
+        proc.log_thread.join()
+        proc.wait()
+        metrics.record_command(cmd, prefix, time.perf_counter() - proc.start_time, proc.returncode)
+        with self.lock:
+            self.procs.remove(proc)
+            stopped = self.stopped
+        if proc.returncode != 0:
+            if not stopped:
+                logging.error('%sCommand failed with exit code %s: %s' % (prefix, proc.returncode, cmd))
+            return False
+        return True
+
+    def run(self, cmd, prefix=''):
+        proc = self.start(cmd, prefix)
+        if proc == None:
+            return False
+        return self.wait(proc, cmd, prefix)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            for proc in self.procs:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+
+def normal_chrom(name):
+    name = name.upper()
+    return name[3:] if name.startswith('CHR') else name
+
+
+def contig_names(vcf):
+    # the VCF's contig names by normalized chromosome (22 for chr22 and 22)
+    return dict((normal_chrom(name), name) for name in vcf_metadata(vcf)['contigs'])
+
+
+def write_targets(vcf, varlist, regions_fn, start=1, end=None):
+    # coordinate targets (CHROM, BEG, END) of the variants in varlist between start and end, with the VCF's contig names
+    # returns the number of targets, or None if the IDs are not chrom:pos:ref:alt
+    positions = {}
+    f1 = gzip.open(varlist, 'rt') if varlist.endswith('.gz') else open(varlist, 'r')
+    for line in f1:
+        var = line.strip()
+        if var == '':
+            continue
+        parsed = parse_id(var)
+        if parsed == None:
+            f1.close()
+            return None
+        if parsed[1] >= start and (end == None or parsed[1] <= end):
+            positions.setdefault(parsed[0], set()).add(parsed[1])
+    f1.close()
     
+    contigs = contig_names(vcf)
+    n = 0
+    fo = open(regions_fn, 'w')
+    for chrom in positions:
+        if chrom not in contigs:
+            continue
+        # runs of consecutive positions as one interval
+        pos = sorted(positions[chrom])
+        start = pos[0]
+        for k in range(1, len(pos)+1):
+            if k == len(pos) or pos[k] != pos[k-1]+1:
+                fo.write('%s\t%s\t%s\n' % (contigs[chrom], start, pos[k-1]))
+                if k < len(pos):
+                    start = pos[k]
+        n = n + len(pos)
+    fo.close()
+    return n
+
+
+def view_command(vcf, samfn, varlist, out, fmt, threads=1, prefix='', targets=False, snpsonly=False, regions_fn=None,
+                 region=None):
+    # region: (chrom, start, end) shard; records are assigned to the shard holding their POS
+    # bcftools --threads: compression threads besides the main one
+    opts = ['--threads', str(threads-1)] if threads > 1 else []
+    if region != None:
+        opts = opts + ['--no-version']
+    n = None
+    if targets:
+        # fetch only the records at the overlap positions through the index
+        # (records starting there; the ID filter then drops other variants at the same positions)
+        (start, end) = (region[1], region[2]) if region != None else (1, None)
+        n = write_targets(vcf, varlist, regions_fn, start, end) if find_index(vcf) != None else None
+        if n == None or (n == 0 and region == None):
+            logging.warning('%sNo tabix index for the VCF or no chrom:pos:ref:alt IDs: reading the whole VCF.' % prefix)
+        elif n > 0:
+            logging.info('%s%s target positions' % (prefix, n))
+            opts = opts + ['-R', regions_fn, '--regions-overlap', '0']
+    if region != None and not n:
+        contig = contig_names(vcf).get(normal_chrom(region[0]), region[0])
+        end = '' if region[2] == None else region[2]
+        opts = opts + ['-r', '%s:%s-%s' % (contig, region[1], end), '--regions-overlap', '0']
+    if snpsonly:
+        expr = "'ID=@%s && TYPE=\"snp\"'" % varlist
+    else:
+        expr = 'ID=@%s' % varlist
     if samfn == None or samfn == "":
-        try: 
-            subprocess.run(' '.join(['bcftools', 'view', '-Oz', '-o', outvcf, '-i', 'ID=@%s' % varlist, vcf]), shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Command failed with exit code {e.returncode}")
-            sys.exit(1)
-            
+        cmd = ['bcftools', 'view'] + opts + ['-O%s' % fmt, '-o', out, '-i', expr, vcf]
     else:
-        try:
-            subprocess.run(' '.join(['bcftools', 'view', '-Oz', '-o', outvcf, '-S', samfn, '--force-samples', '-i', 'ID=@%s' % varlist, vcf]), shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Command failed with exit code {e.returncode}")
-            sys.exit(1)
-            
+        cmd = ['bcftools', 'view'] + opts + ['-O%s' % fmt, '-o', out, '-S', samfn, '--force-samples', '-i', expr, vcf]
+    return ' '.join(cmd)
+
+
+def format_files(vcf, samfn, varlist, outvcf, runner, threads=1, prefix='', targets=False, snpsonly=False, cache=None):
+    logging.info('####################')
+    logging.info('%sVCF file:\t%s' % (prefix, vcf))
+    logging.info('%sSample file:\t%s' % (prefix, samfn))
+    logging.info('%sVariant file:\t%s' % (prefix, varlist))
+    logging.info('%sTEMP file:\t%s' % (prefix, outvcf))
+    
+    if cache != None:
+        key = cache.key('format', [vcf, samfn, varlist], [targets, snpsonly])
+        if cache.fetch(key, [outvcf, outvcf + '.tbi'], prefix) != None:
+            return True
+    regions_fn = outvcf + '.targets.tsv'
+    cmd = view_command(vcf, samfn, varlist, outvcf, 'z', threads, prefix, targets, snpsonly, regions_fn)
+    ok = runner.run(cmd, prefix)
+    remove_targets([regions_fn])
+    if not ok:
+        return False
+    if not runner.run(' '.join(['tabix', '-fp', 'vcf', outvcf]), prefix):
+        return False
+    if cache != None:
+        cache.store(key, [outvcf, outvcf + '.tbi'], prefix=prefix)
+    return True
+
+
+def stream_merge(filelists, output, threads, targets, snpsonly, runner=None, region=None, prefix=''):
+    # per-cohort bcftools view piped (uncompressed BCF) straight into bcftools merge --no-index:
+    # no temp VCFs, indexes or mergelist; SNPs are selected in the per-cohort views
+    # region: only the records with POS in the (chrom, start, end) shard
+    if runner == None:
+        runner = CommandRunner()
+    shard = '' if region == None else '.shard%s' % region[1]
+    regions_fns = [filelists[idx][3] + shard + '.targets.tsv' for idx in filelists]
     try:
-        subprocess.run(' '.join(['tabix', '-fp', 'vcf', outvcf]), shell=True, check=True)
-    except subprocess.CallProcessError as e:
-        logging.error(f"Command failed with exit code {e.returncode}")
+        return run_stream_merge(filelists, output, threads, targets, snpsonly, runner, region, prefix, regions_fns)
+    finally:
+        remove_targets(regions_fns)
+
+
+def run_stream_merge(filelists, output, threads, targets, snpsonly, runner, region, prefix, regions_fns):
+    views = []
+    for (k, idx) in enumerate(filelists):
+        (vcf, variant, sample, temp) = filelists[idx]
+        view_prefix = '%s[%s %s] ' % (prefix, idx, os.path.basename(vcf))
+        logging.info('####################')
+        logging.info('%sVCF file:\t%s' % (view_prefix, vcf))
+        logging.info('%sSample file:\t%s' % (view_prefix, sample))
+        logging.info('%sVariant file:\t%s' % (view_prefix, variant))
+        cmd = view_command(vcf, sample, variant, '-', 'u', 1, view_prefix, targets, snpsonly, regions_fns[k], region)
+        proc = runner.start(cmd, view_prefix, stdout=subprocess.PIPE)
+        if proc == None:
+            break
+        views.append((proc, cmd, view_prefix))
+    
+    merge_proc = None
+    if len(views) == len(filelists):
+        logging.info('####################')
+        logging.info('%sMerging cohorts' % prefix)
+        fds = [proc.stdout.fileno() for (proc, cmd, view_prefix) in views]
+        opts = ['--threads', str(threads-1)] if threads > 1 else []
+        if region != None:
+            # shards are concatenated: the same header in every shard
+            opts = opts + ['--no-version']
+        merge_cmd = ' '.join(['bcftools', 'merge', '--no-index'] + opts + ['-m', 'none', '-Oz', '-o', output] +
+                             ['/dev/fd/%s' % fd for fd in fds])
+        merge_proc = runner.start(merge_cmd, prefix, pass_fds=fds)
+    for (proc, cmd, view_prefix) in views:
+        proc.stdout.close()
+    
+    # a failing view ends its pipe, which makes the merge (and then the other views) fail too
+    procs = views + ([(merge_proc, merge_cmd, prefix)] if merge_proc != None else [])
+    failed = [cmd for (proc, cmd, view_prefix) in procs if not runner.wait(proc, cmd, view_prefix)]
+    if len(failed) > 0 or merge_proc == None:
+        if os.path.exists(output):
+            os.remove(output)
+        return False
+    return True
+
+
+def remove_targets(regions_fns):
+    # the -R targets files of the views, only needed while they run
+    for fn in regions_fns:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+
+def shard_regions(filelists, chrom, n_shards):
+    # [(chrom, start, end)] shards of the chromosome with similar amounts of data in the largest input VCF (most records),
+    # from its tabix index; [None] (the whole chromosome) unless every VCF has an index (needed by `bcftools view -r`)
+    vcfs = [filelists[idx][0] for idx in filelists]
+    missing = [vcf for vcf in vcfs if find_index(vcf) == None]
+    if len(missing) > 0:
+        logging.warning('No tabix index for %s: merging the chromosome in one piece.' % ', '.join(missing))
+        return [None]
+    vcf = max(vcfs, key=lambda vcf: n_records(vcf_metadata(vcf)))
+    contigs = contig_names(vcf)
+    name = contigs.get(normal_chrom(chrom))
+    regions = [r for r in split_regions(vcf, n_shards, vcf_metadata(vcf)['contigs']) if r[0] == name]
+    if len(regions) == 0:
+        logging.warning('Chromosome %s is not in the index of %s: merging the chromosome in one piece.' % (chrom, vcf))
+        return [None]
+    return regions
+
+
+def shard_merge(filelists, chrom, output, tempdir, jobs, threads, targets, snpsonly, n_shards):
+    # stream merges of region shards in parallel, concatenated in order
+    # shards hold the records whose POS is in the region: records spanning a boundary are merged once
+    regions = shard_regions(filelists, chrom, n_shards)
+    per_job = max(1, threads//jobs)
+    logging.info('%s shards, %s jobs, %s threads per job' % (len(regions), jobs, per_job))
+    runner = CommandRunner()
+    shards = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for (k, region) in enumerate(regions):
+            shard = '%s/merged-%s.shard%s.vcf.gz' % (tempdir, chrom, k)
+            shards.append(shard)
+            if region == None:
+                prefix = ''
+            else:
+                prefix = '[%s:%s-%s] ' % (region[0], region[1], '' if region[2] == None else region[2])
+            futures.append(pool.submit(stream_merge, filelists, shard, per_job, targets, snpsonly, runner, region, prefix))
+        for future in as_completed(futures):
+            if not future.result():
+                runner.stop()
+                for f in futures:
+                    f.cancel()
+                logging.error('Merging failed. Stopping the other jobs.')
+                for shard in shards:
+                    if os.path.exists(shard):
+                        os.remove(shard)
+                sys.exit(1)
+    
+    logging.info('####################')
+    logging.info('Concatenating %s shards' % len(shards))
+    opts = ['--threads', str(threads-1)] if threads > 1 else []
+    if not runner.run(' '.join(['bcftools', 'concat', '--naive'] + opts + ['-Oz', '-o', output] + shards)):
+        sys.exit(1)
+    if not runner.run(' '.join(['tabix', '-fp', 'vcf', output])):
         sys.exit(1)
+    for shard in shards:
+        os.remove(shard)
 
 
-def run(chrom, filelist_fn, output, tempdir, snpsonly, python_lib):
+def format_all(filelists, jobs, threads, targets=False, snpsonly=False, cache=None):
+    # one job per cohort; cores are split between jobs and bcftools compression threads
+    runner = CommandRunner()
+    per_job = max(1, threads//jobs)
+    logging.info('%s jobs, %s threads per job' % (jobs, per_job))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for idx in filelists:
+            (vcf, variant, sample, temp) = filelists[idx]
+            prefix = '[%s %s] ' % (idx, os.path.basename(vcf))
+            futures.append(pool.submit(format_files, vcf, sample, variant, temp, runner, per_job, prefix,
+                                       targets, snpsonly, cache))
+        for future in as_completed(futures):
+            if not future.result():
+                runner.stop()
+                for f in futures:
+                    f.cancel()
+                logging.error('Formatting files failed. Stopping the other jobs.')
+                sys.exit(1)
+
+
+def run(chrom, filelist_fn, output, tempdir, snpsonly, python_lib, jobs=1, threads=None, targets=False, stream=False,
+        shards=0, cache=None):
     start = datetime.now()
+    if threads == None:
+        threads = jobs
     
     ext = output.split('.')[-1]
     if ext != 'gz':
@@ -64,18 +344,38 @@ def run(chrom, filelist_fn, output, tempdir, snpsonly, python_lib):
     logging.info('File lists:\t%s' % filelist_fn)
     logging.info('Output:\t%s' % output)
     logging.info('TEMP directory\t%s' % tempdir)
+    logging.info('Jobs\t%s' % jobs)
+    logging.info('Threads\t%s' % threads)
+    logging.info('Index targets\t%s' % targets)
+    logging.info('Streaming\t%s' % stream)
+    logging.info('Shards\t%s' % shards)
+    logging.info('Cache\t%s' % (None if cache == None else cache.cache_dir))
     
-    check_samples(filelists, python_lib)
+    with metrics.stage('check_samples') as m:
+        check_samples(filelists, python_lib)
+        m['files'] = len(filelists)
+    
+    if stream or shards > 1:
+        with metrics.stage('merge') as m:
+            if shards > 1:
+                shard_merge(filelists, chrom, output, tempdir, jobs, threads, targets, snpsonly, shards)
+            elif not stream_merge(filelists, output, threads, targets, snpsonly):
+                logging.error('Merging failed.')
+                sys.exit(1)
+            m['files'] = len(filelists)
+        logging.info('####################')
+        logging.info('Merging done')
+        logging.info('Merged VCF saved to:\n\t%s' % output)
+        logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+        return
     
     logging.info('####################')
     logging.info('Formatting files...')
     
-    for idx in filelists:
-        vcf = filelists[idx][0]
-        variant = filelists[idx][1]
-        sample = filelists[idx][2]
-        temp = filelists[idx][3]        
-        format_files(vcf, sample, variant, temp)
+    # with targets, SNPs are selected while extracting: no filtering pass after the merge
+    with metrics.stage('format') as m:
+        format_all(filelists, jobs, threads, targets, snpsonly and targets, cache)
+        m['files'] = len(filelists)
                
     mergelist = '%s/mergelist-%s.txt' % (tempdir, chrom)
     f1 = open(mergelist, 'w')
@@ -87,28 +387,24 @@ def run(chrom, filelist_fn, output, tempdir, snpsonly, python_lib):
     logging.info('####################')
     logging.info('Merging cohorts')
     
-    if snpsonly:    
+    runner = CommandRunner()
+    opts = ['--threads', str(threads-1)] if threads > 1 else []
+    if snpsonly and not targets:    
         tempmerge = '%s/merged-%s.temp.vcf.gz' % (tempdir, chrom)
-        try:
-            subprocess.run(' '.join(['bcftools', 'merge', '-m' ,'none', '-Oz', '-o', tempmerge, '-l', mergelist]), shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Command failed with exit code {e.returncode}")
-            sys.exit(1)
+        with metrics.stage('merge'):
+            if not runner.run(' '.join(['bcftools', 'merge'] + opts + ['-m' ,'none', '-Oz', '-o', tempmerge, '-l', mergelist])):
+                sys.exit(1)
 
         logging.info('####################')
         logging.info('Filtering for SNPs only')
-        try:
-            f = 'TYPE="snp"'
-            subprocess.run(' '.join(['bcftools', 'view', '-Oz', '-o', output, '-i', "'%s'" % f, tempmerge]), shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Command failed with exit code {e.returncode}")
-            sys.exit(1)
+        f = 'TYPE="snp"'
+        with metrics.stage('filter'):
+            if not runner.run(' '.join(['bcftools', 'view'] + opts + ['-Oz', '-o', output, '-i', "'%s'" % f, tempmerge])):
+                sys.exit(1)
     else:
-        try:
-            subprocess.run(' '.join(['bcftools', 'merge', '-m' ,'none', '-Oz', '-o', output, '-l', mergelist]), shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Command failed with exit code {e.returncode}")
-            sys.exit(1)
+        with metrics.stage('merge'):
+            if not runner.run(' '.join(['bcftools', 'merge'] + opts + ['-m' ,'none', '-Oz', '-o', output, '-l', mergelist])):
+                sys.exit(1)
     logging.info('####################')
     logging.info('Merging done')
     logging.info('Merged VCF saved to:\n\t%s' % output)
@@ -0,0 +1,216 @@
+import sys
+import json
+import time
+import atexit
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# performance metrics of one tsim.py run, written as JSON with --metrics:
+# stages (wall and CPU time, records/sec, bytes read and written, peak RSS), timers summed over a loop
+# (e.g. VCF decoding vs. rsq math vs. text formatting) and the bcftools/tabix commands run
+# everything is a no-op until enable() is called
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stages = []
+        self.timers = {}
+        self.commands = []
+        self.metrics_fn = None
+        self.profile_fn = None
+        self.profile_stage = None
+        self.profiler = None
+
+
+_metrics = Metrics()
+
+
+def enable(metrics_fn=None, profile_fn=None, profile_stage=None):
+    # profile_fn: cProfile stats of the whole run, or of the stages named profile_stage
+    _metrics.enabled = True
+    _metrics.metrics_fn = metrics_fn
+    _metrics.profile_fn = profile_fn
+    _metrics.profile_stage = profile_stage
+    _metrics.argv = sys.argv
+    _metrics.start = datetime.now()
+    _metrics.wall = time.perf_counter()
+    _metrics.io = read_io()
+    if profile_fn != None and profile_stage == None:
+        start_profile()
+    # also written when a step exits with an error
+    atexit.register(finish)
+
+
+def read_io():
+    # (bytes read, bytes written) by this process, None where /proc/self/io is not available
+    try:
+        with open('/proc/self/io') as f1:
+            io = dict(line.split(':') for line in f1)
+        return (int(io['rchar']), int(io['wchar']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def cpu_seconds(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss/1024.0**2 if sys.platform == 'darwin' else rss/1024.0
+
+
+def start_profile():
+    import cProfile
+
+    if _metrics.profiler == None:
+        _metrics.profiler = cProfile.Profile()
+    _metrics.profiler.enable()
+
+
+def stop_profile():
+    if _metrics.profiler != None:
+        _metrics.profiler.disable()
+
+
+@contextmanager
+def stage(name):
+    # with stage('rsq') as m: ... m['records'] = n
+    m = {'name': name}
+    if not _metrics.enabled:
+        yield m
+        return
+    profile = _metrics.profile_fn != None and _metrics.profile_stage == name
+    if profile:
+        start_profile()
+    (wall, cpu, io) = (time.perf_counter(), cpu_seconds(), read_io())
+    try:
+        yield m
+    finally:
+        if profile:
+            stop_profile()
+        m['wall_seconds'] = round(time.perf_counter() - wall, 6)
+        m['cpu_seconds'] = round(cpu_seconds() - cpu, 6)
+        if m.get('records') != None and m['wall_seconds'] > 0:
+            m['records_per_sec'] = round(m['records']/m['wall_seconds'], 1)
+        end_io = read_io()
+        if io != None and end_io != None:
+            m['bytes_read'] = end_io[0] - io[0]
+            m['bytes_written'] = end_io[1] - io[1]
+        m['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        with _metrics.lock:
+            _metrics.stages.append(m)
+
+
+@contextmanager
+def collect():
+    # with collect() as stages: ... stages finished inside the block, also without --metrics (tsim_api)
+    # without a metrics file they are dropped from the run afterwards, so a long-running process does not keep them
+    if not _metrics.enabled:
+        enable()
+    with _metrics.lock:
+        (first, first_command) = (len(_metrics.stages), len(_metrics.commands))
+    stages = []
+    try:
+        yield stages
+    finally:
+        with _metrics.lock:
+            stages.extend(_metrics.stages[first:])
+            if _metrics.metrics_fn == None:
+                del _metrics.stages[first:]
+                del _metrics.commands[first_command:]
+
+
+def add_time(name, seconds, calls=1):
+    if not _metrics.enabled:
+        return
+    with _metrics.lock:
+        timer = _metrics.timers.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        timer['seconds'] = timer['seconds'] + seconds
+        timer['calls'] = timer['calls'] + calls
+
+
+def timed(iterable, name):
+    # iterates over iterable, adding the time spent producing each item to the timer name
+    if not _metrics.enabled:
+        return iterable
+    return _timed(iterable, name)
+
+
+def _timed(iterable, name):
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            add_time(name, time.perf_counter() - start, 0)
+            return
+        add_time(name, time.perf_counter() - start)
+        yield item
+
+
+@contextmanager
+def timer(name):
+    if not _metrics.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def record_command(cmd, prefix, seconds, returncode):
+    # bcftools/tabix (or tsim.py) commands run through merge.CommandRunner
+    if not _metrics.enabled:
+        return
+    with _metrics.lock:
+        _metrics.commands.append({'command': cmd, 'prefix': prefix.strip(), 'wall_seconds': round(seconds, 6),
+                                  'returncode': returncode})
+
+
+def finish():
+    if not _metrics.enabled:
+        return
+    _metrics.enabled = False
+    stop_profile()
+    if _metrics.profile_fn != None and _metrics.profiler != None:
+        import pstats
+
+        _metrics.profiler.dump_stats(_metrics.profile_fn)
+        logging.info('####################')
+        logging.info('Profile saved to:\n\t%s' % _metrics.profile_fn)
+        stats = pstats.Stats(_metrics.profiler, stream=sys.stdout)
+        stats.sort_stats('cumulative').print_stats(20)
+
+    if _metrics.metrics_fn == None:
+        return
+    io = read_io()
+    summary = {
+        'command': _metrics.argv,
+        'start': _metrics.start.isoformat(),
+        'wall_seconds': round(time.perf_counter() - _metrics.wall, 6),
+        'cpu_seconds': round(cpu_seconds(), 6),
+        'children_cpu_seconds': round(cpu_seconds(resource.RUSAGE_CHILDREN), 6),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'children_peak_rss_mb': round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+        'stages': _metrics.stages,
+        'timers': dict((name, {'seconds': round(t['seconds'], 6), 'calls': t['calls']})
+                       for (name, t) in _metrics.timers.items()),
+        'commands': _metrics.commands,
+    }
+    if io != None and _metrics.io != None:
+        summary['bytes_read'] = io[0] - _metrics.io[0]
+        summary['bytes_written'] = io[1] - _metrics.io[1]
+    with open(_metrics.metrics_fn, 'w') as fo:
+        json.dump(summary, fo, indent=2)
+    logging.info('Metrics saved to:\n\t%s' % _metrics.metrics_fn)
@@ -1,70 +1,226 @@
 from datetime import datetime
 import sys
+import gzip
+import heapq
 import logging
+from itertools import groupby
 
+import metrics
+from bgzf import open_text, abort
 from check_chrom import check_chrom
+from variant_key import VariantKeys, position, isin
 
 def load_varlist(var_fn):
     logging.info('####################')
     logging.info('Reading variants: %s' % var_fn)
     varlist = set()
-    f1 = open(var_fn, 'r')
-    for line in f1.readlines():
+    f1 = gzip.open(var_fn, 'rt') if var_fn.endswith('.gz') else open(var_fn, 'r')
+    for line in f1:
         var = line.strip()
-        varlist.add(var)
+        if var != '':
+            varlist.add(var)
     f1.close()
     logging.info('%s variants detected' % len(varlist))
     return varlist
 
 
-def run(filelist_fn, chrom, output):
+def read_ids(var_fn):
+    with gzip.open(var_fn, 'rt') if var_fn.endswith('.gz') else open(var_fn) as f1:
+        for line in f1:
+            var = line.strip()
+            if var != '':
+                yield var
+
+
+def read_sorted(var_fn, k, keys, n_read, unsorted):
+    # (position, list number, key, var) from a position-sorted variant list
+    # stops and records the file in unsorted if it is not sorted by position
+    pos = None
+    for var in read_ids(var_fn):
+        key = keys.key(var)
+        if key == None or (pos != None and position(key) < pos):
+            unsorted.append(var_fn)
+            return
+        pos = position(key)
+        n_read[k] = n_read[k]+1
+        yield (pos, k, key, var)
+
+
+def stream_overlap(filelist, min_cohorts, fo, counts_fo):
+    # k-way merge of the lists, holding one position at a time
+    # returns the number of cohorts carrying each variant as a histogram, or None if a list is not sorted
+    keys = VariantKeys()
+    n_read = [0 for fn in filelist]
+    unsorted = []
+    merged = heapq.merge(*[read_sorted(fn, k, keys, n_read, unsorted) for (k, fn) in enumerate(filelist)])
+
+    hist = [0 for k in range(len(filelist)+1)]
+    for (pos, group) in groupby(merged, key=lambda x: x[0]):
+        # variants are named as in the first list carrying them
+        carriers = {}
+        for (p, k, key, var) in group:
+            carriers.setdefault(key, [var, set()])[1].add(k)
+        for (var, lists) in sorted(carriers.values()):
+            n = len(lists)
+            hist[n] = hist[n]+1
+            if counts_fo != None:
+                counts_fo.write('%s\t%s\n' % (var, n))
+            if n >= min_cohorts:
+                fo.write('%s\n' % var)
+
+    if len(unsorted) > 0:
+        logging.warning('%s is not sorted by position (or IDs are not chrom:pos:ref:alt): loading the lists instead of streaming.' % unsorted[0])
+        return None
+    for (fn, n) in zip(filelist, n_read):
+        logging.info('%s variants in %s' % (n, fn))
+    return hist
+
+
+def key_overlap(filelist, min_cohorts, fo, counts_fo):
+    # overlap of unsorted lists with integer variant keys, None if IDs cannot be encoded
+    import numpy as np
+
+    keys = VariantKeys()
+    list_keys = []
+    for fn in filelist:
+        logging.info('####################')
+        logging.info('Reading variants: %s' % fn)
+        k = keys.encode(read_ids(fn))
+        if k is None:
+            logging.info('Variant IDs are not all chrom:pos:ref:alt: matching variants by ID.')
+            return None
+        list_keys.append(np.unique(k))
+        logging.info('%s variants detected' % len(list_keys[-1]))
+
+    (uniq, counts) = np.unique(np.concatenate(list_keys), return_counts=True)
+    hist = np.bincount(counts, minlength=len(filelist)+1).tolist()
+    if counts_fo == None:
+        uniq = uniq[counts >= min_cohorts]
+        counts = counts[counts >= min_cohorts]
+
+    # name variants as in the first list carrying them
+    names = np.empty(len(uniq), dtype=object)
+    named = np.zeros(len(uniq), dtype=bool)
+    for fn in filelist:
+        if named.all():
+            break
+        ids = list(read_ids(fn))
+        list_keys = keys.encode(ids)
+        idx = np.searchsorted(uniq, list_keys)
+        hit = np.flatnonzero(isin(list_keys, uniq))
+        hit = hit[~named[idx[hit]]]
+        (idx_hit, first) = np.unique(idx[hit], return_index=True)
+        names[idx_hit] = [ids[i] for i in hit[first]]
+        named[idx_hit] = True
+
+    for i in np.lexsort((names.astype(str), position(uniq))):
+        if counts_fo != None:
+            counts_fo.write('%s\t%s\n' % (names[i], counts[i]))
+        if counts[i] >= min_cohorts:
+            fo.write('%s\n' % names[i])
+    return hist
+
+
+def variant_order(var):
+    # genomic order for chrom:pos:ref:alt IDs, other IDs first by name
+    key = VariantKeys().key(var)
+    return (-1, var) if key == None else (position(key), var)
+
+
+def set_overlap(filelist, min_cohorts, fo, counts_fo):
+    carriers = {}
+    for fn in filelist:
+        for var in load_varlist(fn):
+            carriers[var] = carriers.get(var, 0)+1
+
+    hist = [0 for k in range(len(filelist)+1)]
+    for var in sorted(carriers, key=variant_order):
+        n = carriers[var]
+        hist[n] = hist[n]+1
+        if counts_fo != None:
+            counts_fo.write('%s\t%s\n' % (var, n))
+        if n >= min_cohorts:
+            fo.write('%s\n' % var)
+    return hist
+
+
+def open_outputs(output, counts_fn, previous=()):
+    # (re)starts the output and counts files (bgzipped if named .gz), discarding what was written before
+    for fo in previous:
+        if fo != None:
+            fo.close()
+    return (open_text(output), open_text(counts_fn) if counts_fn != None else None)
+
+
+def run(filelist_fn, chrom, output, min_cohorts=None, counts_fn=None):
     start = datetime.now()
-    
-    filelist = set()
+
+    filelist = []
     f1 = open(filelist_fn, 'r')
     for line in f1.readlines():
         fn = line.strip()
-        filelist.add(fn)
+        if fn != '' and fn not in filelist:
+            filelist.append(fn)
     f1.close()
-    
+    if min_cohorts == None:
+        min_cohorts = len(filelist)
+
     logging.info('###########################')
     logging.info('##### Variant Overlap #####')
     logging.info('###########################')
     logging.info('### Arguments')
     logging.info('Chromosome:\t%s' % chrom)
     logging.info('Variant lists:\n\t%s' % '\n\t'.join(filelist))
+    logging.info('Minimum cohorts:\t%s' % min_cohorts)
+    logging.info('Cohort counts:\t%s' % counts_fn)
     logging.info('Output:\t%s' % output)
-    
+
+    if min_cohorts < 1 or min_cohorts > len(filelist):
+        logging.error('--min-cohorts must be between 1 and the number of variant lists (%s).' % len(filelist))
+        sys.exit(1)
+
     min_num = check_chrom(chrom)
-    
-    varlist = {}
-    for fn in filelist:
-        varlist[fn] = load_varlist(fn)
-        
-    skip = True
-    for fn in varlist.keys():
-        if skip:
-            list1 = varlist[fn]
-            skip = False
-        else:
-            list2 = varlist[fn]
-            overlap = list1.intersection(list2)
-            list1 = overlap
-            
-    overlap = sorted(overlap)
-    f1 = open(output, 'w')
-    f1.write('\n'.join(overlap))
-    f1.write('\n')
+
+    logging.info('####################')
+    logging.info('Merging variant lists...')
+    (f1, f2) = (None, None)
+    try:
+        with metrics.stage('overlap') as m:
+            (f1, f2) = open_outputs(output, counts_fn)
+            hist = stream_overlap(filelist, min_cohorts, f1, f2)
+            if hist == None:
+                (f1, f2) = open_outputs(output, counts_fn, (f1, f2))
+                hist = key_overlap(filelist, min_cohorts, f1, f2)
+            if hist == None:
+                (f1, f2) = open_outputs(output, counts_fn, (f1, f2))
+                hist = set_overlap(filelist, min_cohorts, f1, f2)
+            # distinct variants over all cohorts
+            m['records'] = sum(hist)
+    except BaseException:
+        for fo in [f1, f2]:
+            if fo != None:
+                abort(fo)
+        raise
+    n_overlap = sum(hist[min_cohorts:])
+    if n_overlap == 0:
+        f1.write('\n')
     f1.close()
+    if f2 != None:
+        f2.close()
 
     logging.info('####################')
-    logging.info(' %s variants overlapping' % len(overlap))
+    for k in range(len(filelist), 0, -1):
+        logging.info(' %s variants in %s of %s cohorts' % (hist[k], k, len(filelist)))
+    logging.info(' %s variants overlapping' % n_overlap)
 
-    if len(overlap) < min_num:
+    if n_overlap < min_num:
         logging.warning('WARNING: low number of variants passing QC for chromosome %s (ideally want %s variants or more)' % (chrom, min_num))
 
 
     logging.info('####################')
     logging.info('Finding variant overlap done.')
     logging.info('Overlapping variant IDs saved to:\n\t%s' % output)
+    if counts_fn != None:
+        logging.info('Number of cohorts per variant saved to:\n\t%s' % counts_fn)
     logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+    return (hist, n_overlap)
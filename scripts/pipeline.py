@@ -0,0 +1,282 @@
+from datetime import datetime
+import os
+import sys
+import time
+import logging
+
+from merge import CommandRunner
+from vcf_index import find_index, vcf_metadata, n_records
+
+STEPS = ['rsq', 'qc', 'overlap', 'merge']
+
+
+class Task:
+    # one tsim.py call; done when its marker exists with the same command and its inputs were not rerun
+    def __init__(self, name, chrom, step, cmd, deps, outputs, cpus, memory):
+        self.name = name
+        self.chrom = chrom
+        self.step = step
+        self.cmd = cmd
+        self.deps = deps
+        self.outputs = outputs
+        self.cpus = cpus
+        self.memory = memory
+        self.priority = 0
+        self.proc = None
+
+
+def parse_chroms(text):
+    # 1-22, 20,21,22 or 1-5,7
+    chroms = []
+    for part in text.split(','):
+        if '-' in part:
+            (first, last) = part.split('-')
+            chroms = chroms + [str(c) for c in range(int(first), int(last)+1)]
+        elif part.strip() != '':
+            chroms.append(part.strip())
+    return chroms
+
+
+def load_manifest(manifest_fn):
+    # one cohort per line: name,VCF,sample list[,PLINK .hwe file]
+    # {chrom} in the VCF and .hwe paths is replaced by the chromosome
+    cohorts = []
+    f1 = open(manifest_fn, 'r')
+    for line in f1.readlines():
+        fn = line.strip().split(',')
+        if fn[0] == '' or fn[0].startswith('#'):
+            continue
+        if len(fn) < 3:
+            logging.error('Cohort manifest lines need a name, a VCF and a sample list: %s' % line.strip())
+            sys.exit(1)
+        hwe = fn[3] if len(fn) > 3 and fn[3] != '' else None
+        if not os.path.exists(fn[2]):
+            logging.error('Sample list %s of cohort %s not found.' % (fn[2], fn[0]))
+            sys.exit(1)
+        cohorts.append((fn[0], fn[1], fn[2], hwe))
+    f1.close()
+    names = [cohort[0] for cohort in cohorts]
+    if len(set(names)) != len(names):
+        logging.error('Cohort names in %s are not unique.' % manifest_fn)
+        sys.exit(1)
+    return cohorts
+
+
+def file_size(fn):
+    return os.path.getsize(fn) if os.path.exists(fn) else 0
+
+
+def build_tasks(cohorts, chroms, outdir, task_cpus, calc_hwe, snpsonly, filters, cache_dir, cache_size):
+    # rsq -> qc per cohort, then overlap -> merge per chromosome
+    tsim = '%s %s' % (sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tsim.py'))
+    cache = '' if cache_dir == None else ' --cache-dir %s --cache-size %s' % (cache_dir, cache_size)
+    tasks = []
+    for chrom in chroms:
+        tempdir = '%s/tmp/chr%s' % (outdir, chrom)
+        chrom_tasks = []
+        qc_fns = []
+        qc_tasks = []
+        mergelist = []
+        # records in the cohorts' VCFs (or their size without an index): large chromosomes are started first
+        size = 0
+        for (name, vcf_pattern, samples, hwe_pattern) in cohorts:
+            vcf = vcf_pattern.replace('{chrom}', chrom)
+            if not os.path.exists(vcf):
+                logging.error('%s not found (cohort %s, chromosome %s).' % (vcf, name, chrom))
+                sys.exit(1)
+            if find_index(vcf) != None:
+                meta = vcf_metadata(vcf)
+                n_samples = len(meta['samples'])
+                n_variants = n_records(meta)
+                size = size + n_variants*max(1, n_samples)
+            else:
+                (n_samples, n_variants) = (0, 0)
+                size = size + file_size(vcf)
+            rsq_fn = '%s/%s/chr%s.rsq.tsv' % (outdir, name, chrom)
+            qc_fn = '%s/%s/chr%s.qc.txt' % (outdir, name, chrom)
+
+            rsq_cmd = '%s rsq -v %s -s %s -o %s -j %s -t %s%s' % (tsim, vcf, samples, rsq_fn, task_cpus, tempdir, cache)
+            if calc_hwe and hwe_pattern == None:
+                rsq_cmd = rsq_cmd + ' --calc-hwe'
+            # dosage blocks of 1000 variants per job (8 byte floats, a few copies) and the interpreter
+            rsq_mem = task_cpus*(1000*n_samples*8*4 + 200*1024**2)
+            rsq_task = Task('%s.chr%s.rsq' % (name, chrom), chrom, 'rsq', rsq_cmd, [], [rsq_fn], task_cpus, rsq_mem)
+
+            qc_cmd = '%s qc -r %s -m %s -o %s -c %s -rf %s -mf %s -ef %s -hf %s%s' % (
+                tsim, rsq_fn, rsq_fn, qc_fn, chrom, filters[0], filters[1], filters[2], filters[3], cache)
+            if hwe_pattern != None:
+                qc_cmd = qc_cmd + ' --hwe %s' % hwe_pattern.replace('{chrom}', chrom)
+            elif calc_hwe:
+                qc_cmd = qc_cmd + ' -hc 6'
+            # the Rsq table is loaded into dictionaries: a few hundred bytes per variant
+            qc_mem = 200*1024**2 + 300*n_variants
+            qc_task = Task('%s.chr%s.qc' % (name, chrom), chrom, 'qc', qc_cmd, [rsq_task], [qc_fn], 1, qc_mem)
+
+            chrom_tasks = chrom_tasks + [rsq_task, qc_task]
+            qc_fns.append(qc_fn)
+            qc_tasks.append(qc_task)
+            mergelist.append('%s,%s,%s' % (vcf, '%s/overlap/chr%s.overlap.txt' % (outdir, chrom), samples))
+
+        list_fn = '%s/overlap/chr%s.qc_lists.txt' % (outdir, chrom)
+        overlap_fn = '%s/overlap/chr%s.overlap.txt' % (outdir, chrom)
+        overlap_cmd = '%s overlap -l %s -c %s -o %s' % (tsim, list_fn, chrom, overlap_fn)
+        overlap_task = Task('chr%s.overlap' % chrom, chrom, 'overlap', overlap_cmd, qc_tasks, [overlap_fn], 1,
+                            200*1024**2)
+
+        mergelist_fn = '%s/merged/chr%s.mergelist.txt' % (outdir, chrom)
+        merged_fn = '%s/merged/chr%s.merged.vcf.gz' % (outdir, chrom)
+        merge_cmd = '%s merge -l %s -c %s -o %s -t %s -j %s%s%s' % (
+            tsim, mergelist_fn, chrom, merged_fn, tempdir, task_cpus, ' -s' if snpsonly else '', cache)
+        merge_task = Task('chr%s.merge' % chrom, chrom, 'merge', merge_cmd, [overlap_task], [merged_fn], task_cpus,
+                          task_cpus*500*1024**2)
+        chrom_tasks = chrom_tasks + [overlap_task, merge_task]
+        for task in chrom_tasks:
+            task.priority = size
+        tasks = tasks + chrom_tasks
+
+        for d in ['%s/%s' % (outdir, cohort[0]) for cohort in cohorts] + [tempdir, outdir + '/overlap', outdir + '/merged']:
+            os.makedirs(d, exist_ok=True)
+        write_list(list_fn, qc_fns)
+        write_list(mergelist_fn, mergelist)
+    return tasks
+
+
+def write_list(fn, lines):
+    # rewritten only if the content changed
+    text = ''.join(['%s\n' % line for line in lines])
+    if os.path.exists(fn):
+        with open(fn) as f1:
+            if f1.read() == text:
+                return
+    with open(fn, 'w') as fo:
+        fo.write(text)
+
+
+def marker(outdir, task):
+    return '%s/done/%s.done' % (outdir, task.name)
+
+
+def find_done(tasks, outdir):
+    # a task is done if it succeeded with the same command, its outputs exist and its inputs are done
+    done = set()
+    for task in tasks:
+        fn = marker(outdir, task)
+        if not os.path.exists(fn) or not all(os.path.exists(out) for out in task.outputs):
+            continue
+        with open(fn) as f1:
+            if f1.read() != task.cmd:
+                continue
+        if all(dep in done for dep in task.deps):
+            done.add(task)
+    return done
+
+
+def schedule(tasks, done, outdir, cpus, memory):
+    # starts ready tasks (inputs done) while they fit in the CPU and memory budgets,
+    # largest chromosomes first and, within a chromosome, later steps first
+    runner = CommandRunner()
+    pending = [task for task in tasks if task not in done]
+    running = []
+    failed = set()
+    used_cpus = 0
+    used_memory = 0
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            ready = [task for task in pending if all(dep in done for dep in task.deps)]
+            ready.sort(key=lambda task: (-task.priority, -STEPS.index(task.step)))
+            for task in ready:
+                fits = used_cpus + task.cpus <= cpus and used_memory + task.memory <= memory
+                if not fits and len(running) > 0:
+                    continue
+                if not fits:
+                    logging.warning('%s needs more than the CPU or memory budget: running it alone.' % task.name)
+                log_fn = '%s/logs/%s.log' % (outdir, task.name)
+                logging.info('Starting %s (%s CPUs, %.1f GB; log: %s)' % (task.name, task.cpus, task.memory/1024**3, log_fn))
+                task.log = open(log_fn, 'w')
+                task.start = datetime.now()
+                task.proc = runner.start(task.cmd, '[%s] ' % task.name, stdout=task.log)
+                pending.remove(task)
+                running.append(task)
+                used_cpus = used_cpus + task.cpus
+                used_memory = used_memory + task.memory
+
+            time.sleep(0.5)
+            for task in list(running):
+                if task.proc.poll() == None:
+                    continue
+                ok = runner.wait(task.proc, task.cmd, '[%s] ' % task.name)
+                task.log.close()
+                running.remove(task)
+                used_cpus = used_cpus - task.cpus
+                used_memory = used_memory - task.memory
+                if ok:
+                    with open(marker(outdir, task), 'w') as fo:
+                        fo.write(task.cmd)
+                    done.add(task)
+                    logging.info('Finished %s (%s)' % (task.name, datetime.now()-task.start))
+                else:
+                    failed.add(task)
+                    logging.error('%s failed, see %s/logs/%s.log' % (task.name, outdir, task.name))
+                    # skip everything depending on it
+                    skipped = [task]
+                    while len(skipped) > 0:
+                        t = skipped.pop()
+                        for other in list(pending):
+                            if t in other.deps:
+                                logging.error('Skipping %s' % other.name)
+                                pending.remove(other)
+                                skipped.append(other)
+    except KeyboardInterrupt:
+        logging.error('Interrupted: stopping the running tasks. Rerun the same command to resume.')
+        runner.stop()
+        sys.exit(1)
+    return failed
+
+
+def run(manifest_fn, outdir, chroms='1-22', cpus=None, memory=None, task_cpus=1, calc_hwe=False, snpsonly=False,
+        filters=(0.99, 0.01, 0.9, 1e-6), cache_dir=None, cache_size=20):
+    start = datetime.now()
+    if cpus == None:
+        cpus = os.cpu_count()
+    if memory == None:
+        memory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')/1024**3
+
+    logging.info('###########################')
+    logging.info('######## Pipeline #########')
+    logging.info('###########################')
+    logging.info('### Arguments')
+    logging.info('Cohort manifest\t%s' % manifest_fn)
+    logging.info('Output directory\t%s' % outdir)
+    logging.info('Chromosomes\t%s' % chroms)
+    logging.info('CPUs\t%s' % cpus)
+    logging.info('Memory (GB)\t%.1f' % memory)
+    logging.info('CPUs per task\t%s' % task_cpus)
+    logging.info('HWE calculated\t%s' % calc_hwe)
+    logging.info('SNPs only\t%s' % snpsonly)
+    logging.info('QC filters (Rsq, MAF, ER2, HWE)\t%s' % ', '.join([str(f) for f in filters]))
+    logging.info('Cache\t%s' % cache_dir)
+
+    cohorts = load_manifest(manifest_fn)
+    logging.info('Cohorts:\n\t%s' % '\n\t'.join([cohort[0] for cohort in cohorts]))
+    for d in [outdir, outdir + '/logs', outdir + '/done']:
+        os.makedirs(d, exist_ok=True)
+
+    logging.info('####################')
+    logging.info('Building tasks...')
+    tasks = build_tasks(cohorts, parse_chroms(chroms), outdir, task_cpus, calc_hwe, snpsonly, filters,
+                        cache_dir, cache_size)
+    done = find_done(tasks, outdir)
+    logging.info('%s tasks, %s already done' % (len(tasks), len(done)))
+
+    logging.info('####################')
+    logging.info('Running tasks...')
+    failed = schedule(tasks, done, outdir, cpus, memory*1024**3)
+
+    logging.info('####################')
+    if len(failed) > 0:
+        logging.error('%s tasks failed: %s' % (len(failed), ', '.join(sorted(task.name for task in failed))))
+        logging.error('Fix the errors and rerun the same command to resume.')
+        sys.exit(1)
+    logging.info('Pipeline done.')
+    logging.info('Merged VCFs saved to:\n\t%s/merged' % outdir)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
@@ -0,0 +1,308 @@
+from datetime import datetime
+import os
+import sys
+import json
+import struct
+import shutil
+import logging
+import subprocess
+
+from bgzf import BgzfWriter
+from variant_key import ID_FORMAT
+
+# binary Rsq table:
+#   magic, header length (uint64), JSON header, then 64-byte aligned arrays
+#   - one float64 array per numeric column ('-' and other placeholders are NaN)
+#   - IDs packed in one byte array, with n+1 int64 offsets into it
+#   - for columns with values not written as str() of a float64, a uint8 array of their format (see text_format),
+#     so that converting back to TSV gives the text written by `rsq`
+MAGIC = b'TSIMRSQ1'
+ALIGN = 64
+MISSING = ('-', '.', 'None', 'NA', 'nan')
+# appended to bgzipped TSVs for the tabix index
+INDEX_COLUMNS = ['CHROM', 'POS']
+
+
+def is_binary(fn):
+    with open(fn, 'rb') as f1:
+        return f1.read(len(MAGIC)) == MAGIC
+
+
+def data_start(header_size):
+    pos = len(MAGIC) + 8 + header_size
+    return pos + (-pos) % ALIGN
+
+
+def parse_value(x):
+    try:
+        return float(x)
+    except ValueError:
+        if x in MISSING:
+            return float('nan')
+        logging.error('%s is not a number. Only the first column (variant ID) can be text.' % x)
+        sys.exit(1)
+
+
+class BinaryWriter:
+    # file-like: takes the TSV text written by `rsq` and stores it column by column
+    def __init__(self, fn):
+        self.name = fn
+        self.columns = None
+        self.rest = ''
+        self.n = 0
+        self.id_size = 0
+        self.temps = []
+        self.formats = []
+        self.has_formats = []
+        self.extra = 0
+
+    def write(self, text):
+        import numpy as np
+
+        lines = (self.rest + text).split('\n')
+        self.rest = lines.pop()
+        if len(lines) == 0:
+            return
+        if self.columns == None:
+            self.columns = lines.pop(0).split('\t')
+            if self.columns[-2:] == INDEX_COLUMNS:
+                # taken from the ID again when converted back
+                self.columns = self.columns[:-2]
+                self.extra = 2
+            self.temps = [open('%s.%s.tmp' % (self.name, k), 'wb') for k in range(len(self.columns)+1)]
+            self.formats = [open('%s.%s.fmt.tmp' % (self.name, k), 'wb') for k in range(1, len(self.columns))]
+            self.has_formats = [False for fh in self.formats]
+            np.array([0], dtype='<i8').tofile(self.temps[1])
+
+        rows = [line.split('\t') for line in lines if line != '']
+        for row in rows:
+            if len(row) != len(self.columns) + self.extra:
+                logging.error('Expected %s columns, found %s: %s' % (len(self.columns) + self.extra, len(row), '\t'.join(row)))
+                sys.exit(1)
+
+        ids = [row[0].encode() for row in rows]
+        ends = self.id_size + np.cumsum([len(x) for x in ids], dtype='<i8')
+        self.temps[0].write(b''.join(ids))
+        ends.tofile(self.temps[1])
+        if len(ids) > 0:
+            self.id_size = int(ends[-1])
+        for k in range(1, len(self.columns)):
+            texts = [row[k] for row in rows]
+            values = [parse_value(x) for x in texts]
+            np.array(values, dtype='<f8').tofile(self.temps[k+1])
+            formats = np.zeros(len(texts), dtype=np.uint8)
+            # only integers and numbers in scientific notation can be written differently
+            for i in [i for (i, x) in enumerate(texts) if 'e' in x or x.lstrip('-').isdigit()]:
+                formats[i] = text_format(texts[i], values[i])
+            formats.tofile(self.formats[k-1])
+            self.has_formats[k-1] = self.has_formats[k-1] or bool(formats.any())
+        self.n = self.n + len(rows)
+
+    def close(self):
+        if self.rest != '':
+            self.write('\n')
+        if self.columns == None:
+            logging.error('Nothing written to %s' % self.name)
+            sys.exit(1)
+        for fh in self.temps + self.formats:
+            fh.close()
+        # formats only for the columns that need them
+        formats = {}
+        for (k, fh) in enumerate(self.formats):
+            if self.has_formats[k]:
+                formats[self.columns[k+1]] = len(self.temps)
+                self.temps.append(fh)
+            else:
+                os.remove(fh.name)
+
+        # ID bytes, ID offsets, one array per numeric column, then the formats
+        sizes = [os.path.getsize(fh.name) for fh in self.temps]
+        offsets = []
+        pos = 0
+        for size in sizes:
+            offsets.append(pos)
+            pos = pos + size + (-size) % ALIGN
+        blob = json.dumps({'n': self.n, 'columns': self.columns, 'offsets': offsets, 'sizes': sizes,
+                           'formats': formats}).encode()
+
+        with open(self.name, 'wb') as fo:
+            fo.write(MAGIC)
+            fo.write(struct.pack('<Q', len(blob)))
+            fo.write(blob)
+            base = data_start(len(blob))
+            for (fh, off) in zip(self.temps, offsets):
+                fo.write(b'\0' * (base + off - fo.tell()))
+                with open(fh.name, 'rb') as f1:
+                    shutil.copyfileobj(f1, fo)
+                os.remove(fh.name)
+
+    def abort(self):
+        for fh in self.temps + self.formats:
+            fh.close()
+            if os.path.exists(fh.name):
+                os.remove(fh.name)
+        self.temps = []
+        self.formats = []
+
+
+def add_positions(text):
+    # CHROM and POS of each variant (from its ID, e.g. chr22:16050075:A:G) appended to lines of the Rsq TSV
+    lines = []
+    for line in text.split('\n')[:-1]:
+        var = line.split('\t', 1)[0]
+        m = ID_FORMAT.match(var)
+        if var == 'ID':
+            lines.append('%s\t%s\n' % (line, '\t'.join(INDEX_COLUMNS)))
+        elif m == None:
+            lines.append('%s\t-\t-\n' % line)
+        else:
+            lines.append('%s\t%s\t%s\n' % (line, var[:m.end(1)], m.group(2)))
+    return ''.join(lines)
+
+
+class IndexedWriter(BgzfWriter):
+    # bgzipped Rsq TSV with a tabix index on the appended CHROM and POS columns
+    def __init__(self, fn):
+        BgzfWriter.__init__(self, fn, transform=add_positions)
+
+    def close(self):
+        if self.fh.closed:
+            return
+        BgzfWriter.close(self)
+        index_table(self.name)
+
+
+def index_table(fn):
+    import gzip
+
+    with gzip.open(fn, 'rt') as f1:
+        n = len(f1.readline().split('\t'))
+    cmd = ['tabix', '-f', '-s', str(n-1), '-b', str(n), '-e', str(n), '-S', '1', fn]
+    try:
+        returncode = subprocess.run(cmd).returncode
+    except FileNotFoundError:
+        logging.warning('tabix not found on PATH, %s left unindexed.' % fn)
+        return
+    if returncode != 0:
+        logging.warning('%s could not be indexed with tabix (variant IDs need to be chrom:pos:ref:alt).' % fn)
+
+
+def open_output(fn, binary):
+    # binary table, bgzipped and indexed TSV (.gz) or TSV
+    if binary:
+        return BinaryWriter(fn)
+    if fn.endswith('.gz'):
+        return IndexedWriter(fn)
+    return open(fn, 'w')
+
+
+def open_table(fn):
+    import numpy as np
+
+    with open(fn, 'rb') as f1:
+        if f1.read(len(MAGIC)) != MAGIC:
+            logging.error('%s is not a binary Rsq table.' % fn)
+            sys.exit(1)
+        (size,) = struct.unpack('<Q', f1.read(8))
+        header = json.loads(f1.read(size))
+
+    n = header['n']
+    base = data_start(size)
+    offsets = [base + off for off in header['offsets']]
+    table = {'n': n, 'columns': header['columns'], 'values': {}, 'formats': {}}
+    table['id_data'] = np.memmap(fn, dtype=np.uint8, mode='r', offset=offsets[0], shape=(header['sizes'][0],)) \
+        if header['sizes'][0] > 0 else np.zeros(0, dtype=np.uint8)
+    table['id_offsets'] = np.memmap(fn, dtype='<i8', mode='r', offset=offsets[1], shape=(n+1,))
+    for (k, name) in enumerate(header['columns'][1:]):
+        if n > 0:
+            table['values'][name] = np.memmap(fn, dtype='<f8', mode='r', offset=offsets[k+2], shape=(n,))
+        else:
+            table['values'][name] = np.zeros(0)
+    for (name, k) in header.get('formats', {}).items():
+        table['formats'][name] = np.memmap(fn, dtype=np.uint8, mode='r', offset=offsets[k], shape=(n,))
+    return table
+
+
+def column(table, col):
+    # col: 0-based column number, as in the TSV
+    if col <= 0 or col >= len(table['columns']):
+        logging.error('Column %s is not a numeric column of the binary table (columns: %s).' % (col+1, ', '.join(table['columns'])))
+        sys.exit(1)
+    return table['values'][table['columns'][col]]
+
+
+def get_ids(table, rows):
+    data = table['id_data']
+    offsets = table['id_offsets']
+    return [data[offsets[i]:offsets[i+1]].tobytes().decode() for i in rows]
+
+
+def text_format(text, x):
+    # 0: str() of the float64 value, 1: integer (e.g. the 0 AAF of monomorphic variants),
+    # 2: str() of the float32 value (AAF and RSQ of `rsq`, e.g. 1e-04 for 0.0001)
+    import numpy as np
+
+    if text.lstrip('-').isdigit():
+        return 1
+    if text != str(x) and text == str(np.float32(x)):
+        return 2
+    return 0
+
+
+def format_value(x, fmt=0):
+    if x != x:
+        return '-'
+    if fmt == 1:
+        return '%d' % x
+    if fmt == 2:
+        import numpy as np
+        return str(np.float32(x))
+    return str(x)
+
+
+def format_column(table, name, start, end):
+    values = table['values'][name][start:end].tolist()
+    if name not in table['formats']:
+        return [format_value(x) for x in values]
+    return [format_value(x, fmt) for (x, fmt) in zip(values, table['formats'][name][start:end].tolist())]
+
+
+def write_tsv(table, fo, step=500000):
+    fo.write('\t'.join(table['columns']) + '\n')
+    for start in range(0, table['n'], step):
+        end = min(start+step, table['n'])
+        ids = get_ids(table, range(start, end))
+        cols = [format_column(table, name, start, end) for name in table['columns'][1:]]
+        fo.write(''.join(['\t'.join(row) + '\n' for row in zip(ids, *cols)]))
+
+
+def run(in_fn, out_fn):
+    start = datetime.now()
+
+    logging.info('###########################')
+    logging.info('#### Convert Rsq table ####')
+    logging.info('###########################')
+    logging.info('### Arguments')
+    logging.info('Input\t%s' % in_fn)
+    logging.info('Output\t%s' % out_fn)
+
+    logging.info('####################')
+    if is_binary(in_fn):
+        logging.info('Converting binary table to TSV...')
+        table = open_table(in_fn)
+        with open_output(out_fn, False) as fo:
+            write_tsv(table, fo)
+        n = table['n']
+    else:
+        import gzip
+
+        logging.info('Converting TSV to binary table...')
+        fo = BinaryWriter(out_fn)
+        with gzip.open(in_fn, 'rt') if in_fn.endswith('.gz') else open(in_fn) as f1:
+            shutil.copyfileobj(f1, fo)
+        fo.close()
+        n = fo.n
+
+    logging.info('%s variants converted' % n)
+    logging.info('Converted table saved to:\n\t%s' % out_fn)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
@@ -0,0 +1,197 @@
+from datetime import datetime
+import os
+import sys
+import argparse
+import subprocess
+import logging
+
+from hwe import hwe_exact
+
+# deterministic Minimac4-style imputed VCFs for benchmarks: GT:DS:HDS, INFO AF/MAF/R2 (and ER2 for typed variants),
+# with matching sample lists and PLINK --hardy files
+# cohorts share one set of sites (each keeps ~90%), so that qc, overlap and merge have work to do
+BASES = 'ACGT'
+LEVELS = 101 # haploid dosages are written with 2 decimals
+
+
+def simulate_sites(n_variants, seed, start=16050000):
+    # (pos, ref, alt, af) sorted by position; mostly SNPs, some indels and split multiallelic sites
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    sites = []
+    pos = start
+    while len(sites) < n_variants:
+        pos = pos + int(rng.integers(1, 200))
+        ref = BASES[rng.integers(4)]
+        kind = rng.random()
+        if kind < 0.04:
+            alts = [ref + ''.join(BASES[b] for b in rng.integers(4, size=rng.integers(1, 6)))]
+        elif kind < 0.08:
+            ref = ref + ''.join(BASES[b] for b in rng.integers(4, size=rng.integers(1, 6)))
+            alts = [ref[0]]
+        else:
+            others = [b for b in BASES if b != ref]
+            alts = [others[k] for k in rng.permutation(3)[:2 if kind > 0.97 else 1]]
+        for alt in alts:
+            # allele frequencies skewed towards rare variants, as in imputed data
+            sites.append((pos, ref, alt, float(rng.beta(0.4, 2.5))))
+    return sites[:n_variants]
+
+
+def dosage_cells():
+    # FORMAT cell for each pair of quantized haploid dosages (index LEVELS*h1 + h2)
+    import numpy as np
+
+    cells = []
+    for h1 in range(LEVELS):
+        for h2 in range(LEVELS):
+            gt = '%d|%d' % (h1 > LEVELS//2, h2 > LEVELS//2)
+            cells.append('%s:%s:%s,%s' % (gt, dosage_text(h1+h2), dosage_text(h1), dosage_text(h2)))
+    return np.array(cells, dtype=object)
+
+
+def dosage_text(level):
+    return ('%.2f' % (level/(LEVELS-1))).rstrip('0').rstrip('.')
+
+
+def vcf_header(chrom, samples):
+    return ''.join([
+        '##fileformat=VCFv4.1\n',
+        '##filedate=2024.1.1\n',
+        '##source=tsim synthetic (Minimac4 style)\n',
+        '##contig=<ID=chr%s>\n' % chrom,
+        '##FILTER=<ID=PASS,Description="All filters passed">\n',
+        '##INFO=<ID=AF,Number=1,Type=Float,Description="Estimated Alternate Allele Frequency">\n',
+        '##INFO=<ID=MAF,Number=1,Type=Float,Description="Estimated Minor Allele Frequency">\n',
+        '##INFO=<ID=R2,Number=1,Type=Float,Description="Estimated Imputation Accuracy (R-square)">\n',
+        '##INFO=<ID=ER2,Number=1,Type=Float,Description="Empirical (Leave-One-Out) R-square (available only for genotyped variants)">\n',
+        '##INFO=<ID=IMPUTED,Number=0,Type=Flag,Description="Marker was imputed but NOT genotyped">\n',
+        '##INFO=<ID=TYPED,Number=0,Type=Flag,Description="Marker was genotyped AND imputed">\n',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n',
+        '##FORMAT=<ID=DS,Number=1,Type=Float,Description="Estimated Alternate Allele Dosage : [P(0/1)+2*P(1/1)]">\n',
+        '##FORMAT=<ID=HDS,Number=2,Type=Float,Description="Estimated Haploid Alternate Allele Dosage">\n',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n' % '\t'.join(samples)])
+
+
+HWE_TESTS = ['ALL', 'AFF', 'UNAFF']
+
+
+def genotype_counts(gts, cases):
+    # (hom alt, het, hom ref) of the hard calls (0, 1, 2 alt alleles) for each PLINK test
+    return [(int((g == 2).sum()), int((g == 1).sum()), int((g == 0).sum())) for g in [gts, gts[cases], gts[~cases]]]
+
+
+def write_hwe(fh, rows):
+    # PLINK --hardy rows for (var, ref, alt, counts), with the p-values of all variants computed together
+    import numpy as np
+
+    fh.write('%4s %20s %8s %4s %4s %20s %8s %8s %12s\n' % ('CHR', 'SNP', 'TEST', 'A1', 'A2', 'GENO', 'O(HET)', 'E(HET)', 'P'))
+    if len(rows) == 0:
+        return
+    counts = np.array([row[3] for row in rows]) # variants x tests x (hom alt, het, hom ref)
+    pvalues = [hwe_exact(counts[:, t, 1], counts[:, t, 2], counts[:, t, 0]) for t in range(len(HWE_TESTS))]
+    for (i, (var, ref, alt, geno)) in enumerate(rows):
+        for (t, test) in enumerate(HWE_TESTS):
+            (hom_alt, het, hom_ref) = geno[t]
+            n = max(1, hom_alt + het + hom_ref)
+            p_alt = (2*hom_alt + het)/(2.0*n)
+            fh.write('%4s %20s %8s %4s %4s %20s %8.4f %8.4f %12.4g\n' % (
+                chrom_of(var), var, test, alt, ref, '%s/%s/%s' % geno[t], het/float(n), 2*p_alt*(1-p_alt), pvalues[t][i]))
+
+
+def chrom_of(var):
+    return var.split(':')[0].replace('chr', '')
+
+
+def write_cohort(prefix, sites, chrom, name, n_samples, seed, keep=0.9, typed=0.05):
+    # prefix.vcf.gz (+ .tbi), prefix.samples.txt and prefix.hwe for one cohort
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    cells = dosage_cells()
+    samples = ['%s_%05d' % (name, i) for i in range(n_samples)]
+    # first half of the samples are cases
+    cases = np.arange(n_samples) < n_samples//2
+
+    vcf_fn = prefix + '.vcf'
+    fo = open(vcf_fn, 'w')
+    fo.write(vcf_header(chrom, samples))
+    hwe_rows = []
+    for (pos, ref, alt, af) in sites:
+        if rng.random() >= keep:
+            continue
+        # imputation quality: how much of the true haplotype shows in the dosage
+        quality = rng.beta(6, 1)
+        truth = rng.random((n_samples, 2)) < af
+        hds = quality*truth + (1-quality)*af + rng.normal(0, 0.1*(1-quality), (n_samples, 2))
+        level = np.rint(np.clip(hds, 0, 1)*(LEVELS-1)).astype(np.int64)
+        hds = level/(LEVELS-1.0)
+
+        p = hds.mean()
+        r2 = hds.var()/(p*(1-p)) if 0 < p < 1 else 0
+        info = 'AF=%.5f;MAF=%.5f;R2=%.5f' % (p, min(p, 1-p), min(r2, 1))
+        if rng.random() < typed:
+            er2 = np.corrcoef(truth.reshape(-1), hds.reshape(-1))[0, 1]**2 if truth.any() and not truth.all() else 0
+            info = info + ';ER2=%.5f;TYPED' % er2
+        else:
+            info = info + ';IMPUTED'
+        var = 'chr%s:%s:%s:%s' % (chrom, pos, ref, alt)
+        fo.write('chr%s\t%s\t%s\t%s\t%s\t.\tPASS\t%s\tGT:DS:HDS\t%s\n' % (
+            chrom, pos, var, ref, alt, info, '\t'.join(cells[level[:, 0]*LEVELS + level[:, 1]])))
+        hwe_rows.append((var, ref, alt, genotype_counts((level > LEVELS//2).sum(axis=1), cases)))
+    fo.close()
+    with open(prefix + '.hwe', 'w') as fh:
+        write_hwe(fh, hwe_rows)
+
+    # all samples but every 20th
+    with open(prefix + '.samples.txt', 'w') as fs:
+        fs.write(''.join(['%s\n' % y for (i, y) in enumerate(samples) if i % 20 != 19]))
+
+    for cmd in [['bgzip', '-f', vcf_fn], ['tabix', '-fp', 'vcf', vcf_fn + '.gz']]:
+        if subprocess.run(cmd).returncode != 0:
+            logging.error('Command failed: %s' % ' '.join(cmd))
+            sys.exit(1)
+    return len(hwe_rows)
+
+
+def run(outdir, n_cohorts=2, n_variants=100000, n_samples=500, chrom='22', seed=1):
+    # cohort files are named c<k>.vcf.gz, c<k>.samples.txt and c<k>.hwe
+    start = datetime.now()
+    logging.info('####################')
+    logging.info('Simulating %s cohorts: %s sites, %s samples each, chromosome %s, seed %s' % (
+        n_cohorts, n_variants, n_samples, chrom, seed))
+    os.makedirs(outdir, exist_ok=True)
+    sites = simulate_sites(n_variants, seed)
+    prefixes = []
+    for k in range(n_cohorts):
+        prefix = '%s/c%s' % (outdir, k)
+        n = write_cohort(prefix, sites, chrom, 'C%s' % k, n_samples, seed*1000 + k)
+        logging.info('%s.vcf.gz: %s variants' % (prefix, n))
+        prefixes.append(prefix)
+    logging.info('Simulation runtime: ' + str(datetime.now()-start))
+    return prefixes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='synthetic.py',
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     description='Write deterministic Minimac4-style imputed VCFs (GT:DS:HDS, AF/MAF/R2/ER2),\nwith sample lists and PLINK --hardy files, for benchmarks.')
+    parser.add_argument('-o', '--outdir', required=True,
+                        help='output directory (c<k>.vcf.gz, c<k>.samples.txt, c<k>.hwe)')
+    parser.add_argument('-k', '--cohorts', default=2, type=int,
+                        help='number of cohorts [default: 2]')
+    parser.add_argument('-v', '--variants', default=100000, type=int,
+                        help='number of sites before sampling (each cohort keeps ~90%%) [default: 100000]')
+    parser.add_argument('-n', '--samples', default=500, type=int,
+                        help='number of samples per cohort [default: 500]')
+    parser.add_argument('-c', '--chrom', default='22',
+                        help='chromosome [default: 22]')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='random seed [default: 1]')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout,
+                        format='%(levelname)s %(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    run(args.outdir, args.cohorts, args.variants, args.samples, args.chrom, args.seed)
@@ -4,148 +4,457 @@ import logging
 import argparse
 
 
-global_parser = argparse.ArgumentParser(prog='tsim.py',
-                                  description='##########################################\n### Two-Stage Imputation Method ###\n##########################################\n\nConducts per chromosome analysis.',
-                                  formatter_class=argparse.RawTextHelpFormatter,
-                                  prefix_chars='-',
-                                  argument_default=None,
-                                  add_help=True,
-                                  allow_abbrev=True,
-                                  exit_on_error=True)
-subparsers = global_parser.add_subparsers(title='subcommands',
-                                          dest='command',
-                                          description=None, 
-                                          required=True)
-
-global_parser.add_argument('--version', action='version', version='%(prog)s 1.0 (2023)')
-
-
-rsq_parser = subparsers.add_parser('rsq', 
-                                   formatter_class=argparse.RawTextHelpFormatter,
-                                   description='Calculates Minimac4 rsq from imputed dosages.\nOutputs TSV containing variant ID, AAF, recalculated RSQ, original Rsq, and empirical Rsq (if genotyped).\nParticularly useful if you only want to analyze a subset of the samples that were imputed.',
-                                   help='calculate Rsq')
-rsq_parser.add_argument('-v', '--vcf',
-                        required=True,
-                        help='VCF containing dosage info')
-rsq_parser.add_argument('-o', '--output',
-                        required=True,
-                        help='output file (TSV)')
-rsq_parser.add_argument('-s', '--samples',
-                        help='file containing list of samples to include in calculation')
-rsq_parser.add_argument('-p', '--pythonlib', default='',
-                        help='specify python site-packages location')
-rsq_parser.add_argument('--verbose', action='store_true',
-                        help='run with more verbose logging')
-                        
-
-qc_parser = subparsers.add_parser('qc', 
-                                  formatter_class=argparse.RawTextHelpFormatter,
-                                  description='Perform variant QC based on Rsq, empirical Rsq (if genotyped), allele frequency, and HWE.\nOutputs file containing variants passing filters, one per line.',
-                                  help='perform variant QC')
-qc_parser.add_argument('-r', '--rsq', required=True,
-                       help='TSV containing Rsq and empirical rsq calculations (can be gzipped)')
-qc_parser.add_argument('-m', '--maf', required=True,
-                       help='TSV containing allele frequency (can be gzipped)')
-qc_parser.add_argument('-o', '--output', required=True,
-                       help='output file (txt)')
-qc_parser.add_argument('-c', '--chrom', required=True,
-                       help='chromosome of analysis')
-qc_parser.add_argument('--hwe', default=None,
-                       help='file containing PLINK `--hardy` output')
-qc_parser.add_argument('-rf', '--rfilter', default=0.99, type=float,
-                       help='Rsq filter [default: 0.99]')
-qc_parser.add_argument('-mf', '--mfilter', default=0.01, type=float,
-                       help='MAF filter [default: 0.01]')
-qc_parser.add_argument('-ef', '--efilter', default=0.9, type=float,
-                       help='empirical Rsq filter [default: 0.90]')
-qc_parser.add_argument('-hf', '--hfilter', default=1e-6, type=float,
-                       help='HWE p-value filter [default: 1e-6]')
-qc_parser.add_argument('-rc', '--rcol', default=3, type=int,
-                       help='column # containing Rsq (1-based) [default: 3]')
-qc_parser.add_argument('-mc', '--mcol', default=2, type=int,
-                       help='column # containing allele frequency (1-based) [default: 2]')
-qc_parser.add_argument('-ec', '--ecol', default=5, type=int,
-                       help='column # containing empirical Rsq (1-based) [default: 5]')
-qc_parser.add_argument('-rvc', '--rvarcol', default=1, type=int,
-                       help='column # containing variant ID in rsq file (1-based) [default: 1]')
-qc_parser.add_argument('-mvc', '--mvarcol', default=1, type=int,
-                       help='column # containing variant ID in maf file (1-based) [default: 1]')
-qc_parser.add_argument('-nc', '--nocases', action='store_true',
-                       help='if used, indicates there are no cases in QC (relevant for HWE filtering)')
-qc_parser.add_argument('--verbose', action='store_true',
-                       help='run with more verbose logging')
-
-
-overlap_parser = subparsers.add_parser('overlap', 
+def build_parser():
+    global_parser = argparse.ArgumentParser(prog='tsim.py',
+                                      description='##########################################\n### Two-Stage Imputation Method ###\n##########################################\n\nConducts per chromosome analysis.',
+                                      formatter_class=argparse.RawTextHelpFormatter,
+                                      prefix_chars='-',
+                                      argument_default=None,
+                                      add_help=True,
+                                      allow_abbrev=True,
+                                      exit_on_error=True)
+    subparsers = global_parser.add_subparsers(title='subcommands',
+                                              dest='command',
+                                              description=None, 
+                                              required=True)
+
+    global_parser.add_argument('--version', action='version', version='%(prog)s 1.0 (2023)')
+    global_parser.add_argument('--metrics', default=None, metavar='FILE',
+                               help='write per-stage wall/CPU time, records/sec, bytes read/written, peak RSS\nand bcftools/tabix command timings to this JSON file')
+    global_parser.add_argument('--profile', default=None, metavar='FILE',
+                               help='run under cProfile and save the stats to this file (see also --profile-stage)')
+    global_parser.add_argument('--profile-stage', default=None, metavar='NAME',
+                               help='profile only the stage NAME (e.g. rsq, qc, overlap, merge) [default: whole run]')
+
+
+    rsq_parser = subparsers.add_parser('rsq', 
                                        formatter_class=argparse.RawTextHelpFormatter,
-                                       description='Find variant overlap between multiple cohorts.\nOutputs file containing variants present in both cohorts, one per line.',
-                                       help='find variant overlap')
-overlap_parser.add_argument('-l', '--varlist', required=True,
-                            help='file containing list of variant lists to overlap')
-overlap_parser.add_argument('-o', '--output', required=True,
-                            help='output file (txt)')
-overlap_parser.add_argument('-c', '--chrom', required=True,
-                            help='chromosome of analysis')
-
-
-merge_parser = subparsers.add_parser('merge', 
-                                     formatter_class=argparse.RawTextHelpFormatter,
-                                     description='Merge VCF files from multiple cohorts based on variant overlap.\nOutputs merged VCF file.',
-                                     help='merge VCF files')
-merge_parser.add_argument('-l', '--list', required=True,
-                          help='common-separated file contianing list of VCFs to merge, variant lists to merge on, and samples to include for each file. Column 1 = VCF files, Column 2 = variant lists, Column 3 = sample lists.')
-merge_parser.add_argument('-o', '--output', required=True,
-                          help='output VCF')
-merge_parser.add_argument('-c', '--chrom', required=True,
-                          help='chromosome of analysis')
-merge_parser.add_argument('-t', '--tempdir', default=os.getcwd(),
-                          help='directory for temporary files [default is current working directory]')
-merge_parser.add_argument('-s', '--snpsonly', action='store_true',
-                          help='filter for SNPs only')
-merge_parser.add_argument('-p', '--pythonlib', default='',
-                        help='specify python site-packages location')
-
-
-args = global_parser.parse_args()
-
-
-logfmt_str = '%(levelname)s %(asctime)s: %(message)s'
-datefmt_str = '%Y-%m-%d %H:%M:%S'
-logging.basicConfig(stream=sys.stdout,
-            format=logfmt_str, datefmt=datefmt_str,
-            level=logging.INFO)
-logger = logging.getLogger()
-
-if args.command == 'rsq':
-    import calculate_rsq
-    
-    if args.verbose:
-        logging.info('Verbosity on')
-        logger.setLevel('DEBUG')
-    calculate_rsq.run(args.vcf, args.output, args.samples, args.pythonlib)
-    
-if args.command == 'qc':
-    import variant_qc
-    
-    if args.verbose:
-        logging.info('Verbosity on')
-        logger.setLevel('DEBUG')
-    variant_qc.run(args.chrom, args.rsq, args.maf, args.hwe, args.output,
-                   args.rfilter, args.mfilter, args.efilter, args.hfilter,
-                   args.rcol, args.mcol, args.ecol, args.rvarcol, args.mvarcol, 
-                   args.nocases)
-
-if args.command == 'overlap':
-    import overlap
-    
-    # no debug logging
-    
-    overlap.run(args.varlist, args.chrom, args.output)
-    
-if args.command == 'merge':
-    import merge
-    
-    # no debug logging
-    
-    merge.run(args.chrom, args.list, args.output, args.tempdir, args.snpsonly, args.pythonlib)
+                                       description='Calculates Minimac4 rsq from imputed dosages.\nOutputs TSV containing variant ID, AAF, recalculated RSQ, original Rsq, and empirical Rsq (if genotyped).\nParticularly useful if you only want to analyze a subset of the samples that were imputed.',
+                                       help='calculate Rsq')
+    rsq_parser.add_argument('-v', '--vcf',
+                            required=True,
+                            help='VCF containing dosage info (or a Minimac4 .info/.info.gz file, see --info-only,\nor a dosage matrix written by `dosage-matrix`)')
+    rsq_parser.add_argument('-o', '--output',
+                            required=True,
+                            help='output file (TSV); bgzipped with a tabix index if it ends with .gz')
+    rsq_parser.add_argument('-s', '--samples',
+                            help='file containing list of samples to include in calculation')
+    rsq_parser.add_argument('--subsets',
+                            help='comma-separated file listing named sample subsets (Column 1 = name, Column 2 = sample list).\nRsq is calculated for every subset in one pass over the VCF.')
+    rsq_parser.add_argument('--wide', action='store_true',
+                            help='with --subsets, write one wide TSV instead of one TSV per subset')
+    rsq_parser.add_argument('--info-only', action='store_true',
+                            help='without a sample subset, use AF/R2/ER2 from INFO instead of decoding dosages (much faster)')
+    rsq_parser.add_argument('--binary', action='store_true',
+                            help='write a binary columnar table instead of a TSV (see `rsq-convert`)')
+    rsq_parser.add_argument('--calc-hwe', action='store_true',
+                            help='add exact HWE p-values from the genotypes (GT) of all samples (column HWE_ALL)')
+    rsq_parser.add_argument('--hwe-controls', default=None,
+                            help='with --calc-hwe, file containing list of control samples; adds HWE_UNAFF')
+    rsq_parser.add_argument('--hwe-midp', action='store_true',
+                            help='with --calc-hwe, use mid-p adjusted p-values')
+    rsq_parser.add_argument('-b', '--block-size', default=1000, type=int,
+                            help='number of variants processed together [default: 1000]')
+    rsq_parser.add_argument('-j', '--jobs', '--threads', default=1, type=int,
+                            help='number of processes; splits the VCF into regions using its tabix index [default: 1]')
+    rsq_parser.add_argument('--decompress-threads', default=0, type=int,
+                            help='htslib threads decompressing the VCF (per job), with blocks of variants read ahead\nin a background thread [default: 0, read in the main thread]')
+    rsq_parser.add_argument('-t', '--tempdir', default=os.getcwd(),
+                            help='directory for per-region temporary files [default is current working directory]')
+    rsq_parser.add_argument('--cache-dir', default=None,
+                            help='directory caching outputs between runs, keyed by a hash of the inputs and options [default: no cache]')
+    rsq_parser.add_argument('--cache-size', default=20, type=float,
+                            help='size limit of the cache directory in GB; least recently used results are removed [default: 20]')
+    rsq_parser.add_argument('-p', '--pythonlib', default='',
+                            help='specify python site-packages location')
+    rsq_parser.add_argument('--verbose', action='store_true',
+                            help='run with more verbose logging')
+
+
+    qc_parser = subparsers.add_parser('qc', 
+                                      formatter_class=argparse.RawTextHelpFormatter,
+                                      description='Perform variant QC based on Rsq, empirical Rsq (if genotyped), allele frequency, and HWE.\nOutputs file containing variants passing filters, one per line.',
+                                      help='perform variant QC')
+    qc_parser.add_argument('-r', '--rsq', required=True,
+                           help='TSV containing Rsq and empirical rsq calculations (can be gzipped or a binary Rsq table)')
+    qc_parser.add_argument('-m', '--maf', required=True,
+                           help='TSV containing allele frequency (can be gzipped or a binary Rsq table)')
+    qc_parser.add_argument('-o', '--output', required=True,
+                           help='output file (txt); bgzipped if it ends with .gz')
+    qc_parser.add_argument('-c', '--chrom', required=True,
+                           help='chromosome of analysis')
+    qc_parser.add_argument('--hwe', default=None,
+                           help='file containing PLINK `--hardy` output')
+    qc_parser.add_argument('-hc', '--hcol', default=None, type=int,
+                           help='column # containing HWE p-values in rsq file, from `rsq --calc-hwe` (1-based; instead of --hwe)')
+    qc_parser.add_argument('-rf', '--rfilter', default=0.99, type=float,
+                           help='Rsq filter [default: 0.99]')
+    qc_parser.add_argument('-mf', '--mfilter', default=0.01, type=float,
+                           help='MAF filter [default: 0.01]')
+    qc_parser.add_argument('-ef', '--efilter', default=0.9, type=float,
+                           help='empirical Rsq filter [default: 0.90]')
+    qc_parser.add_argument('-hf', '--hfilter', default=1e-6, type=float,
+                           help='HWE p-value filter [default: 1e-6]')
+    qc_parser.add_argument('-rc', '--rcol', default=3, type=int,
+                           help='column # containing Rsq (1-based) [default: 3]')
+    qc_parser.add_argument('-mc', '--mcol', default=2, type=int,
+                           help='column # containing allele frequency (1-based) [default: 2]')
+    qc_parser.add_argument('-ec', '--ecol', default=5, type=int,
+                           help='column # containing empirical Rsq (1-based) [default: 5]')
+    qc_parser.add_argument('-rvc', '--rvarcol', default=1, type=int,
+                           help='column # containing variant ID in rsq file (1-based) [default: 1]')
+    qc_parser.add_argument('-mvc', '--mvarcol', default=1, type=int,
+                           help='column # containing variant ID in maf file (1-based) [default: 1]')
+    qc_parser.add_argument('-nc', '--nocases', action='store_true',
+                           help='if used, indicates there are no cases in QC (relevant for HWE filtering)')
+    qc_parser.add_argument('--stream', action='store_true',
+                           help='join the inputs as they are read (constant memory) if sorted by position, as written by `rsq`\n(variant IDs chr:pos:ref:alt); falls back to loading them otherwise')
+    qc_parser.add_argument('--cache-dir', default=None,
+                           help='directory caching outputs between runs, keyed by a hash of the inputs and options [default: no cache]')
+    qc_parser.add_argument('--cache-size', default=20, type=float,
+                           help='size limit of the cache directory in GB; least recently used results are removed [default: 20]')
+    qc_parser.add_argument('--verbose', action='store_true',
+                           help='run with more verbose logging')
+
+
+    sweep_parser = subparsers.add_parser('qc-sweep', 
+                                         formatter_class=argparse.RawTextHelpFormatter,
+                                         description='Evaluate a grid of Rsq, MAF, empirical Rsq and HWE filters on inputs loaded once.\nOutputs TSV with the number of variants failing each filter and passing all filters for every combination.\nOptionally writes the variants passing one chosen combination (same as `qc`).',
+                                         help='count variants passing a grid of QC filters')
+    sweep_parser.add_argument('-r', '--rsq', required=True,
+                              help='TSV containing Rsq and empirical rsq calculations (can be gzipped or a binary Rsq table)')
+    sweep_parser.add_argument('-m', '--maf', required=True,
+                              help='TSV containing allele frequency (can be gzipped or a binary Rsq table)')
+    sweep_parser.add_argument('-o', '--output', required=True,
+                              help='output file (TSV of pass counts)')
+    sweep_parser.add_argument('-c', '--chrom', required=True,
+                              help='chromosome of analysis')
+    sweep_parser.add_argument('--hwe', default=None,
+                              help='file containing PLINK `--hardy` output')
+    sweep_parser.add_argument('-hc', '--hcol', default=None, type=int,
+                              help='column # containing HWE p-values in rsq file, from `rsq --calc-hwe` (1-based; instead of --hwe)')
+    sweep_parser.add_argument('-rf', '--rfilter', default='0.99',
+                              help='comma-separated Rsq filters [default: 0.99]')
+    sweep_parser.add_argument('-mf', '--mfilter', default='0.01',
+                              help='comma-separated MAF filters [default: 0.01]')
+    sweep_parser.add_argument('-ef', '--efilter', default='0.9',
+                              help='comma-separated empirical Rsq filters [default: 0.90]')
+    sweep_parser.add_argument('-hf', '--hfilter', default='1e-6',
+                              help='comma-separated HWE p-value filters [default: 1e-6]')
+    sweep_parser.add_argument('--point', default=None,
+                              help='Rsq,MAF,ER2,HWE filters whose passing variants are written to --passing')
+    sweep_parser.add_argument('--passing', default=None,
+                              help='output file (txt) for variants passing the --point filters')
+    sweep_parser.add_argument('-rc', '--rcol', default=3, type=int,
+                              help='column # containing Rsq (1-based) [default: 3]')
+    sweep_parser.add_argument('-mc', '--mcol', default=2, type=int,
+                              help='column # containing allele frequency (1-based) [default: 2]')
+    sweep_parser.add_argument('-ec', '--ecol', default=5, type=int,
+                              help='column # containing empirical Rsq (1-based) [default: 5]')
+    sweep_parser.add_argument('-rvc', '--rvarcol', default=1, type=int,
+                              help='column # containing variant ID in rsq file (1-based) [default: 1]')
+    sweep_parser.add_argument('-mvc', '--mvarcol', default=1, type=int,
+                              help='column # containing variant ID in maf file (1-based) [default: 1]')
+    sweep_parser.add_argument('-nc', '--nocases', action='store_true',
+                              help='if used, indicates there are no cases in QC (relevant for HWE filtering)')
+    sweep_parser.add_argument('--verbose', action='store_true',
+                              help='run with more verbose logging')
+
+
+    rsqqc_parser = subparsers.add_parser('rsq-qc', 
+                                         formatter_class=argparse.RawTextHelpFormatter,
+                                         description='Calculate Rsq from imputed dosages and apply Rsq, empirical Rsq, allele frequency and HWE filters in one pass.\nOutputs file containing variants passing filters, one per line (same as `rsq` followed by `qc`).',
+                                         help='calculate Rsq and perform variant QC')
+    rsqqc_parser.add_argument('-v', '--vcf', required=True,
+                              help='VCF containing dosage info (or a Minimac4 .info/.info.gz file, see --info-only)')
+    rsqqc_parser.add_argument('-o', '--output', required=True,
+                              help='output file (txt); bgzipped if it ends with .gz')
+    rsqqc_parser.add_argument('-c', '--chrom', required=True,
+                              help='chromosome of analysis')
+    rsqqc_parser.add_argument('-s', '--samples',
+                              help='file containing list of samples to include in calculation')
+    rsqqc_parser.add_argument('-r', '--rsq-output', default=None,
+                              help='also write the full Rsq TSV (same as `rsq` output, bgzipped with a tabix index if it ends with .gz)')
+    rsqqc_parser.add_argument('--info-only', action='store_true',
+                              help='without a sample subset, use AF/R2/ER2 from INFO instead of decoding dosages (much faster)')
+    rsqqc_parser.add_argument('--binary', action='store_true',
+                              help='write the Rsq table (-r) in binary columnar format')
+    rsqqc_parser.add_argument('--hwe', default=None,
+                              help='file containing PLINK `--hardy` output')
+    rsqqc_parser.add_argument('--calc-hwe', action='store_true',
+                              help='calculate exact HWE p-values from the genotypes (GT) instead of --hwe\n(controls only with --hwe-controls, otherwise all samples)')
+    rsqqc_parser.add_argument('--hwe-controls', default=None,
+                              help='with --calc-hwe, file containing list of control samples')
+    rsqqc_parser.add_argument('--hwe-midp', action='store_true',
+                              help='with --calc-hwe, use mid-p adjusted p-values')
+    rsqqc_parser.add_argument('-rf', '--rfilter', default=0.99, type=float,
+                              help='Rsq filter [default: 0.99]')
+    rsqqc_parser.add_argument('-mf', '--mfilter', default=0.01, type=float,
+                              help='MAF filter [default: 0.01]')
+    rsqqc_parser.add_argument('-ef', '--efilter', default=0.9, type=float,
+                              help='empirical Rsq filter [default: 0.90]')
+    rsqqc_parser.add_argument('-hf', '--hfilter', default=1e-6, type=float,
+                              help='HWE p-value filter [default: 1e-6]')
+    rsqqc_parser.add_argument('-nc', '--nocases', action='store_true',
+                              help='if used, indicates there are no cases in QC (relevant for HWE filtering)')
+    rsqqc_parser.add_argument('-b', '--block-size', default=1000, type=int,
+                              help='number of variants processed together [default: 1000]')
+    rsqqc_parser.add_argument('-j', '--jobs', '--threads', default=1, type=int,
+                              help='number of processes; splits the VCF into regions using its tabix index [default: 1]')
+    rsqqc_parser.add_argument('--decompress-threads', default=0, type=int,
+                              help='htslib threads decompressing the VCF (per job), with blocks of variants read ahead\nin a background thread [default: 0, read in the main thread]')
+    rsqqc_parser.add_argument('-t', '--tempdir', default=os.getcwd(),
+                              help='directory for per-region temporary files [default is current working directory]')
+    rsqqc_parser.add_argument('-p', '--pythonlib', default='',
+                              help='specify python site-packages location')
+    rsqqc_parser.add_argument('--verbose', action='store_true',
+                              help='run with more verbose logging')
+
+
+    convert_parser = subparsers.add_parser('rsq-convert', 
+                                           formatter_class=argparse.RawTextHelpFormatter,
+                                           description='Convert an Rsq TSV to a binary columnar table, or a binary table back to TSV.\nThe direction is detected from the input file.',
+                                           help='convert Rsq tables between TSV and binary')
+    convert_parser.add_argument('-i', '--input', required=True,
+                                help='Rsq TSV (can be gzipped) or binary table')
+    convert_parser.add_argument('-o', '--output', required=True,
+                                help='output file')
+
+
+    matrix_parser = subparsers.add_parser('dosage-matrix', 
+                                          formatter_class=argparse.RawTextHelpFormatter,
+                                          description='Decode the haploid dosages (HDS) and genotypes of an imputed VCF once into a memory-mapped matrix.\n`rsq -v` reads the matrix instead of the VCF, for repeated runs on different sample subsets.',
+                                          help='store dosages as a memory-mapped matrix for rsq')
+    matrix_parser.add_argument('-v', '--vcf', required=True,
+                               help='VCF containing dosage info')
+    matrix_parser.add_argument('-o', '--output', required=True,
+                               help='output file (dosage matrix)')
+    matrix_parser.add_argument('-s', '--samples',
+                               help='file containing list of samples to store [default: all samples]')
+    matrix_parser.add_argument('--dtype', default='uint16', choices=['uint16', 'uint8'],
+                               help='uint16 stores dosages in steps of 0.001 (exact for Minimac4 output),\nuint8 in steps of 0.005 at half the size [default: uint16]')
+    matrix_parser.add_argument('-b', '--block-size', default=1000, type=int,
+                               help='number of variants processed together [default: 1000]')
+    matrix_parser.add_argument('-p', '--pythonlib', default='',
+                               help='specify python site-packages location')
+
+
+    concordance_parser = subparsers.add_parser('concordance', 
+                                               formatter_class=argparse.RawTextHelpFormatter,
+                                               description='Compare the dosages of the first and second stage of imputation for the samples in both VCFs.\nBoth VCFs are read once, side by side, and variants are matched by chromosome, position, REF and ALT.\nOutputs the dosage r2 and mean absolute difference of each variant, and a summary per chromosome.',
+                                               help='compare stage 1 and stage 2 dosages')
+    concordance_parser.add_argument('-1', '--first', required=True,
+                                    help='VCF of the first stage of imputation (HDS), sorted by position')
+    concordance_parser.add_argument('-2', '--second', required=True,
+                                    help='VCF of the second stage of imputation (HDS), sorted by position')
+    concordance_parser.add_argument('-o', '--output', required=True,
+                                    help='output file (TSV, one row per variant in both VCFs)')
+    concordance_parser.add_argument('--summary', default=None,
+                                    help='per-chromosome summary (TSV) [default: output with .summary before the extension]')
+    concordance_parser.add_argument('-s', '--samples',
+                                    help='file containing list of samples to compare [default: all samples in both VCFs]')
+    concordance_parser.add_argument('-b', '--block-size', default=1000, type=int,
+                                    help='number of variants processed together [default: 1000]')
+    concordance_parser.add_argument('-p', '--pythonlib', default='',
+                                    help='specify python site-packages location')
+    concordance_parser.add_argument('--verbose', action='store_true',
+                                    help='run with more verbose logging')
+
+
+    overlap_parser = subparsers.add_parser('overlap', 
+                                           formatter_class=argparse.RawTextHelpFormatter,
+                                           description='Find variant overlap between multiple cohorts.\nOutputs file containing variants present in all (or --min-cohorts) cohorts, one per line, in genomic order.',
+                                           help='find variant overlap')
+    overlap_parser.add_argument('-l', '--varlist', required=True,
+                                help='file containing list of variant lists to overlap')
+    overlap_parser.add_argument('-o', '--output', required=True,
+                                help='output file (txt); bgzipped if it ends with .gz')
+    overlap_parser.add_argument('-c', '--chrom', required=True,
+                                help='chromosome of analysis')
+    overlap_parser.add_argument('-n', '--min-cohorts', default=None, type=int,
+                                help='keep variants present in at least this many cohorts [default: all cohorts]')
+    overlap_parser.add_argument('--counts', default=None,
+                                help='also write the number of cohorts carrying each variant (TSV)')
+
+
+    merge_parser = subparsers.add_parser('merge', 
+                                         formatter_class=argparse.RawTextHelpFormatter,
+                                         description='Merge VCF files from multiple cohorts based on variant overlap.\nOutputs merged VCF file.',
+                                         help='merge VCF files')
+    merge_parser.add_argument('-l', '--list', required=True,
+                              help='common-separated file contianing list of VCFs to merge, variant lists to merge on, and samples to include for each file. Column 1 = VCF files, Column 2 = variant lists, Column 3 = sample lists.')
+    merge_parser.add_argument('-o', '--output', required=True,
+                              help='output VCF')
+    merge_parser.add_argument('-c', '--chrom', required=True,
+                              help='chromosome of analysis')
+    merge_parser.add_argument('-t', '--tempdir', default=os.getcwd(),
+                              help='directory for temporary files [default is current working directory]')
+    merge_parser.add_argument('-s', '--snpsonly', action='store_true',
+                              help='filter for SNPs only')
+    merge_parser.add_argument('--targets', action='store_true',
+                              help='read only the records at the variant list positions through the tabix index of each VCF,\nselecting SNPs (--snpsonly) in the same read')
+    merge_parser.add_argument('--stream', action='store_true',
+                              help='pipe the formatted cohorts straight into bcftools merge (no temporary VCFs)')
+    merge_parser.add_argument('--shards', default=0, type=int,
+                              help='split the chromosome into this many regions (from the tabix index of the largest VCF),\nstream merge them in parallel (--jobs at a time) and concatenate them [default: 0 = off]')
+    merge_parser.add_argument('-j', '--jobs', default=1, type=int,
+                              help='number of cohorts formatted (or shards merged) at the same time [default: 1]')
+    merge_parser.add_argument('--threads', default=None, type=int,
+                              help='total number of threads, split between the jobs for bcftools compression [default: same as --jobs]')
+    merge_parser.add_argument('--cache-dir', default=None,
+                              help='directory caching outputs between runs, keyed by a hash of the inputs and options [default: no cache]')
+    merge_parser.add_argument('--cache-size', default=20, type=float,
+                              help='size limit of the cache directory in GB; least recently used results are removed [default: 20]')
+    merge_parser.add_argument('-p', '--pythonlib', default='',
+                            help='specify python site-packages location')
+
+
+    pipeline_parser = subparsers.add_parser('pipeline',
+                                            formatter_class=argparse.RawTextHelpFormatter,
+                                            description='Run rsq, qc, overlap and merge for every cohort and chromosome.\nTasks run in parallel within a CPU and memory budget, largest chromosomes first.\nRerunning the same command resumes after the completed tasks.',
+                                            help='run all steps for all chromosomes')
+    pipeline_parser.add_argument('-m', '--manifest', required=True,
+                                 help='comma-separated cohort manifest: Column 1 = cohort name, Column 2 = VCF, Column 3 = sample list,\noptional Column 4 = PLINK .hwe file; {chrom} in the paths is replaced by the chromosome')
+    pipeline_parser.add_argument('-o', '--outdir', required=True,
+                                 help='output directory (per-cohort Rsq tables and QC lists, overlaps, merged VCFs, logs)')
+    pipeline_parser.add_argument('-c', '--chroms', default='1-22',
+                                 help='chromosomes, e.g. 1-22 or 20,21,22 [default: 1-22]')
+    pipeline_parser.add_argument('--cpus', default=None, type=int,
+                                 help='number of CPUs used at the same time [default: all]')
+    pipeline_parser.add_argument('--memory', default=None, type=float,
+                                 help='memory budget in GB for the estimated use of the running tasks [default: physical memory]')
+    pipeline_parser.add_argument('--task-cpus', default=1, type=int,
+                                 help='CPUs (--jobs) of each rsq and merge task [default: 1]')
+    pipeline_parser.add_argument('--calc-hwe', action='store_true',
+                                 help='for cohorts without a .hwe file, compute HWE in rsq and filter on it in qc')
+    pipeline_parser.add_argument('-s', '--snpsonly', action='store_true',
+                                 help='only merge SNPs')
+    pipeline_parser.add_argument('-rf', '--rfilter', default=0.99, type=float,
+                                 help='Rsq filter [default: 0.99]')
+    pipeline_parser.add_argument('-mf', '--mfilter', default=0.01, type=float,
+                                 help='MAF filter [default: 0.01]')
+    pipeline_parser.add_argument('-ef', '--efilter', default=0.9, type=float,
+                                 help='empirical Rsq filter [default: 0.90]')
+    pipeline_parser.add_argument('-hf', '--hfilter', default=1e-6, type=float,
+                                 help='HWE p-value filter [default: 1e-6]')
+    pipeline_parser.add_argument('--cache-dir', default=None,
+                                 help='directory caching outputs between runs, keyed by a hash of the inputs and options [default: no cache]')
+    pipeline_parser.add_argument('--cache-size', default=20, type=float,
+                                 help='size limit of the cache directory in GB; least recently used results are removed [default: 20]')
+
+    return global_parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    logfmt_str = '%(levelname)s %(asctime)s: %(message)s'
+    datefmt_str = '%Y-%m-%d %H:%M:%S'
+    logging.basicConfig(stream=sys.stdout,
+                format=logfmt_str, datefmt=datefmt_str,
+                level=logging.INFO)
+    logger = logging.getLogger()
+
+    if args.metrics != None or args.profile != None:
+        import metrics
+        metrics.enable(args.metrics, args.profile, args.profile_stage)
+
+    cache = None
+    if getattr(args, 'cache_dir', None) != None:
+        from cache import open_cache
+        cache = open_cache(args.cache_dir, args.cache_size)
+
+    if args.command == 'rsq':
+        import calculate_rsq
+
+        if args.verbose:
+            logging.info('Verbosity on')
+            logger.setLevel('DEBUG')
+        calculate_rsq.run(args.vcf, args.output, args.samples, args.pythonlib, args.block_size,
+                          args.jobs, args.tempdir, args.subsets, args.wide,
+                          args.binary, args.info_only,
+                          args.calc_hwe, args.hwe_controls, args.hwe_midp, cache, args.decompress_threads)
+
+    if args.command == 'qc':
+        import variant_qc
+
+        if args.verbose:
+            logging.info('Verbosity on')
+            logger.setLevel('DEBUG')
+        variant_qc.run(args.chrom, args.rsq, args.maf, args.hwe, args.output,
+                       args.rfilter, args.mfilter, args.efilter, args.hfilter,
+                       args.rcol, args.mcol, args.ecol, args.rvarcol, args.mvarcol, 
+                       args.nocases, args.hcol, args.stream, cache)
+
+    if args.command == 'qc-sweep':
+        import variant_qc
+
+        if args.verbose:
+            logging.info('Verbosity on')
+            logger.setLevel('DEBUG')
+        point = None
+        if args.point != None:
+            point = variant_qc.parse_grid(args.point)
+            if len(point) != 4 or args.passing == None:
+                logging.error('--point takes 4 comma-separated filters (Rsq,MAF,ER2,HWE) and needs --passing.')
+                sys.exit(1)
+        variant_qc.run_sweep(args.chrom, args.rsq, args.maf, args.hwe, args.output,
+                             variant_qc.parse_grid(args.rfilter), variant_qc.parse_grid(args.mfilter),
+                             variant_qc.parse_grid(args.efilter), variant_qc.parse_grid(args.hfilter),
+                             args.rcol, args.mcol, args.ecol, args.rvarcol, args.mvarcol,
+                             args.nocases, point, args.passing, args.hcol)
+
+    if args.command == 'rsq-qc':
+        import variant_qc
+
+        if args.verbose:
+            logging.info('Verbosity on')
+            logger.setLevel('DEBUG')
+        variant_qc.run_fused(args.chrom, args.vcf, args.samples, args.hwe, args.output, args.rsq_output,
+                             args.rfilter, args.mfilter, args.efilter, args.hfilter, args.nocases,
+                             args.block_size, args.jobs, args.tempdir, args.pythonlib, args.binary,
+                             args.info_only, args.calc_hwe, args.hwe_controls, args.hwe_midp, args.decompress_threads)
+
+    if args.command == 'rsq-convert':
+        import rsq_table
+
+        rsq_table.run(args.input, args.output)
+
+    if args.command == 'dosage-matrix':
+        import dosage_matrix
+
+        dosage_matrix.run(args.vcf, args.output, args.samples, args.dtype, args.block_size, args.pythonlib)
+
+    if args.command == 'concordance':
+        import concordance
+
+        if args.verbose:
+            logging.info('Verbosity on')
+            logger.setLevel('DEBUG')
+        concordance.run(args.first, args.second, args.output, args.samples, args.summary, args.block_size, args.pythonlib)
+
+    if args.command == 'overlap':
+        import overlap
+
+        # no debug logging
+
+        overlap.run(args.varlist, args.chrom, args.output, args.min_cohorts, args.counts)
+
+    if args.command == 'merge':
+        import merge
+
+        # no debug logging
+
+        merge.run(args.chrom, args.list, args.output, args.tempdir, args.snpsonly, args.pythonlib,
+                  args.jobs, args.threads, args.targets, args.stream, args.shards, cache)
+
+    if args.command == 'pipeline':
+        import pipeline
+
+        pipeline.run(args.manifest, args.outdir, args.chroms, args.cpus, args.memory, args.task_cpus,
+                     args.calc_hwe, args.snpsonly, (args.rfilter, args.mfilter, args.efilter, args.hfilter),
+                     args.cache_dir, args.cache_size)
+
 
+if __name__ == '__main__':
+    main()
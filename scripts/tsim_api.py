@@ -0,0 +1,199 @@
+import os
+import gzip
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import metrics
+
+# in-process API: the tsim.py steps as functions returning their results, so that a long-running Python process
+# (e.g. a workflow engine worker) can run many steps without starting tsim.py for each chromosome and step
+#   sys.path.insert(0, '/path/to/tsim/scripts')
+#   import tsim_api
+#   result = tsim_api.qc('22', 'chr22.rsq.txt', 'chr22.maf.txt', 'chr22.hq.txt')
+# outputs are written as with tsim.py, and the step modules (and numpy, cyvcf2, pysam) are imported on first use
+# errors raise TsimError instead of exiting (also missing or unreadable inputs and values that cannot be parsed,
+# with the original exception as its cause); logging is left to the caller
+# stages: per-stage metrics of the step (wall/CPU time, records/sec, ...), as written by tsim.py --metrics
+# steps share process-wide state (metrics, logging, sys.path): run one step at a time per process
+
+
+class TsimError(Exception):
+    pass
+
+
+class RsqResult(NamedTuple):
+    outputs: List[str]
+    counts: List[Tuple[int, int]] # (non-monomorphic, monomorphic) variants, per output (or per subset with wide)
+    n_variants: int
+    stages: List[dict]
+
+
+class QcResult(NamedTuple):
+    passing: Optional[List[str]] # None with ids=False
+    n_passing: int
+    r2_fail: int
+    er2_fail: int
+    maf_fail: int
+    hwe_fail: int
+    stages: List[dict]
+
+
+class RsqQcResult(NamedTuple):
+    passing: Optional[List[str]]
+    n_passing: int
+    n_variants: int
+    monomorphic: int
+    r2_fail: int
+    er2_fail: int
+    maf_fail: int
+    hwe_fail: int
+    stages: List[dict]
+
+
+class OverlapResult(NamedTuple):
+    overlapping: Optional[List[str]]
+    n_overlapping: int
+    cohorts: List[int] # number of variants found in k cohorts at index k
+    stages: List[dict]
+
+
+class MergeResult(NamedTuple):
+    output: str
+    stages: List[dict]
+
+
+class ConcordanceResult(NamedTuple):
+    counts: Dict[str, Tuple[int, int, int]] # per chromosome: variants in stage 1, in stage 2 and in both
+    stages: List[dict]
+
+
+class MatrixResult(NamedTuple):
+    n_variants: int
+    n_samples: int
+    stages: List[dict]
+
+
+class ErrorLog(logging.Handler):
+    # errors logged by a step, for the TsimError raised when it exits
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def call(fn, *args):
+    # (result of fn, its stages); sys.exit(), OSError and ValueError in the step become TsimError
+    errors = ErrorLog()
+    logger = logging.getLogger()
+    logger.addHandler(errors)
+    try:
+        with metrics.collect() as stages:
+            result = fn(*args)
+    except SystemExit as e:
+        message = '\n'.join(errors.messages) if len(errors.messages) > 0 else 'exit status %s' % e.code
+        raise TsimError('%s failed: %s' % (fn.__module__, message)) from None
+    except (OSError, ValueError) as e:
+        raise TsimError('%s failed: %s' % (fn.__module__, e)) from e
+    finally:
+        logger.removeHandler(errors)
+    return (result, stages)
+
+
+def open_cache(cache_dir, cache_size):
+    if cache_dir == None:
+        return None
+    from cache import open_cache
+    return open_cache(cache_dir, cache_size)
+
+
+def read_ids(fn):
+    with gzip.open(fn, 'rt') if fn.endswith('.gz') else open(fn) as f1:
+        return [line.strip() for line in f1 if line.strip() != '']
+
+
+def rsq(vcf: str, output: str, samples: Optional[str] = None, *,
+        subsets: Optional[str] = None, wide: bool = False, binary: bool = False, info_only: bool = False,
+        calc_hwe: bool = False, hwe_controls: Optional[str] = None, hwe_midp: bool = False,
+        block_size: int = 1000, jobs: int = 1, decompress_threads: int = 0, tempdir: Optional[str] = None,
+        cache_dir: Optional[str] = None, cache_size: float = 20, pythonlib: str = '') -> RsqResult:
+    import calculate_rsq
+
+    ((out_fns, counts, n_variants), stages) = call(calculate_rsq.run, vcf, output, samples, pythonlib, block_size,
+                                                   jobs, tempdir, subsets, wide, binary, info_only, calc_hwe,
+                                                   hwe_controls, hwe_midp, open_cache(cache_dir, cache_size),
+                                                   decompress_threads)
+    return RsqResult(out_fns, [tuple(c) for c in counts], n_variants, stages)
+
+
+def qc(chrom: str, rsq: str, maf: str, output: str, *,
+       hwe: Optional[str] = None, hcol: Optional[int] = None,
+       rfilter: float = 0.99, mfilter: float = 0.01, efilter: float = 0.9, hfilter: float = 1e-6,
+       rcol: int = 3, mcol: int = 2, ecol: int = 5, rvarcol: int = 1, mvarcol: int = 1,
+       nocases: bool = False, stream: bool = False,
+       cache_dir: Optional[str] = None, cache_size: float = 20, ids: bool = True) -> QcResult:
+    # ids: read the passing variant IDs back from output
+    import variant_qc
+
+    ((r2_fail, er2_fail, maf_fail, n_passing, hwe_fail), stages) = call(
+        variant_qc.run, chrom, rsq, maf, hwe, output, rfilter, mfilter, efilter, hfilter,
+        rcol, mcol, ecol, rvarcol, mvarcol, nocases, hcol, stream, open_cache(cache_dir, cache_size))
+    return QcResult(read_ids(output) if ids else None, n_passing, r2_fail, er2_fail, maf_fail, hwe_fail, stages)
+
+
+def rsq_qc(chrom: str, vcf: str, output: str, samples: Optional[str] = None, *,
+           rsq_output: Optional[str] = None, binary: bool = False, info_only: bool = False,
+           hwe: Optional[str] = None, calc_hwe: bool = False, hwe_controls: Optional[str] = None,
+           hwe_midp: bool = False, nocases: bool = False,
+           rfilter: float = 0.99, mfilter: float = 0.01, efilter: float = 0.9, hfilter: float = 1e-6,
+           block_size: int = 1000, jobs: int = 1, decompress_threads: int = 0, tempdir: Optional[str] = None,
+           pythonlib: str = '', ids: bool = True) -> RsqQcResult:
+    import variant_qc
+
+    ((counts, n_variants, qc_counts), stages) = call(
+        variant_qc.run_fused, chrom, vcf, samples, hwe, output, rsq_output, rfilter, mfilter, efilter, hfilter,
+        nocases, block_size, jobs, tempdir, pythonlib, binary, info_only, calc_hwe, hwe_controls, hwe_midp,
+        decompress_threads)
+    (r2_fail, er2_fail, maf_fail, n_passing, hwe_fail) = qc_counts
+    return RsqQcResult(read_ids(output) if ids else None, n_passing, n_variants, counts[1],
+                       r2_fail, er2_fail, maf_fail, hwe_fail, stages)
+
+
+def overlap(chrom: str, varlist: str, output: str, *,
+            min_cohorts: Optional[int] = None, counts: Optional[str] = None, ids: bool = True) -> OverlapResult:
+    # varlist: file listing the variant lists of the cohorts, one per line
+    import overlap as step
+
+    ((hist, n_overlap), stages) = call(step.run, varlist, chrom, output, min_cohorts, counts)
+    return OverlapResult(read_ids(output) if ids else None, n_overlap, hist, stages)
+
+
+def merge(chrom: str, filelist: str, output: str, *,
+          tempdir: Optional[str] = None, snpsonly: bool = False, targets: bool = False, stream: bool = False,
+          shards: int = 0, jobs: int = 1, threads: Optional[int] = None,
+          cache_dir: Optional[str] = None, cache_size: float = 20, pythonlib: str = '') -> MergeResult:
+    import merge as step
+
+    if tempdir == None:
+        tempdir = os.getcwd()
+    (result, stages) = call(step.run, chrom, filelist, output, tempdir, snpsonly, pythonlib, jobs, threads,
+                            targets, stream, shards, open_cache(cache_dir, cache_size))
+    return MergeResult(output, stages)
+
+
+def concordance(first: str, second: str, output: str, samples: Optional[str] = None, *,
+                summary: Optional[str] = None, block_size: int = 1000, pythonlib: str = '') -> ConcordanceResult:
+    import concordance as step
+
+    (result, stages) = call(step.run, first, second, output, samples, summary, block_size, pythonlib)
+    counts = dict((result.names[rank], tuple(result.counts[rank])) for rank in sorted(result.counts))
+    return ConcordanceResult(counts, stages)
+
+
+def dosage_matrix(vcf: str, output: str, samples: Optional[str] = None, *,
+                  dtype: str = 'uint16', block_size: int = 1000, pythonlib: str = '') -> MatrixResult:
+    import dosage_matrix as step
+
+    ((n_variants, n_samples), stages) = call(step.run, vcf, output, samples, dtype, block_size, pythonlib)
+    return MatrixResult(n_variants, n_samples, stages)
@@ -0,0 +1,88 @@
+import re
+
+# 64-bit integer keys for variant IDs: chrom (5 bits) | position (28 bits) | alleles (31 bits)
+# keys sort in genomic order and are the same however the ID is written
+# (chr22:16050075:A:G, 22:16050075:A:G, chr22_16050075_A_G, 22-16050075-A-G, ...)
+# alleles: ref and alt with up to 11 bases in total are packed in the key,
+# longer (or non-ACGT) alleles get a number from a side table
+CHROMS = dict([(str(i), i) for i in range(1, 23)] + [('X', 23), ('Y', 24), ('M', 25), ('MT', 25)])
+POS_BITS = 28
+ALLELE_BITS = 31
+INLINE_BASES = 11
+BASES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+ID_FORMAT = re.compile(r'^(?:chr)?([0-9]+|X|Y|MT?)[:_-]([0-9]+)[:_-]([^:_/\s-]+)[:_/-]([^:_/\s-]+)$', re.I)
+
+
+def parse_id(var):
+    # (chrom, pos, ref, alt), None if the ID is not chrom/pos/ref/alt
+    m = ID_FORMAT.match(var)
+    if m == None:
+        return None
+    (chrom, pos, ref, alt) = m.groups()
+    return (chrom.upper(), int(pos), ref.upper(), alt.upper())
+
+
+class VariantKeys:
+    # the side table is kept here: keys are comparable between lists encoded by the same object
+    def __init__(self):
+        self.long_alleles = {}
+
+    def alleles(self, ref, alt):
+        if len(ref) + len(alt) <= INLINE_BASES:
+            code = 0
+            for base in ref + alt:
+                if base not in BASES:
+                    break
+                code = (code << 2) | BASES[base]
+            else:
+                code = code << 2*(INLINE_BASES - len(ref) - len(alt))
+                return (len(ref) << 26) | (len(alt) << 22) | code
+        index = self.long_alleles.setdefault(ref + ':' + alt, len(self.long_alleles))
+        return (1 << (ALLELE_BITS-1)) | index
+
+    def key(self, var):
+        # None if the ID cannot be encoded
+        parsed = parse_id(var)
+        if parsed == None:
+            return None
+        (chrom, pos, ref, alt) = parsed
+        if chrom not in CHROMS or pos >= (1 << POS_BITS) or len(self.long_alleles) >= (1 << (ALLELE_BITS-1)):
+            return None
+        return (CHROMS[chrom] << (POS_BITS+ALLELE_BITS)) | (pos << ALLELE_BITS) | self.alleles(ref, alt)
+
+    def encode(self, ids):
+        # uint64 keys in the order of ids, None if any ID cannot be encoded
+        import numpy as np
+
+        keys = []
+        for var in ids:
+            k = self.key(var)
+            if k == None:
+                return None
+            keys.append(k)
+        return np.array(keys, dtype=np.uint64)
+
+
+def position(key):
+    # chrom and position part of a key: equal for variants at the same site
+    return key >> ALLELE_BITS
+
+
+def isin(keys, sorted_keys):
+    # vectorized membership test against sorted (unique) keys
+    import numpy as np
+
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    idx = np.searchsorted(sorted_keys, keys)
+    idx[idx == len(sorted_keys)] = 0
+    return sorted_keys[idx] == keys
+
+
+def first_occurrence(keys):
+    # True for the first variant with each key, as a dict built from the IDs would keep
+    import numpy as np
+
+    first = np.zeros(len(keys), dtype=bool)
+    first[np.unique(keys, return_index=True)[1]] = True
+    return first
@@ -2,17 +2,69 @@ from datetime import datetime
 import sys
 import logging
 import gzip
+import itertools
 
+import metrics
 from check_chrom import check_chrom
+from bgzf import open_text, abort
+from rsq_table import is_binary, open_table, column, get_ids, open_output
+from variant_key import VariantKeys, position, isin, first_occurrence
 
-def load_rsq(rfn, rfilter, rcol, rvarcol, efilter, ecol, r2_drop=0, er2_drop=0, track_bin=500000, badcol=10): 
+def check_idcol(fn, varcol):
+    if varcol != 0:
+        logging.error('The variant ID is always column 1 of a binary Rsq table (%s).' % fn)
+        sys.exit(1)
+
+
+def load_rsq_binary(rfn, rfilter, rcol, rvarcol, efilter, ecol):
+    import numpy as np
+    
+    logging.info('####################')
+    logging.info('Loading Rsqs (binary table)...')
+    check_idcol(rfn, rvarcol)
+    table = open_table(rfn)
+    rsq = column(table, rcol)
+    er2 = column(table, ecol)
+    
+    # '-' is stored as NaN: no Rsq means the variant is skipped, no ER2 means it is not genotyped
+    r2_pass = rsq >= rfilter
+    er2_pass = np.isnan(er2) | (er2 >= efilter)
+    r2_drop = int((~np.isnan(rsq) & ~r2_pass).sum())
+    er2_drop = int((r2_pass & ~er2_pass).sum())
+    
+    rows = np.flatnonzero(r2_pass & er2_pass)
+    rdic = dict(zip(get_ids(table, rows), rsq[rows].tolist()))
+    logging.info('Processed %s variants' % int((~np.isnan(rsq)).sum()))
+    return (rdic, r2_drop, er2_drop)
+
+
+def load_maf_binary(mfn, mfilter, mcol, mvarcol):
+    import numpy as np
+    
+    logging.info('####################')
+    logging.info('Loading AFs (binary table)...')
+    check_idcol(mfn, mvarcol)
+    table = open_table(mfn)
+    maf = column(table, mcol)
+    
+    maf_pass = (maf >= mfilter) & (maf <= 1-mfilter)
+    maf_drop = int((~np.isnan(maf) & ~maf_pass).sum())
+    
+    rows = np.flatnonzero(maf_pass)
+    mdic = dict(zip(get_ids(table, rows), maf[rows].tolist()))
+    logging.info('Processed %s variants' % int((~np.isnan(maf)).sum()))
+    return (mdic, maf_drop)
+
+
+def rsq_rows(rfn, rfilter, rcol, rvarcol, efilter, ecol, counts, track_bin=500000, badcol=10):
+    # variants passing the Rsq and ER2 filters, in file order: (var, rsq)
+    # counts: [r2_drop, er2_drop], updated as the file is read
     wrong_col1 = 0
     wrong_col2 = 0
     
     logging.info('####################')
     logging.info('Loading Rsqs...')
     count = 0
-    rdic = {} # only if pass Rsq filter and ER2 filter
     rsq_zip = True if rfn.endswith('.gz') else False
     with gzip.open(rfn, 'rt') if rsq_zip else open(rfn) as f1:
         for line in f1:
@@ -21,23 +73,24 @@ def load_rsq(rfn, rfilter, rcol, rvarcol, efilter, ecol, r2_drop=0, er2_drop=0,
             rsq = ln[rcol]
             er2 = ln[ecol]
             
+            keep = False
             try:
                 rsq = float(rsq)
                 if rsq >= rfilter:
                     try:
                         er2 = float(er2)
                         if er2 >= efilter:
-                            rdic[var] = rsq
+                            keep = True
                         else:
-                            er2_drop = er2_drop+1
+                            counts[1] = counts[1]+1
                     except:
                         if er2 != '-' and er2 != '.':
                             logging.debug('%s is not a number' % rsq)
                             wrong_col2 = wrong_col2+1
                         else:
-                            rdic[var] = rsq
+                            keep = True
                 else:
-                    r2_drop = r2_drop+1
+                    counts[0] = counts[0]+1
                 count = count + 1
                 if count%track_bin == 0:
                     logging.debug('Processed %s variants' % count)
@@ -55,29 +108,44 @@ def load_rsq(rfn, rfilter, rcol, rvarcol, efilter, ecol, r2_drop=0, er2_drop=0,
                 logging.error("Check your column number for ER2 (-ec). It doesn't seem right.")
                 logging.error('%s is not a number' % er2)
                 sys.exit(1)
+            
+            if keep:
+                yield (var, rsq)
         logging.info('Processed %s variants' % count)
-    return (rdic, r2_drop, er2_drop)
 
 
-def load_maf(mfn, mfilter, mcol, mvarcol, maf_drop=0, track_bin=500000, badcol=10):
+def load_rsq(rfn, rfilter, rcol, rvarcol, efilter, ecol, r2_drop=0, er2_drop=0, track_bin=500000, badcol=10): 
+    if is_binary(rfn):
+        return load_rsq_binary(rfn, rfilter, rcol, rvarcol, efilter, ecol)
+    
+    counts = [r2_drop, er2_drop]
+    rdic = {} # only if pass Rsq filter and ER2 filter
+    for (var, rsq) in rsq_rows(rfn, rfilter, rcol, rvarcol, efilter, ecol, counts, track_bin, badcol):
+        rdic[var] = rsq
+    return (rdic, counts[0], counts[1])
+
+
+def maf_rows(mfn, mfilter, mcol, mvarcol, counts, track_bin=500000, badcol=10):
+    # variants passing the MAF filter, in file order: (var, maf)
+    # counts: [maf_drop], updated as the file is read
     wrong_col = 0
 
     logging.info('####################')
     logging.info('Loading AFs...')
     count = 0
-    mdic = {} # only if pass MAF
     maf_zip = True if mfn.endswith('.gz') else False
     with gzip.open(mfn, 'rt') if maf_zip else open(mfn) as f1:
         for line in f1:
             ln = line.strip().split('\t')
             var = ln[mvarcol]
             maf = ln[mcol]
+            keep = False
             try:
                 maf = float(maf)
                 if maf >= mfilter and maf <= 1-mfilter:
-                    mdic[var] = maf
+                    keep = True
                 else:
-                    maf_drop = maf_drop+1
+                    counts[0] = counts[0]+1
                 count = count+1
                 if count%track_bin == 0:
                     logging.debug('Processed %s variants' % count)
@@ -89,12 +157,26 @@ def load_maf(mfn, mfilter, mcol, mvarcol, maf_drop=0, track_bin=500000, badcol=1
                 logging.error("Check your column number for MAF (-mc). It doesn't seem right.")
                 logging.error('%s is not a number' % maf)
                 sys.exit(1)
+            
+            if keep:
+                yield (var, maf)
                 
         logging.info('Processed %s variants' % count)
-    return (mdic, maf_drop)
 
 
-def load_hwe(hfile, hfilter, nocases, track_bin=500000, badcol=10):
+def load_maf(mfn, mfilter, mcol, mvarcol, maf_drop=0, track_bin=500000, badcol=10):
+    if is_binary(mfn):
+        return load_maf_binary(mfn, mfilter, mcol, mvarcol)
+    
+    counts = [maf_drop]
+    mdic = {} # only if pass MAF
+    for (var, maf) in maf_rows(mfn, mfilter, mcol, mvarcol, counts, track_bin, badcol):
+        mdic[var] = maf
+    return (mdic, counts[0])
+
+
+def hwe_rows(hfile, hfilter, nocases, track_bin=500000, badcol=10):
+    # variants failing HWE in the relevant test, in file order: (var, p-value)
     wrong_col = 0
     
     logging.info('####################')
@@ -104,7 +186,6 @@ def load_hwe(hfile, hfilter, nocases, track_bin=500000, badcol=10):
         logging.debug('No cases. Using ALL for HWE filter.')
     
     count = 0
-    hdic = {} # only if fail HWE
     
     with open(hfile) as f1:
         for line in f1:
@@ -112,16 +193,17 @@ def load_hwe(hfile, hfilter, nocases, track_bin=500000, badcol=10):
             var = ln[1]
             hwe = ln[8]
             test = [ln[2]][0]
-                
+            
+            fail = False
             try:
                 hwe = float(hwe)
                 
                 if nocases:
                     if hwe <= hfilter and 'ALL' in test:
-                        hdic[var] = hwe
+                        fail = True
                 else:
                     if hwe <= hfilter and test == 'UNAFF':
-                        hdic[var] = hwe
+                        fail = True
                         
                 count = count+1
                 if count%track_bin == 0:
@@ -134,15 +216,230 @@ def load_hwe(hfile, hfilter, nocases, track_bin=500000, badcol=10):
                 logging.error("Check your HWE file. It doesn't seem right.")
                 logging.error('%s is not a number' % hwe)
                 sys.exit(1)
+            
+            if fail:
+                yield (var, hwe)
                 
         logging.info('Processed %s lines (may be multiple of total variants)' % count)
+
+
+def load_hwe(hfile, hfilter, nocases, track_bin=500000, badcol=10):
+    hdic = {} # only if fail HWE
+    for (var, hwe) in hwe_rows(hfile, hfilter, nocases, track_bin, badcol):
+        hdic[var] = hwe
     return hdic
 
 
+def position_groups(rows, keys):
+    # consecutive variants at the same position: (position, {key: var, ...}) in file order
+    # yields None and stops if the variants are not sorted by position (or IDs cannot be encoded)
+    pos = None
+    group = {}
+    for (var, value) in rows:
+        k = keys.key(var)
+        if k == None or (pos != None and position(k) < pos):
+            yield None
+            return
+        if position(k) != pos:
+            if pos != None:
+                yield (pos, group)
+            pos = position(k)
+            group = {}
+        group.setdefault(k, var)
+    if pos != None:
+        yield (pos, group)
+
+
+def stream_join(rsq_groups, maf_groups, hwe_groups, fo):
+    # merge-join of the position-sorted inputs, holding one position of each at a time
+    # writes variants passing all filters in Rsq file order
+    # returns (hq_keep, hwe_fail), or None if an input is not sorted
+    end = (float('inf'), {})
+    m = next(maf_groups, end)
+    h = next(hwe_groups, end)
+    hq_keep = 0
+    hwe_fail = 0
+    for r in rsq_groups:
+        if r == None:
+            return None
+        (pos, rvars) = r
+        while m != None and m[0] < pos:
+            m = next(maf_groups, end)
+        while h != None and h[0] < pos:
+            hwe_fail = hwe_fail + len(h[1])
+            h = next(hwe_groups, end)
+        if m == None or h == None:
+            return None
+        mvars = m[1] if m[0] == pos else {}
+        hvars = h[1] if h[0] == pos else {}
+        for (k, var) in rvars.items():
+            if k in mvars and k not in hvars:
+                fo.write('%s\n' % var)
+                hq_keep = hq_keep+1
+    
+    # rest of the inputs: counts, and sortedness of what the join relied on
+    while m != end:
+        if m == None:
+            return None
+        m = next(maf_groups, end)
+    while h != end:
+        if h == None:
+            return None
+        hwe_fail = hwe_fail + len(h[1])
+        h = next(hwe_groups, end)
+    return (hq_keep, hwe_fail)
+
+
+def load_hwe_column(rfn, hfilter, hcol, rvarcol):
+    # HWE p-values calculated by `rsq --calc-hwe`: same role as load_hwe
+    import numpy as np
+    
+    (n, ids, (hwe,)) = load_columns(rfn, rvarcol, [hcol], ['HWE (-hc)'])
+    fail = np.flatnonzero(hwe <= hfilter)
+    return dict(zip(ids(fail), hwe[fail].tolist()))
+
+
+def hwe_column_rows(rfn, hfilter, hcol, rvarcol):
+    # variants failing HWE in a column of the Rsq TSV, in file order: (var, p-value)
+    with gzip.open(rfn, 'rt') if rfn.endswith('.gz') else open(rfn) as f1:
+        for line in f1:
+            ln = line.strip().split('\t')
+            try:
+                hwe = float(ln[hcol])
+            except:
+                continue
+            if hwe <= hfilter:
+                yield (ln[rvarcol], hwe)
+
+
+def as_written(values):
+    # values as they read back from the rsq TSV, so thresholds behave the same as on the file
+    import numpy as np
+    
+    if values.dtype == np.float64:
+        return values
+    return values.astype(str).astype(np.float64)
+
+
+def qc_block(ids, af, rsq, poly, er2, rfilter, efilter, mfilter, hdic, hfilter=None, hwe_p=None):
+    # same filters as load_rsq/load_maf/load_hwe, applied to one block of `rsq` results
+    # hwe_p: HWE p-values computed along with rsq, used instead of hdic
+    import numpy as np
+    
+    rsq = as_written(rsq)
+    af = np.where(poly, as_written(af), 0) # monomorphic sites are written with AAF 0
+    er2 = np.array([np.nan if e == '-' else e for e in er2], dtype=np.float64)
+    
+    r2_pass = poly & (rsq >= rfilter)
+    er2_pass = np.isnan(er2) | (er2 >= efilter)
+    maf_pass = (af >= mfilter) & (af <= 1-mfilter)
+    
+    r2_drop = int((poly & ~r2_pass).sum())
+    er2_drop = int((r2_pass & ~er2_pass).sum())
+    maf_drop = int((~maf_pass).sum())
+    
+    if hwe_p is not None:
+        hwe_pass = ~(hwe_p <= hfilter)
+        hwe_drop = int((~hwe_pass).sum())
+        keep = [ids[i] for i in np.flatnonzero(r2_pass & er2_pass & maf_pass & hwe_pass)]
+    else:
+        hwe_drop = 0
+        keep = [ids[i] for i in np.flatnonzero(r2_pass & er2_pass & maf_pass) if ids[i] not in hdic]
+    return (keep, (r2_drop, er2_drop, maf_drop, hwe_drop))
+
+
+def run_stream(rfn, mfn, hfn, ofn, rfilter, mfilter, efilter, hfilter,
+               rcol, mcol, ecol, rvarcol, mvarcol, nocases, hcol):
+    # constant-memory QC for inputs sorted by position (as written by `rsq`)
+    # returns (r2_drop, er2_drop, maf_drop, hq_keep, hwe_fail), or None to use the dict path
+    for fn in [rfn, mfn]:
+        if is_binary(fn):
+            logging.info('%s is a binary table: loading the inputs instead of streaming.' % fn)
+            return None
+    
+    rsq_counts = [0, 0]
+    maf_counts = [0]
+    keys = VariantKeys()
+    rsq_groups = position_groups(rsq_rows(rfn, rfilter, rcol-1, rvarcol-1, efilter, ecol-1, rsq_counts), keys)
+    maf_groups = position_groups(maf_rows(mfn, mfilter, mcol-1, mvarcol-1, maf_counts), keys)
+    if hfn != None:
+        hwe_groups = position_groups(hwe_rows(hfn, hfilter, nocases), keys)
+    elif hcol != None:
+        hwe_groups = position_groups(hwe_column_rows(rfn, hfilter, hcol-1, rvarcol-1), keys)
+    else:
+        hwe_groups = iter([])
+    
+    logging.info('####################')
+    logging.info('Finding high quality variants (streaming join)')
+    with open_text(ofn) as f1:
+        joined = stream_join(rsq_groups, maf_groups, hwe_groups, f1)
+    if joined == None:
+        logging.warning('Inputs are not sorted by position (or IDs are not chrom:pos:ref:alt): loading the inputs instead of streaming.')
+        return None
+    (hq_keep, hwe_fail) = joined
+    return (rsq_counts[0], rsq_counts[1], maf_counts[0], hq_keep, hwe_fail)
+
+
+def head_encodable(fn, varcol, valcol, keys, sep='\t', n=1000):
+    # False if any ID in the first n lines of fn cannot be encoded as a variant key
+    # lines without a number in valcol (headers, missing values) are skipped, as when the file is read
+    with gzip.open(fn, 'rt') if fn.endswith('.gz') else open(fn) as f1:
+        for line in itertools.islice(f1, n):
+            ln = line.strip().split(sep)
+            try:
+                float(ln[valcol])
+            except (IndexError, ValueError):
+                continue
+            if keys.key(ln[varcol]) == None:
+                return False
+    return True
+
+
+def run_keys(rfn, mfn, hfn, ofn, rfilter, mfilter, efilter, hfilter,
+             rcol, mcol, ecol, rvarcol, mvarcol, nocases):
+    # QC with integer variant keys: sorted arrays instead of dicts of ID strings
+    # returns (r2_drop, er2_drop, maf_drop, hq_keep, hwe_fail), or None to use the dict path
+    import numpy as np
+    
+    for fn in [rfn, mfn]:
+        if is_binary(fn):
+            return None
+    
+    keys = VariantKeys()
+    # rsIDs and the like show in the first lines: fall back before reading the inputs in full
+    heads = [(rfn, rvarcol-1, rcol-1, '\t'), (mfn, mvarcol-1, mcol-1, '\t')] + ([(hfn, 1, 8, None)] if hfn != None else [])
+    if not all(head_encodable(fn, varcol, valcol, keys, sep) for (fn, varcol, valcol, sep) in heads):
+        logging.info('Variant IDs are not all chrom:pos:ref:alt: matching variants by ID.')
+        return None
+    rsq_counts = [0, 0]
+    maf_counts = [0]
+    rsq_ids = [var for (var, rsq) in rsq_rows(rfn, rfilter, rcol-1, rvarcol-1, efilter, ecol-1, rsq_counts)]
+    rsq_keys = keys.encode(rsq_ids)
+    maf_keys = keys.encode(var for (var, maf) in maf_rows(mfn, mfilter, mcol-1, mvarcol-1, maf_counts)) \
+        if rsq_keys is not None else None
+    hwe_keys = np.zeros(0, dtype=np.uint64)
+    if hfn != None and maf_keys is not None:
+        hwe_keys = keys.encode(var for (var, hwe) in hwe_rows(hfn, hfilter, nocases))
+    if maf_keys is None or hwe_keys is None:
+        logging.info('Variant IDs are not all chrom:pos:ref:alt: matching variants by ID.')
+        return None
+    maf_keys = np.unique(maf_keys)
+    hwe_keys = np.unique(hwe_keys)
+    
+    logging.info('####################')
+    logging.info('Finding high quality variants')
+    keep = first_occurrence(rsq_keys) & isin(rsq_keys, maf_keys) & ~isin(rsq_keys, hwe_keys)
+    with open_text(ofn) as f1:
+        for i in np.flatnonzero(keep):
+            f1.write('%s\n' % rsq_ids[i])
+    logging.info('Processed %s/%s variants' % (len(rsq_keys), len(rsq_keys)))
+    return (rsq_counts[0], rsq_counts[1], maf_counts[0], int(keep.sum()), len(hwe_keys))
+
+
 def run(chrom, rfn, mfn, hfn, ofn,
         rfilter, mfilter, efilter, hfilter,
         rcol, mcol, ecol, rvarcol, mvarcol, 
-        nocases):
+        nocases, hcol=None, stream=False, cache=None):
     start = datetime.now()
     
     logging.info('######################')
@@ -161,53 +458,191 @@ def run(chrom, rfn, mfn, hfn, ofn,
     logging.info('MAF column\t%s' % mcol)
     logging.info('MAF variant column\t%s' % mvarcol)
     logging.info('HWE file\t%s' % hfn)
-    if hfn != None:
+    logging.info('HWE column\t%s' % hcol)
+    if hfn != None or hcol != None:
         logging.info('HWE filter\t%s' % hfilter)
     logging.info('Output\t%s' % ofn)
+    logging.info('Streaming join\t%s' % stream)
+    logging.info('Cache\t%s' % (None if cache == None else cache.cache_dir))
+    
+    if hfn != None and hcol != None:
+        logging.error('Use either an HWE file (--hwe) or an HWE column of the Rsq file (-hc), not both.')
+        sys.exit(1)
     
     min_num = check_chrom(chrom)   
     
-    (rdic, r2_drop, er2_drop) = load_rsq(rfn, rfilter, rcol-1, rvarcol-1, efilter, ecol-1)
-    (mdic, maf_drop) = load_maf(mfn, mfilter, mcol-1, mvarcol-1)
+    with metrics.stage('qc') as m:
+        joined = None
+        if cache != None:
+            key = cache.key('qc', [rfn, mfn, hfn],
+                            [rfilter, mfilter, efilter, hfilter, rcol, mcol, ecol, rvarcol, mvarcol, nocases, hcol])
+            joined = cache.fetch(key, [ofn])
+        cached = joined != None
+        if stream and joined == None:
+            joined = run_stream(rfn, mfn, hfn, ofn, rfilter, mfilter, efilter, hfilter,
+                                rcol, mcol, ecol, rvarcol, mvarcol, nocases, hcol)
+        if joined == None and hcol == None:
+            joined = run_keys(rfn, mfn, hfn, ofn, rfilter, mfilter, efilter, hfilter,
+                              rcol, mcol, ecol, rvarcol, mvarcol, nocases)
     
-    if hfn != None:
-        hdic = load_hwe(hfn, hfilter, nocases)
+        if joined == None:
+            (rdic, r2_drop, er2_drop) = load_rsq(rfn, rfilter, rcol-1, rvarcol-1, efilter, ecol-1)
+            (mdic, maf_drop) = load_maf(mfn, mfilter, mcol-1, mvarcol-1)
     
+            if hfn != None:
+                hdic = load_hwe(hfn, hfilter, nocases)
+            elif hcol != None:
+                hdic = load_hwe_column(rfn, hfilter, hcol-1, rvarcol-1)
+                hfn = rfn
+    
+            logging.info('####################')
+            logging.info('Finding high quality variants')
+            count = 0
+            hq_keep = 0
+            total = len(rdic)
+
+            if hfn == None:
+                with open_text(ofn) as f1:
+                    for var in rdic:
+                        if var in mdic.keys():
+                            f1.write('%s\n' % var)
+                            hq_keep = hq_keep+1
+                        count = count+1
+                        if count%10000 == 0:
+                            logging.debug('Processed %s/%s variants' % (count, total))
+                logging.info('Processed %s/%s variants' % (count, total))
+            else:
+                with open_text(ofn) as f1:
+                    for var in rdic:
+                        if var in mdic.keys() and var not in hdic.keys():
+                            f1.write('%s\n' % var)
+                            hq_keep = hq_keep+1
+                        count = count+1
+                        if count%10000 == 0:
+                            logging.debug('Processed %s/%s variants' % (count, total))
+                logging.info('Processed %s/%s variants' % (count, total))
+            hwe_fail = len(hdic.keys()) if hfn != None else 0
+        else:
+            (r2_drop, er2_drop, maf_drop, hq_keep, hwe_fail) = joined
+        if cache != None and not cached:
+            cache.store(key, [ofn], [r2_drop, er2_drop, maf_drop, hq_keep, hwe_fail])
+        m['variants_kept'] = hq_keep
+
     logging.info('####################')
-    logging.info('Finding high quality variants')
-    count = 0
-    hq_keep = 0
-    total = len(rdic)
+    logging.info(' %s variants fail RSQ filter (%s)' % (r2_drop, rfilter))
+    logging.info(' %s genotyped variants fail ER2 filter (%s)' % (er2_drop, efilter))
+    logging.info(' %s variants fail MAF filter (%s)' % (maf_drop, mfilter))
+    if hfn != None or hcol != None:
+        logging.info(' %s variants fail HWE (%s)' % (hwe_fail, hfilter))
+    logging.info(' %s variants pass all filters' % hq_keep)
 
-    if hfn == None:
-        f1 = open(ofn, 'w')
-        for var in rdic:
-            if var in mdic.keys():
-                f1.write('%s\n' % var)
-                hq_keep = hq_keep+1
-            count = count+1
-            if count%10000 == 0:
-                logging.debug('Processed %s/%s variants' % (count, total))
-        logging.info('Processed %s/%s variants' % (count, total))
-        f1.close()
-    else:
-        f1 = open(ofn, 'w')
-        for var in rdic:
-            if var in mdic.keys() and var not in hdic.keys():
-                f1.write('%s\n' % var)
-                hq_keep = hq_keep+1
-            count = count+1
-            if count%10000 == 0:
-                logging.debug('Processed %s/%s variants' % (count, total))
-        logging.info('Processed %s/%s variants' % (count, total))
-        f1.close()
+    if hq_keep < min_num:
+        logging.warning('WARNING: low number of variants passing QC for chromosome %s (ideally want %s variants or more)' % (chrom, min_num))
 
+    logging.info('####################') 
+    logging.info('Filtering high quality variants done.')
+    logging.info('High quality variants IDs saved to:\n\t%s' % ofn)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+    return (r2_drop, er2_drop, maf_drop, hq_keep, hwe_fail)
+
+
+def run_fused(chrom, vcf_fn, sam_fn, hfn, ofn, rsq_fn,
+              rfilter, mfilter, efilter, hfilter, nocases,
+              block_size=1000, jobs=1, tempdir=None, python_lib='', binary=False, info_only=False,
+              calc_hwe=False, controls_fn=None, midp=False, decompress_threads=0):
+    if python_lib != '' and python_lib not in sys.path:
+        sys.path.append(python_lib)
+    
+    from calculate_rsq import open_vcf, compute_rsq, is_info_file, hwe_controls, hwe_header
+    
+    start = datetime.now()
+    calc_hwe = calc_hwe or controls_fn != None
+    
+    logging.info('############################')
+    logging.info('##### Rsq + Variant QC #####')
+    logging.info('############################')
+    logging.info('### Arguments')
+    logging.info('Chromosome\t%s' % chrom)
+    logging.info('VCF\t%s' % vcf_fn)
+    logging.info('Samples\t%s' % sam_fn)
+    logging.info('Rsq filter\t%s' % rfilter)
+    logging.info('ER2 filter\t%s' % efilter)
+    logging.info('MAF filter\t%s' % mfilter)
+    logging.info('HWE file\t%s' % hfn)
+    logging.info('HWE calculated\t%s' % calc_hwe)
+    if calc_hwe:
+        logging.info('HWE controls\t%s' % controls_fn)
+        logging.info('HWE mid-p\t%s' % midp)
+    if hfn != None or calc_hwe:
+        logging.info('HWE filter\t%s' % hfilter)
+    logging.info('Rsq output\t%s' % rsq_fn)
+    logging.info('Output\t%s' % ofn)
+    logging.info('Block size\t%s' % block_size)
+    logging.info('Jobs\t%s' % jobs)
+    logging.info('Decompression threads\t%s' % decompress_threads)
+    logging.info('INFO only\t%s' % info_only)
+    
+    if (info_only or is_info_file(vcf_fn)) and sam_fn != None:
+        logging.error('Site-level values (--info-only or an info file) cannot be used with a sample subset.')
+        sys.exit(1)
+    if calc_hwe and hfn != None:
+        logging.error('Use either an HWE file (--hwe) or --calc-hwe, not both.')
+        sys.exit(1)
+    if calc_hwe and (info_only or is_info_file(vcf_fn)):
+        logging.error('HWE needs genotypes (not available with --info-only or an info file).')
+        sys.exit(1)
+    
+    min_num = check_chrom(chrom)
+    
+    if hfn != None:
+        hdic = load_hwe(hfn, hfilter, nocases)
+    else:
+        hdic = {}
+    
+    logging.info('####################')
+    logging.info('Getting list of samples for calculation...')
+    (vcf, samples) = open_vcf(vcf_fn, sam_fn, info_only)
+    if vcf != None and len(vcf.samples) > 0:
+        logging.info('Number of samples: %s' % len(samples))
+    
+    hwe = None
+    if calc_hwe:
+        hwe = (hwe_controls(vcf.samples, controls_fn) if controls_fn != None else None, midp)
+    
+    logging.info('####################')
+    logging.info('Calculating rsq and finding high quality variants...')
+    fos = []
+    region_samples = None if sam_fn == None and not info_only else samples
+    try:
+        if rsq_fn != None:
+            fos.append(open_output(rsq_fn, binary))
+            fos[0].write('ID\tAAF\tRSQ\tRSQ_TOPMED\tER2%s\n' % hwe_header(hwe))
+        fos.append(open_text(ofn))
+        with metrics.stage('rsqqc') as m:
+            (counts, n_variants, qc_counts) = compute_rsq(vcf, vcf_fn, region_samples, fos, [None],
+                                                          block_size, jobs, tempdir, python_lib,
+                                                          qc=(rfilter, efilter, mfilter, hdic, hfilter), hwe=hwe,
+                                                          decompress_threads=decompress_threads)
+            m['records'] = n_variants
+    except BaseException:
+        for fo in fos:
+            abort(fo)
+        raise
+    for fo in fos:
+        fo.close()
+    (r2_drop, er2_drop, maf_drop, hq_keep, hwe_drop) = qc_counts
+    
+    logging.info('Processed %s variants' % n_variants)
+    logging.info('Number of variants monomorphic (rsq could not be calculated): %s' % counts[0][1])
+    
     logging.info('####################')
     logging.info(' %s variants fail RSQ filter (%s)' % (r2_drop, rfilter))
     logging.info(' %s genotyped variants fail ER2 filter (%s)' % (er2_drop, efilter))
     logging.info(' %s variants fail MAF filter (%s)' % (maf_drop, mfilter))
     if hfn != None:
         logging.info(' %s variants fail HWE (%s)' % (len(hdic.keys()), hfilter))
+    if calc_hwe:
+        logging.info(' %s variants fail HWE (%s)' % (hwe_drop, hfilter))
     logging.info(' %s variants pass all filters' % hq_keep)
 
     if hq_keep < min_num:
@@ -215,5 +650,204 @@ def run(chrom, rfn, mfn, hfn, ofn,
 
     logging.info('####################') 
     logging.info('Filtering high quality variants done.')
+    if rsq_fn != None:
+        logging.info('Rsq calculations saved to:\n\t%s' % rsq_fn)
     logging.info('High quality variants IDs saved to:\n\t%s' % ofn)
     logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
+    hwe_fail = len(hdic.keys()) if hfn != None else hwe_drop
+    return (counts[0], n_variants, (r2_drop, er2_drop, maf_drop, hq_keep, hwe_fail))
+
+
+def load_columns(fn, varcol, cols, names, track_bin=500000, badcol=10):
+    # ID getter and one float array per column (NaN if missing or not a number), TSV or binary table
+    import numpy as np
+    
+    logging.info('####################')
+    logging.info('Loading %s: %s' % ('/'.join(names), fn))
+    if is_binary(fn):
+        check_idcol(fn, varcol)
+        table = open_table(fn)
+        values = [np.asarray(column(table, col)) for col in cols]
+        logging.info('Processed %s variants' % table['n'])
+        return (table['n'], lambda rows: get_ids(table, rows), values)
+    
+    ids = []
+    values = [[] for col in cols]
+    wrong = [0 for col in cols]
+    nan = float('nan')
+    with gzip.open(fn, 'rt') if fn.endswith('.gz') else open(fn) as f1:
+        for line in f1:
+            ln = line.strip().split('\t')
+            ids.append(ln[varcol])
+            for (k, col) in enumerate(cols):
+                x = ln[col]
+                try:
+                    values[k].append(float(x))
+                except:
+                    values[k].append(nan)
+                    if x != '-' and x != '.':
+                        logging.debug('%s is not a number' % x)
+                        wrong[k] = wrong[k]+1
+                        if wrong[k] > badcol:
+                            logging.error("Check your column number for %s. It doesn't seem right." % names[k])
+                            logging.error('%s is not a number' % x)
+                            sys.exit(1)
+            if len(ids)%track_bin == 0:
+                logging.debug('Processed %s lines' % len(ids))
+    logging.info('Processed %s lines' % len(ids))
+    return (len(ids), lambda rows: [ids[i] for i in rows], [np.array(v, dtype=np.float64) for v in values])
+
+
+def load_hwe_min(hfile, nocases, badcol=10):
+    # lowest p-value of the relevant test per variant (same tests as load_hwe)
+    logging.info('####################')
+    logging.info('Loading HWE p-values...')
+    
+    wrong_col = 0
+    hmin = {}
+    with open(hfile) as f1:
+        for line in f1:
+            ln = line.strip().split()
+            try:
+                hwe = float(ln[8])
+            except:
+                logging.debug('%s is not a number' % ln[8])
+                wrong_col = wrong_col+1
+                if wrong_col > badcol:
+                    logging.error("Check your HWE file. It doesn't seem right.")
+                    sys.exit(1)
+                continue
+            if ('ALL' in ln[2]) if nocases else (ln[2] == 'UNAFF'):
+                if ln[1] not in hmin or hwe < hmin[ln[1]]:
+                    hmin[ln[1]] = hwe
+    logging.info('%s variants with HWE p-values' % len(hmin))
+    return hmin
+
+
+def align(ids, other_ids, other_values):
+    # other_values reordered to ids (NaN where missing)
+    import numpy as np
+    
+    keys = VariantKeys()
+    id_keys = keys.encode(ids)
+    other_keys = keys.encode(other_ids) if id_keys is not None else None
+    if other_keys is not None:
+        # last value for repeated keys, as the dict below
+        order = np.argsort(other_keys[::-1], kind='stable')
+        (sorted_keys, first) = np.unique(other_keys[::-1][order], return_index=True)
+        sorted_values = np.asarray(other_values)[::-1][order][first]
+        found = isin(id_keys, sorted_keys)
+        aligned = np.full(len(ids), np.nan)
+        aligned[found] = sorted_values[np.searchsorted(sorted_keys, id_keys[found])]
+        return aligned
+    
+    index = dict((var, i) for (i, var) in enumerate(other_ids))
+    rows = np.array([index.get(var, -1) for var in ids], dtype=np.int64)
+    aligned = np.full(len(ids), np.nan)
+    aligned[rows >= 0] = other_values[rows[rows >= 0]]
+    return aligned
+
+
+def parse_grid(text):
+    return [float(x) for x in str(text).split(',') if x != '']
+
+
+def run_sweep(chrom, rfn, mfn, hfn, ofn,
+              rgrid, mgrid, egrid, hgrid,
+              rcol, mcol, ecol, rvarcol, mvarcol,
+              nocases, point=None, passing_fn=None, hcol=None):
+    import numpy as np
+    
+    start = datetime.now()
+    
+    logging.info('############################')
+    logging.info('##### Variant QC sweep #####')
+    logging.info('############################')
+    logging.info('### Arguments')
+    logging.info('Chromosome\t%s' % chrom)
+    logging.info('Rsq file\t%s' % rfn)
+    logging.info('Rsq filters\t%s' % rgrid)
+    logging.info('ER2 filters\t%s' % egrid)
+    logging.info('MAF file\t%s' % mfn)
+    logging.info('MAF filters\t%s' % mgrid)
+    logging.info('HWE file\t%s' % hfn)
+    logging.info('HWE column\t%s' % hcol)
+    if hfn != None or hcol != None:
+        logging.info('HWE filters\t%s' % hgrid)
+    logging.info('Output\t%s' % ofn)
+    if point != None:
+        logging.info('Selected filters\t%s' % (point,))
+        logging.info('Passing variants\t%s' % passing_fn)
+    
+    if hfn != None and hcol != None:
+        logging.error('Use either an HWE file (--hwe) or an HWE column of the Rsq file (-hc), not both.')
+        sys.exit(1)
+    
+    min_num = check_chrom(chrom)
+    
+    if mfn == rfn and mvarcol == rvarcol:
+        # one file for both: read it once
+        (n, rsq_ids, (rsq, er2, maf)) = load_columns(rfn, rvarcol-1, [rcol-1, ecol-1, mcol-1],
+                                                     ['Rsq (-rc)', 'ER2 (-ec)', 'MAF (-mc)'])
+        maf_al = maf
+    else:
+        (n, rsq_ids, (rsq, er2)) = load_columns(rfn, rvarcol-1, [rcol-1, ecol-1], ['Rsq (-rc)', 'ER2 (-ec)'])
+        (m_n, maf_ids, (maf,)) = load_columns(mfn, mvarcol-1, [mcol-1], ['MAF (-mc)'])
+        maf_al = align(rsq_ids(range(n)), maf_ids(range(m_n)), maf)
+    
+    if hfn != None:
+        hmin = load_hwe_min(hfn, nocases)
+        hvals = np.array(list(hmin.values()), dtype=np.float64)
+        hwe_al = align(rsq_ids(range(n)), list(hmin.keys()), hvals)
+    elif hcol != None:
+        (h_n, h_ids, (hvals,)) = load_columns(rfn, rvarcol-1, [hcol-1], ['HWE (-hc)'])
+        hwe_al = hvals
+    else:
+        hgrid = [None]
+    
+    def evaluate(rf, mf, ef, hf):
+        r2_pass = rsq >= rf
+        er2_pass = np.isnan(er2) | (er2 >= ef)
+        keep = r2_pass & er2_pass & (maf_al >= mf) & (maf_al <= 1-mf)
+        counts = [int((~np.isnan(rsq) & ~r2_pass).sum()),
+                  int((r2_pass & ~er2_pass).sum()),
+                  int((~np.isnan(maf) & ~((maf >= mf) & (maf <= 1-mf))).sum())]
+        if hf != None:
+            keep = keep & ~(hwe_al <= hf)
+            counts.append(int((hvals <= hf).sum()))
+        else:
+            counts.append('-')
+        return (keep, counts)
+    
+    logging.info('####################')
+    logging.info('Evaluating %s filter combinations' % (len(rgrid)*len(mgrid)*len(egrid)*len(hgrid)))
+    fo = open(ofn, 'w')
+    fo.write('CHROM\tRSQ_FILTER\tMAF_FILTER\tER2_FILTER\tHWE_FILTER\tRSQ_FAIL\tER2_FAIL\tMAF_FAIL\tHWE_FAIL\tPASS\tMIN_PASS\tLOW\n')
+    for rf in rgrid:
+        for mf in mgrid:
+            for ef in egrid:
+                for hf in hgrid:
+                    (keep, counts) = evaluate(rf, mf, ef, hf)
+                    hq_keep = int(keep.sum())
+                    row = [chrom, rf, mf, ef, '-' if hf == None else hf] + counts + [hq_keep, min_num, hq_keep < min_num]
+                    fo.write('\t'.join(map(str, row)) + '\n')
+                    logging.debug('Rsq %s, MAF %s, ER2 %s, HWE %s: %s variants pass all filters' % (rf, mf, ef, hf, hq_keep))
+    fo.close()
+    
+    if point != None:
+        (rf, mf, ef, hf) = point
+        (keep, counts) = evaluate(rf, mf, ef, hf if hfn != None or hcol != None else None)
+        f1 = open(passing_fn, 'w')
+        for var in rsq_ids(np.flatnonzero(keep)):
+            f1.write('%s\n' % var)
+        f1.close()
+        logging.info('####################')
+        logging.info(' %s variants pass all filters (Rsq %s, MAF %s, ER2 %s, HWE %s)' % (int(keep.sum()), rf, mf, ef, hf))
+        if int(keep.sum()) < min_num:
+            logging.warning('WARNING: low number of variants passing QC for chromosome %s (ideally want %s variants or more)' % (chrom, min_num))
+        logging.info('High quality variants IDs saved to:\n\t%s' % passing_fn)
+    
+    logging.info('####################') 
+    logging.info('QC sweep done.')
+    logging.info('Pass counts saved to:\n\t%s' % ofn)
+    logging.info('Runtime: ' + str(datetime.now()-start) + '\n')
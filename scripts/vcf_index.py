@@ -0,0 +1,180 @@
+import os
+import sys
+import gzip
+import json
+import struct
+import logging
+from bisect import bisect_left
+
+
+def find_index(vcf_fn):
+    for ext in ('.tbi', '.csi'):
+        if os.path.exists(vcf_fn + ext):
+            return vcf_fn + ext
+    return None
+
+
+def _read(fh, fmt):
+    size = struct.calcsize(fmt)
+    return struct.unpack(fmt, fh.read(size))
+
+
+def _names(buf):
+    # tabix header: format, col_seq, col_beg, col_end, meta, skip, l_nm, names
+    l_nm = struct.unpack('<i', buf[24:28])[0]
+    return buf[28:28+l_nm].decode().split('\0')[:-1]
+
+
+def read_index(idx_fn):
+    # returns one entry per contig:
+    # [name, [(0-based window start, compressed offset), ...], last compressed offset, n_records]
+    with gzip.open(idx_fn, 'rb') as fh:
+        magic = fh.read(4)
+        if magic == b'TBI\1':
+            min_shift = 14
+            depth = 5
+            (n_ref,) = _read(fh, '<i')
+            conf = fh.read(28)
+            l_nm = struct.unpack('<i', conf[24:28])[0]
+            names = _names(conf + fh.read(l_nm))
+            csi = False
+        elif magic == b'CSI\1':
+            (min_shift, depth, l_aux) = _read(fh, '<iii')
+            aux = fh.read(l_aux)
+            names = _names(aux) if l_aux >= 28 else []
+            (n_ref,) = _read(fh, '<i')
+            csi = True
+        else:
+            logging.error('%s is not a tabix (.tbi) or CSI (.csi) index.' % idx_fn)
+            sys.exit(1)
+
+        # metadata pseudo-bin sits just past the last real bin
+        meta_bin = ((1 << ((depth+1)*3)) - 1)//7 + 1
+        leaf = ((1 << (depth*3)) - 1)//7
+
+        contigs = []
+        for i in range(n_ref):
+            (n_bin,) = _read(fh, '<i')
+            windows = []
+            last = 0
+            n_records = 0
+            for j in range(n_bin):
+                if csi:
+                    (bin_id, loffset, n_chunk) = _read(fh, '<IQi')
+                else:
+                    (bin_id, n_chunk) = _read(fh, '<Ii')
+                chunks = _read(fh, '<%dQ' % (2*n_chunk))
+                if bin_id == meta_bin:
+                    # (start, end) virtual offsets, then (mapped, unmapped) counts
+                    last = max(last, chunks[1] >> 16)
+                    n_records = chunks[2]
+                    continue
+                last = max(last, max(chunks[1::2]) >> 16)
+                if csi and bin_id >= leaf:
+                    windows.append(((bin_id-leaf) << min_shift, loffset >> 16))
+            if not csi:
+                (n_intv,) = _read(fh, '<i')
+                ioff = _read(fh, '<%dQ' % n_intv)
+                windows = [(k << 14, ioff[k] >> 16) for k in range(n_intv) if ioff[k] != 0]
+            windows.sort()
+            name = names[i] if i < len(names) else None
+            contigs.append([name, windows, last, n_records])
+    return contigs
+
+
+def split_regions(vcf_fn, n_regions, seqnames=None):
+    # split every contig into ~n_regions pieces holding similar amounts of compressed data
+    # regions are (chrom, start, end) 1-based inclusive, end is None for the rest of the contig
+    idx_fn = find_index(vcf_fn)
+    if idx_fn == None:
+        logging.error('No tabix index (.tbi or .csi) found for %s.' % vcf_fn)
+        logging.error('Index it with: tabix -p vcf %s' % vcf_fn)
+        sys.exit(1)
+
+    regions = []
+    for (i, (name, windows, last, n_records)) in enumerate(read_index(idx_fn)):
+        if name == None:
+            name = seqnames[i]
+        if len(windows) == 0:
+            continue
+        offsets = [off for (pos, off) in windows]
+        first = offsets[0]
+        bounds = []
+        for k in range(1, n_regions):
+            target = first + (last-first)*k/n_regions
+            w = bisect_left(offsets, target)
+            if w < len(windows) and windows[w][0] > 0 and (len(bounds) == 0 or windows[w][0] > bounds[-1]):
+                bounds.append(windows[w][0])
+        start = 1
+        for pos in bounds:
+            regions.append((name, start, pos))
+            start = pos+1
+        regions.append((name, start, None))
+    return regions
+
+
+# metadata already read in this process, by absolute path
+_metadata = {}
+
+
+def vcf_fingerprint(vcf_fn):
+    # changes when the VCF or its index is rewritten
+    fingerprint = []
+    for fn in [vcf_fn, find_index(vcf_fn)]:
+        if fn != None:
+            stat = os.stat(fn)
+            fingerprint = fingerprint + [os.path.basename(fn), stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def vcf_metadata(vcf_fn):
+    # samples, contigs and record counts per contig (from the tabix index, None without one) of a VCF
+    # saved next to it (<vcf>.meta.json) and rebuilt when the VCF or its index changes
+    import cyvcf2
+
+    path = os.path.abspath(vcf_fn)
+    fingerprint = vcf_fingerprint(vcf_fn)
+    meta = _metadata.get(path)
+    meta_fn = vcf_fn + '.meta.json'
+    if meta == None and os.path.exists(meta_fn):
+        try:
+            with open(meta_fn) as f1:
+                meta = json.load(f1)
+        except (OSError, ValueError):
+            meta = None
+    if meta != None and meta['fingerprint'] == fingerprint:
+        _metadata[path] = meta
+        return meta
+
+    logging.debug('Indexing VCF metadata: %s' % vcf_fn)
+    vcf = cyvcf2.VCF(fname=vcf_fn, lazy=True)
+    samples = list(vcf.samples)
+    contigs = list(vcf.seqnames)
+    vcf.close()
+    records = None
+    idx_fn = find_index(vcf_fn)
+    if idx_fn != None:
+        records = {}
+        for (i, (name, windows, last, n_records)) in enumerate(read_index(idx_fn)):
+            records[name if name != None else contigs[i]] = n_records
+    meta = {'fingerprint': fingerprint, 'samples': samples, 'contigs': contigs, 'records': records}
+    _metadata[path] = meta
+
+    temp = '%s.%s.tmp' % (meta_fn, os.getpid())
+    try:
+        with open(temp, 'w') as fo:
+            json.dump(meta, fo)
+        os.replace(temp, meta_fn)
+    except OSError:
+        # read-only directory: kept for this run only
+        logging.debug('Cannot write %s' % meta_fn)
+    return meta
+
+
+def n_records(meta, contig=None):
+    # records in the VCF (or on one contig) by its index, None without an index
+    if meta['records'] == None:
+        return None
+    if contig != None:
+        return meta['records'].get(contig, 0)
+    return sum(meta['records'].values())